@@ -8,11 +8,58 @@ export async function OPTIONS() {
   return NextResponse.json({}, { headers: corsHeaders });
 }
 
+type RollupRow = {
+  month: string;
+  item_count: number | string;
+  total_amount: number | string;
+  report_count: number | string;
+};
+
+/**
+ * Amounts from the user's user_stats_monthly rows (migration 037): one row per
+ * workspace and month, kept up to date by triggers. Months are UTC, like the
+ * month windows below on the server. The rollup only holds the user's own
+ * reports, like the get_user_* RPCs (029); the report and receipt counts
+ * also include shared workspace data (026), so they come from RLS counts.
+ */
+function statsFromRollup(rows: RollupRow[], now: Date, totalReports: number, totalReceipts: number) {
+  const monthKey = (offset: number) =>
+    new Date(Date.UTC(now.getUTCFullYear(), now.getUTCMonth() + offset, 1)).toISOString().slice(0, 10);
+  const thisMonth = monthKey(0);
+  const lastMonth = monthKey(-1);
+
+  let totalThisMonth = 0, totalLastMonth = 0, totalAllTime = 0;
+  let receiptCountThisMonth = 0;
+  for (const row of rows) {
+    const amount = Number(row.total_amount);
+    const items = Number(row.item_count);
+    totalAllTime += amount;
+    if (row.month === thisMonth) {
+      totalThisMonth += amount;
+      receiptCountThisMonth += items;
+    } else if (row.month === lastMonth) {
+      totalLastMonth += amount;
+    }
+  }
+
+  return {
+    totalThisMonth,
+    totalAllTime,
+    monthOverMonthTrend: totalLastMonth > 0 ? ((totalThisMonth - totalLastMonth) / totalLastMonth) * 100 : 0,
+    receiptCountThisMonth,
+    totalReports,
+    totalReceipts,
+  };
+}
+
 /**
  * GET /api/mobile/stats
  * Returns pre-computed spending statistics for the authenticated user.
  * RLS auto-filters all queries to the current user.
  *
+ * Reads the user_stats_monthly rollup (a few rows per user). Until migration
+ * 037 has run, falls back to aggregating expense_items as below.
+ *
  * Intentionally loads all expense amounts (no pagination) because stats
  * must be accurate across the entire history, not just page 1.
  * The payload is small — only `amount`, `transaction_date`, `created_at`
@@ -38,6 +85,28 @@ export async function GET(request: NextRequest) {
     const { supabase } = mobileClient;
 
     const now = new Date();
+
+    // ── Rollup: one small read instead of re-aggregating expense_items ──
+    // Plus the RLS-scoped counts, which include workspaces shared with the user
+    const [rollupRes, reportCountRes, receiptCountRes] = await Promise.all([
+      supabase
+        .from('user_stats_monthly')
+        .select('month, item_count, total_amount, report_count'),
+      supabase
+        .from('expense_reports')
+        .select('id', { count: 'exact', head: true }),
+      supabase
+        .from('expense_items')
+        .select('id', { count: 'exact', head: true }),
+    ]);
+    if (!rollupRes.error) {
+      return NextResponse.json(
+        statsFromRollup(rollupRes.data ?? [], now, reportCountRes.count ?? 0, receiptCountRes.count ?? 0),
+        { headers: corsHeaders }
+      );
+    }
+    console.error('[stats] user_stats_monthly:', rollupRes.error.message);
+
     const startOfMonth     = new Date(now.getFullYear(), now.getMonth(), 1).toISOString();
     const startOfNextMonth = new Date(now.getFullYear(), now.getMonth() + 1, 1).toISOString();
     const startOfLastMonth = new Date(now.getFullYear(), now.getMonth() - 1, 1).toISOString();
@@ -65,10 +134,10 @@ export async function GET(request: NextRequest) {
       return count ?? 0;
     };
 
-    // ── Parallel server-side aggregations (RPC) + lightweight counts ──
+    // ── Parallel server-side aggregations (RPC); the counts were fetched above ──
     // Use start-of-next-month as the exclusive upper bound so items added
     // any time during the current month are counted (not capped at 'now').
-    const [thisMonthTotalRes, lastMonthTotalRes, thisMonthCountRes, allTimeTotalRes, reportsRes, totalReceiptsRes] = await Promise.all([
+    const [thisMonthTotalRes, lastMonthTotalRes, thisMonthCountRes, allTimeTotalRes] = await Promise.all([
       supabase.rpc('get_user_month_total', {
         start_date: startOfMonth,
         end_date: startOfNextMonth,
@@ -82,12 +151,6 @@ export async function GET(request: NextRequest) {
         end_date: startOfNextMonth,
       }),
       supabase.rpc('get_user_total_amount'),
-      supabase
-        .from('expense_reports')
-        .select('id', { count: 'exact', head: true }),
-      supabase
-        .from('expense_items')
-        .select('id', { count: 'exact', head: true }),
     ]);
 
     // ── Log RPC errors explicitly (visible in Vercel function logs) ──
@@ -121,8 +184,8 @@ export async function GET(request: NextRequest) {
       totalAllTime,
       monthOverMonthTrend,
       receiptCountThisMonth,
-      totalReports: reportsRes.count ?? 0,
-      totalReceipts: totalReceiptsRes.count ?? 0,
+      totalReports: reportCountRes.count ?? 0,
+      totalReceipts: receiptCountRes.count ?? 0,
     }, { headers: corsHeaders });
   } catch (error: any) {
     console.error('Error in mobile stats:', error instanceof Error ? error.message : String(error));
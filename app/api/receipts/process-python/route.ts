@@ -1,41 +1,59 @@
 import { NextRequest, NextResponse } from 'next/server';
-import { auth } from '@clerk/nextjs/server';
-import { exec } from 'child_process';
-import { promisify } from 'util';
-import path from 'path';
+import { auth, currentUser } from '@clerk/nextjs/server';
+import { processWithPython } from '@/lib/receipt-processing/python-client';
 
-const execAsync = promisify(exec);
+/**
+ * Read the image bytes from the request body.
+ *
+ * Preferred: multipart `image` field or a raw image/octet-stream body, which
+ * reach the Python processor as binary without any base64 round trip.
+ * Legacy: JSON `{ imageData }` base64 payloads are decoded once here.
+ */
+async function readImage(req: NextRequest): Promise<{ image: Buffer | null; mobileQrUrl?: string }> {
+  const contentType = req.headers.get('content-type') || '';
+
+  if (contentType.startsWith('multipart/form-data')) {
+    const formData = await req.formData();
+    const imageFile = formData.get('image') as File | null;
+    const mobileQrUrl = (formData.get('qrUrl') as string | null) || undefined;
+    return {
+      image: imageFile ? Buffer.from(await imageFile.arrayBuffer()) : null,
+      mobileQrUrl,
+    };
+  }
+
+  if (contentType.startsWith('application/json')) {
+    const { imageData, qrUrl } = await req.json();
+    if (!imageData) return { image: null };
+    const base64 = String(imageData).replace(/^data:[^,]*,/, '');
+    return { image: Buffer.from(base64, 'base64'), mobileQrUrl: qrUrl || undefined };
+  }
+
+  const body = Buffer.from(await req.arrayBuffer());
+  return { image: body.length > 0 ? body : null };
+}
 
 export async function POST(req: NextRequest) {
   try {
     const { userId } = await auth();
-    if (!userId) {
+    const user = userId ? await currentUser() : null;
+    if (!userId || !user) {
       return NextResponse.json({ error: 'Unauthorized' }, { status: 401 });
     }
-
-    const { imageData } = await req.json();
-
-    if (!imageData) {
-      return NextResponse.json({ error: 'No image data provided' }, { status: 400 });
+    // Near-duplicates are scoped like raw_receipts rows: by the uploader's email
+    const userEmail = user.emailAddresses[0]?.emailAddress;
+    if (!userEmail) {
+      return NextResponse.json({ error: 'User email not found' }, { status: 400 });
     }
 
-    // Path to Python processor wrapper
-    const wrapperPath = path.join(
-      process.cwd(),
-      'lib/receipt-processing/python-processor/processor-wrapper.py'
-    );
-
-    // Execute Python processor via wrapper
-    const { stdout, stderr } = await execAsync(
-      `python3 "${wrapperPath}" '${imageData}'`,
-      { maxBuffer: 10 * 1024 * 1024 } // 10MB buffer for large responses
-    );
+    const { image, mobileQrUrl } = await readImage(req);
 
-    if (stderr) {
-      // Python stderr captured but not logged in production
+    if (!image) {
+      return NextResponse.json({ error: 'No image data provided' }, { status: 400 });
     }
 
-    const result = JSON.parse(stdout);
+    // Long-lived Python worker pool (started on first use)
+    const result = await processWithPython({ image, mobileQrUrl, dedupeScope: userEmail });
 
     if (!result.success) {
       return NextResponse.json(
@@ -1,5 +1,6 @@
 import axios from 'axios';
 import * as cheerio from 'cheerio';
+import { scrapeKRAWithPython } from './python-client';
 
 export interface KRAInvoiceData {
   invoiceNumber: string;
@@ -13,10 +14,41 @@ export interface KRAInvoiceData {
   scrapedAt: string;
 }
 
+// Pool failures that say nothing about the invoice; anything else is KRA's
+// answer after the pool's own retries, and fetching again only adds load
+const POOL_UNAVAILABLE_ERRORS = new Set(['worker_crashed']);
+
 export async function scrapeKRAInvoice(
   qrUrl: string,
   maxRetries = 3
 ): Promise<KRAInvoiceData | null> {
+  // Prefer the Python pool: keep-alive connections and a persistent invoice cache.
+  // null means the pool is not running or could not be reached.
+  const pooled = await scrapeKRAWithPython(qrUrl).catch((error) => {
+    console.warn('KRA scraping through the pool failed, fetching directly:', error);
+    return null;
+  });
+  if (pooled && !pooled.success) {
+    if (!POOL_UNAVAILABLE_ERRORS.has(pooled.error_type)) {
+      console.error('KRA scraping failed:', pooled.error);
+      return null;
+    }
+    console.warn('KRA scraping through the pool failed, fetching directly:', pooled.error);
+  } else if (pooled) {
+    const invoice = pooled.invoice;
+    return {
+      invoiceNumber: invoice.invoice_number,
+      traderInvoiceNo: invoice.trader_invoice_no,
+      invoiceDate: invoice.invoice_date,
+      merchantName: invoice.merchant_name,
+      totalAmount: invoice.total_amount,
+      taxableAmount: invoice.taxable_amount,
+      vatAmount: invoice.vat_amount,
+      verified: invoice.verified,
+      scrapedAt: invoice.scraped_at,
+    };
+  }
+
   for (let attempt = 1; attempt <= maxRetries; attempt++) {
     try {
       // Add delay on retries to respect KRA servers
@@ -10,6 +10,7 @@ import { scrapeKRAInvoice } from './kra-scraper';
 // import { extractWithTesseract } from './ocr-free'; // Disabled: causes worker issues in Vercel
 import { extractReceiptWithGemini } from './ocr-ai';
 import { rawReceiptStorage, type RawReceiptData } from './raw-storage';
+import { hashImageWithPython } from './python-client';
 import { storeRecognizer } from './store-recognition';
 import { templateRegistry } from './template-registry';
 import { aiReceiptEnhancer } from './ai-enhancement';
@@ -17,6 +18,10 @@ import type { SupabaseClient } from '@supabase/supabase-js';
 
 import { createHash } from 'crypto';
 
+// How long an upload waits for the KRA portal before leaving the receipt to
+// the background verification queue (receipt_processor.kra_queue)
+const KRA_INLINE_BUDGET_MS = parseInt(process.env.KRA_INLINE_BUDGET_MS || '2500', 10);
+
 // SHA-256 hash for reliable duplicate detection
 function calculateHash(buffer: Buffer): string {
   return createHash('sha256').update(buffer).digest('hex');
@@ -130,6 +135,11 @@ export class ReceiptProcessor {
       const imageUrl = await this.uploadImage(imageBuffer, imageFile.name, supabase, options.userEmail, imageFile.type, options.userId);
       result.imageUrl = imageUrl;
       
+      // Perceptual hash for near-duplicate detection, in parallel with extraction
+      const perceptualHashTask = options.storeRaw !== false
+        ? hashImageWithPython(imageBuffer, options.userEmail)
+        : Promise.resolve(null);
+
       // Check for duplicates
       if (options.storeRaw !== false) {
         const duplicates = await rawReceiptStorage.findDuplicates(imageHash, supabase);
@@ -174,11 +184,29 @@ export class ReceiptProcessor {
       // Start with Google Vision data as base
       let kraData = ocrData;
       
-      // Extract KRA data if QR has URL (enhances/verifies Vision data)
+      // Extract KRA data if QR has URL (enhances/verifies Vision data).
+      // The upload only waits KRA_INLINE_BUDGET_MS for the portal; anything
+      // slower is verified later by the background queue (kraStatus 'pending').
+      let kraPending = false;
+      let kraVerified = false;
       if (effectiveQrData?.url) {
+        let budgetTimer: ReturnType<typeof setTimeout> | undefined;
         try {
-          const kraScrapedData = await scrapeKRAInvoice(effectiveQrData.url);
-          if (kraScrapedData) {
+          const scrape = scrapeKRAInvoice(effectiveQrData.url).catch((error) => {
+            console.warn('KRA verification failed - using Vision OCR only', error);
+            return null;
+          });
+          const kraScrapedData = await Promise.race([
+            scrape,
+            new Promise<'timeout'>((resolve) => {
+              budgetTimer = setTimeout(() => resolve('timeout'), KRA_INLINE_BUDGET_MS);
+            }),
+          ]);
+          if (kraScrapedData === 'timeout') {
+            kraPending = true;
+            result.warnings.push('KRA verification queued');
+            result.kraData = ocrData;
+          } else if (kraScrapedData) {
             // Merge: KRA data takes priority over Vision where available
             kraData = {
               merchantName: kraScrapedData.merchantName || ocrData?.merchantName || 'Unknown Merchant',
@@ -187,14 +215,19 @@ export class ReceiptProcessor {
               invoiceNumber: kraScrapedData.invoiceNumber || ocrData?.invoiceNumber || null,
             };
             result.kraData = kraData;
+            kraVerified = true;
           } else {
-            result.warnings.push('KRA returned no data');
+            kraPending = true;
+            result.warnings.push('KRA returned no data - verification queued');
             result.kraData = ocrData;
           }
         } catch (error) {
           console.warn('KRA verification failed - using Vision OCR only');
-          result.warnings.push('KRA verification failed');
+          kraPending = true;
+          result.warnings.push('KRA verification failed - verification queued');
           result.kraData = ocrData;
+        } finally {
+          clearTimeout(budgetTimer);
         }
       } else {
         // No QR code - use pure Vision OCR
@@ -248,6 +281,11 @@ export class ReceiptProcessor {
       // ==========================================
       if (options.storeRaw !== false) {
         
+        const imageHashes = await perceptualHashTask;
+        if (imageHashes?.nearDuplicates.length) {
+          result.warnings.push(`Possible duplicate receipt (${imageHashes.nearDuplicates.length} similar photos found)`);
+        }
+        
         // Check if QR code is eTIMS/KRA
         const hasEtimsQR = effectiveQrData?.url?.includes('itax.kra.go.ke') || 
                           effectiveQrData?.url?.includes('etims.kra.go.ke') ||
@@ -260,11 +298,15 @@ export class ReceiptProcessor {
           workspaceId: options.workspaceId,
           imageUrl,
           imageHash,
+          perceptualHash: imageHashes?.perceptualHash,
           rawQrData: effectiveQrData,
           etimsQRDetected: hasEtimsQR, // NEW: Flag eTIMS QR detection
           etimsQRUrl: hasEtimsQR ? (effectiveQrData?.url || effectiveQrData?.rawValue) : undefined, // NEW: Store eTIMS URL
           rawOcrText: ocrData?.rawText,
           rawKraData: kraData,
+          // Only an inline scrape that returned the invoice counts as verified; an
+          // eTIMS receipt without a usable URL has nothing to verify
+          kraStatus: kraVerified ? 'verified' : (hasEtimsQR && kraPending ? 'pending' : undefined),
           receiptFullText: ocrData?.rawText || '', // NEW: Bag of words for search
           fileSizeBytes: imageBuffer.length,
           mimeType: imageFile.type,
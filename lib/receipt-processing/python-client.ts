@@ -0,0 +1,215 @@
+/**
+ * PYTHON PROCESSOR CLIENT
+ *
+ * Talks to the long-lived Python worker pool (python-processor/receipt_processor/server.py)
+ * over a Unix socket instead of spawning a fresh interpreter per receipt.
+ *
+ * Protocol: frames of 4-byte big-endian length + payload. A request is a JSON
+ * header frame followed by the raw image bytes as a binary frame (no base64, no
+ * argv). The response is a single JSON frame. The pool is started lazily on
+ * first use if nothing is listening on the socket.
+ */
+
+import net from 'net';
+import path from 'path';
+import { spawn } from 'child_process';
+
+const SOCKET_PATH = process.env.PYTHON_PROCESSOR_SOCKET || '/tmp/kacha-receipt-processor.sock';
+const PROCESSOR_DIR = path.join(process.cwd(), 'lib/receipt-processing/python-processor');
+const REQUEST_TIMEOUT_MS = 60_000;
+const STARTUP_TIMEOUT_MS = 30_000;
+
+let serverStartup: Promise<void> | null = null;
+
+export interface PythonProcessRequest {
+  image: Buffer; // raw image bytes
+  mobileQrUrl?: string;
+  alwaysOcr?: boolean; // OCR even when an eTIMS QR is found (default: skip)
+  fullPageOcr?: boolean; // skip the partial roi OCR tier so the result has line items
+  dedupeScope?: string; // only report near-duplicates uploaded by the same user (their email)
+  derivatives?: boolean; // also write storage + thumbnail copies (result.derivatives[name].path) for upload
+}
+
+function frameHeader(length: number): Buffer {
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(length, 0);
+  return header;
+}
+
+/**
+ * Send a JSON header (plus optional binary body) and resolve with the decoded response frame
+ */
+function sendRequest(
+  message: Record<string, unknown>,
+  body?: Buffer,
+  timeoutMs = REQUEST_TIMEOUT_MS
+): Promise<any> {
+  return new Promise((resolve, reject) => {
+    const socket = net.createConnection(SOCKET_PATH);
+    const chunks: Buffer[] = [];
+    let received = 0;
+
+    socket.setTimeout(timeoutMs, () => {
+      socket.destroy(new Error(`Python processor timed out after ${timeoutMs}ms`));
+    });
+
+    socket.on('connect', () => {
+      const payload = Buffer.from(JSON.stringify(body ? { ...message, body: true } : message), 'utf8');
+      socket.write(frameHeader(payload.length));
+      socket.write(payload);
+      if (body) {
+        // Written as-is: the image buffer is never copied or re-encoded
+        socket.write(frameHeader(body.length));
+        socket.write(body);
+      }
+    });
+
+    socket.on('data', (chunk: Buffer) => {
+      chunks.push(chunk);
+      received += chunk.length;
+      if (received < 4) return;
+
+      const buffer = Buffer.concat(chunks);
+      const length = buffer.readUInt32BE(0);
+      if (buffer.length < 4 + length) return;
+
+      socket.end();
+      try {
+        resolve(JSON.parse(buffer.subarray(4, 4 + length).toString('utf8')));
+      } catch (error) {
+        reject(error);
+      }
+    });
+
+    socket.on('error', reject);
+    socket.on('close', () => reject(new Error('Python processor closed the connection')));
+  });
+}
+
+/**
+ * Start the worker pool once per Node process and wait until it answers a ping
+ */
+function ensureServer(): Promise<void> {
+  if (!serverStartup) {
+    serverStartup = (async () => {
+      const child = spawn('python3', ['-m', 'receipt_processor.server', '--socket', SOCKET_PATH], {
+        cwd: PROCESSOR_DIR,
+        stdio: ['ignore', 'ignore', 'inherit'],
+      });
+      child.on('exit', () => {
+        serverStartup = null; // allow a restart on the next request
+      });
+
+      const deadline = Date.now() + STARTUP_TIMEOUT_MS;
+      while (Date.now() < deadline) {
+        try {
+          await sendRequest({ op: 'ping' }, undefined, 1_000);
+          return;
+        } catch {
+          await new Promise((resolve) => setTimeout(resolve, 200));
+        }
+      }
+      child.kill();
+      throw new Error('Python processor did not start in time');
+    })();
+    serverStartup.catch(() => {
+      serverStartup = null;
+    });
+  }
+  return serverStartup;
+}
+
+function isNotListening(error: any): boolean {
+  return error?.code === 'ENOENT' || error?.code === 'ECONNREFUSED';
+}
+
+/**
+ * Process a receipt image with the Python worker pool
+ */
+export async function processWithPython(request: PythonProcessRequest): Promise<any> {
+  const message = {
+    op: 'process',
+    mobile_qr_url: request.mobileQrUrl,
+    always_ocr: request.alwaysOcr,
+    full_page_ocr: request.fullPageOcr,
+    dedupe_scope: request.dedupeScope,
+    derivatives: request.derivatives,
+  };
+
+  try {
+    return await sendRequest(message, request.image);
+  } catch (error) {
+    if (!isNotListening(error)) throw error;
+    await ensureServer();
+    return sendRequest(message, request.image);
+  }
+}
+
+/**
+ * Perceptual hash of an upload the TypeScript pipeline processes, plus earlier
+ * near-duplicates from the same user. Returns null when the pool is not running,
+ * so uploads never wait for a cold start.
+ */
+export async function hashImageWithPython(
+  image: Buffer,
+  dedupeScope?: string
+): Promise<{ perceptualHash: string; nearDuplicates: { image_hash: string; distance: number }[] } | null> {
+  try {
+    const response = await sendRequest({ op: 'hash_image', dedupe_scope: dedupeScope }, image, 5_000);
+    return response?.success
+      ? { perceptualHash: response.perceptual_hash, nearDuplicates: response.near_duplicates || [] }
+      : null;
+  } catch {
+    return null;
+  }
+}
+
+/**
+ * Stores within radiusMeters of a point from the pool's in-memory store directory.
+ * Returns null when the pool is not running, so callers can fall back to the
+ * find_stores_nearby RPC without waiting for a cold start.
+ */
+export async function findNearbyStoresWithPython(
+  latitude: number,
+  longitude: number,
+  radiusMeters = 100
+): Promise<any[] | null> {
+  try {
+    const response = await sendRequest(
+      { op: 'nearby_stores', latitude, longitude, radius_m: radiusMeters },
+      undefined,
+      1_000
+    );
+    return response?.success ? response.stores : null;
+  } catch {
+    return null;
+  }
+}
+
+/**
+ * Fuzzy store matches (closest name first) and the chain named in an OCR'd
+ * merchant name. Returns null when the pool is not running.
+ */
+export async function matchMerchantWithPython(
+  name: string
+): Promise<{ stores: any[]; chainName: string | null } | null> {
+  try {
+    const response = await sendRequest({ op: 'match_merchant', name }, undefined, 1_000);
+    return response?.success ? { stores: response.stores, chainName: response.chain_name } : null;
+  } catch {
+    return null;
+  }
+}
+
+/**
+ * Look up a KRA eTIMS invoice through the pool (pooled connections, persistent
+ * invoice cache). Resolves with the raw response, or null when the pool is not running.
+ */
+export async function scrapeKRAWithPython(url: string): Promise<any | null> {
+  try {
+    return await sendRequest({ op: 'scrape_kra', url });
+  } catch (error) {
+    if (isNotListening(error)) return null;
+    throw error;
+  }
+}
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""One-shot receipt processing from the command line.
+
+The API route talks to the long-lived pool in receipt_processor.server; this
+wrapper runs the same pipeline once and is kept for local debugging. Image
+bytes are read from a file, or raw from stdin when the path is `-`.
+
+Usage: python3 processor-wrapper.py <image-path | ->
+"""
+import json
+import sys
+
+from receipt_processor import error_result, process_receipt
+
+
+def main() -> int:
+    if len(sys.argv) != 2:
+        print(json.dumps({'success': False, 'error': 'Usage: processor-wrapper.py <image-path | ->', 'error_type': 'invalid_request'}))
+        return 1
+
+    try:
+        if sys.argv[1] == '-':
+            image_bytes = sys.stdin.buffer.read()
+        else:
+            with open(sys.argv[1], 'rb') as handle:
+                image_bytes = handle.read()
+        result = process_receipt(image_bytes)
+    except Exception as exc:
+        result = error_result(exc)
+
+    print(json.dumps(result))
+    return 0 if result['success'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
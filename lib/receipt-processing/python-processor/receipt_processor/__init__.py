@@ -0,0 +1,10 @@
+"""
+Kacha server-side receipt processor.
+
+Python counterpart of lib/receipt-processing used by /api/receipts/process-python.
+"""
+
+from .errors import ProcessorError, error_result
+from .pipeline import process_receipt
+
+__all__ = ['ProcessorError', 'error_result', 'process_receipt']
@@ -0,0 +1,350 @@
+"""
+RAW RECEIPT BACKFILL
+
+Reprocesses `raw_receipts` through the Python processor: rows still in
+`processing_status = 'raw'` and rows last processed by an older
+PROCESSOR_VERSION (migration 035). Replaces polling
+SupabaseRawReceiptStorage.getUnprocessed ten rows at a time. Rows the
+TypeScript pipeline processed and Python never saw (processor_version NULL)
+are only selected with `--include-unversioned`: on the first run that is
+the whole historical corpus.
+
+Results are written to `raw_receipts` only (OCR text, QR data, hashes,
+versions and the parsed fields under receipt_metadata.python_processor).
+Linked `expense_items` rows are not changed.
+
+Rows are streamed in (created_at, id) order with keyset pagination, one short
+query per page, so the job never holds a long transaction or re-reads rows it
+has already passed. Images are downloaded and processed on the batch process
+pool (batch.py) with a bounded in-flight window, and results are written back
+in bulk: one UPDATE per `--flush-size` rows.
+
+Progress is checkpointed to a JSON file after every write. The checkpoint is
+the last row before which everything has been written back (results finish
+out of order), so a restarted job resumes there instead of from the start,
+and at worst reprocesses the rows that were in flight. A pass that runs to
+the end removes the checkpoint.
+
+With `--planned`, only rows the re-extraction planner (reextract.py) marked
+with `reextract_requested_at` are selected, not every row an older version
+produced. Writing a result back clears the mark.
+
+Line items are only extracted from full-page OCR, and the default tiers
+accept most receipts from the partial `roi` reading. `--full-page-ocr` skips
+that tier, so every reprocessed row gets `line_items` (at the cost of reading
+the whole page).
+
+Usage:
+    python3 -m receipt_processor.backfill [--workers 8] [--limit 10000]
+    python3 -m receipt_processor.backfill --planned
+    python3 -m receipt_processor.backfill --full-page-ocr   # with line items
+    python3 -m receipt_processor.backfill --reset   # ignore the checkpoint
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Iterator
+
+from .batch import iter_results
+from .db import connect
+from .ocr_tiers import DEFAULT_TIERS, TierStats
+from .snapshot import DEFAULT_SNAPSHOT_PATH
+from .version import PROCESSOR_VERSION
+
+PAGE_SIZE = 500
+DEFAULT_FLUSH_SIZE = 200
+DEFAULT_FLUSH_S = 10.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CHECKPOINT_PATH = os.path.join(tempfile.gettempdir(), 'kacha-backfill-checkpoint.json')
+
+# Unprocessed rows and every row an older processor version produced (plus,
+# opted in, every row Python never processed), or only those the
+# re-extraction planner marked
+_STALE = "processing_status = 'raw' OR processor_version <> %s"
+_UNVERSIONED = ' OR processor_version IS NULL'
+_PLANNED = 'reextract_requested_at IS NOT NULL'
+
+_START = ('-infinity', '00000000-0000-0000-0000-000000000000')
+
+_PAGE_SQL = """
+SELECT id::text, created_at::text, image_url,
+       CASE WHEN raw_qr_data->>'source' = 'mobile_mlkit' THEN raw_qr_data->>'url' END
+FROM raw_receipts
+WHERE (created_at, id) > (%s::timestamptz, %s::uuid)
+  AND ({selection})
+  AND COALESCE(processing_attempts, 0) < %s
+  AND image_url <> ''
+ORDER BY created_at, id
+LIMIT %s
+"""
+
+# Never downgrades a parsed/verified receipt; failed downloads only count an
+# attempt. A success resets the count, so the --max-attempts cap in _PAGE_SQL
+# limits failures in a row whatever the status, and later versions still
+# reprocess rows that succeeded before
+_WRITE_SQL = """
+UPDATE raw_receipts AS r
+SET processing_status = CASE
+      WHEN v.ok AND r.processing_status IN ('raw', 'failed') THEN 'parsed'
+      WHEN NOT v.ok AND r.processing_status = 'raw' THEN 'failed'
+      ELSE r.processing_status
+    END,
+    processing_attempts = CASE WHEN v.ok THEN 0 ELSE COALESCE(r.processing_attempts, 0) + 1 END,
+    last_processed_at = NOW(),
+    processor_version = CASE WHEN v.ok THEN %s ELSE r.processor_version END,
+    reextract_requested_at = CASE WHEN v.ok THEN NULL ELSE r.reextract_requested_at END,
+    raw_ocr_text = COALESCE(v.ocr_text, r.raw_ocr_text),
+    raw_qr_data = COALESCE(r.raw_qr_data, v.qr_data::jsonb),
+    perceptual_hash = COALESCE(v.perceptual_hash, r.perceptual_hash),
+    image_width = COALESCE(v.image_width, r.image_width),
+    image_height = COALESCE(v.image_height, r.image_height),
+    extraction_versions = COALESCE(v.versions::jsonb, r.extraction_versions),
+    receipt_metadata = COALESCE(r.receipt_metadata, '{}'::jsonb) || jsonb_build_object('python_processor', v.summary::jsonb)
+FROM unnest(%s::uuid[], %s::bool[], %s::text[], %s::text[], %s::text[], %s::int[], %s::int[], %s::text[], %s::text[])
+  AS v(id, ok, ocr_text, qr_data, perceptual_hash, image_width, image_height, summary, versions)
+WHERE r.id = v.id
+"""
+
+
+def iter_pending(
+    conn,
+    after: tuple[str, str] | None = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    limit: int | None = None,
+    planned: bool = False,
+    include_unversioned: bool = False,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[dict]:
+    """Yield backfill entries (`id`, `url`, `mobile_qr_url`, `key`) after the `after` key."""
+    selection = _PLANNED if planned else _STALE + (_UNVERSIONED if include_unversioned else '')
+    sql = _PAGE_SQL.format(selection=selection)
+    versions = () if planned else (PROCESSOR_VERSION,)
+    created_at, row_id = after or _START
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        rows = conn.execute(sql, (created_at, row_id, *versions, max_attempts, size)).fetchall()
+        # The last row's (created_at, id) is the next page's cursor
+        for row_id, created_at, image_url, mobile_qr_url in rows:
+            yield {'id': row_id, 'url': image_url, 'mobile_qr_url': mobile_qr_url, 'key': (created_at, row_id)}
+        if len(rows) < size:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def write_results(conn, results: list[dict]) -> None:
+    """Write a batch of processor results back to raw_receipts in one statement."""
+    columns: list[list] = [[] for _ in range(9)]
+    for result in results:
+        ok = bool(result.get('success'))
+        ocr_data = result.get('ocr_data') or {}
+        qr_data = result.get('qr_data')
+        if ok:
+            summary = {
+                'processor_version': PROCESSOR_VERSION,
+                'template_version': result.get('template_version'),
+                'status': result.get('status'),
+                'confidence': result.get('confidence'),
+                'parsed_data': result.get('parsed_data'),
+                'template_fields': result.get('template_fields'),
+                'line_items': result.get('line_items'),
+                'line_item_check': result.get('line_item_check'),
+                'warnings': result.get('warnings'),
+            }
+        else:
+            summary = {'processor_version': PROCESSOR_VERSION, 'error': result.get('error'), 'error_type': result.get('error_type')}
+        values = (
+            result['id'],
+            ok,
+            ocr_data.get('raw_text'),
+            json.dumps(qr_data) if qr_data else None,
+            result.get('perceptual_hash'),
+            result.get('image_width'),
+            result.get('image_height'),
+            json.dumps(summary),
+            json.dumps(result['versions']) if result.get('versions') else None,
+        )
+        for column, value in zip(columns, values):
+            column.append(value)
+    conn.execute(_WRITE_SQL, (PROCESSOR_VERSION, *columns))
+
+
+class Checkpoint:
+    """Low-water mark of the backfill, persisted atomically to a JSON file.
+
+    Entries are registered in fetch order; the mark only moves past an entry
+    once it and every entry before it have been written back.
+    """
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH, planned: bool = False, include_unversioned: bool = False):
+        self.path = path
+        self.job = f'processor-{PROCESSOR_VERSION}' + ('-planned' if planned else '-unversioned' if include_unversioned else '')
+        self._issued: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self._written: set[str] = set()
+
+    def load(self) -> tuple[str, str] | None:
+        """The key to resume after, or None to start from the beginning."""
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        # A new processor version or mode selects a different set of rows: start over
+        if state.get('job') != self.job:
+            return None
+        return tuple(state['after'])
+
+    def issue(self, entry: dict) -> dict:
+        self._issued[entry['id']] = entry['key']
+        return entry
+
+    def written(self, ids: list[str], counts: dict) -> None:
+        self._written.update(ids)
+        after = None
+        while self._issued:
+            row_id, key = next(iter(self._issued.items()))
+            if row_id not in self._written:
+                break
+            self._issued.popitem(last=False)
+            self._written.discard(row_id)
+            after = key
+        if after is not None:
+            self._save({'job': self.job, 'after': list(after), 'updated_at': time.time(), **counts})
+
+    def reset(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self, state: dict) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.backfill-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump(state, handle)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def run_backfill(
+    database_url: str | None = None,
+    checkpoint: Checkpoint | None = None,
+    workers: int | None = None,
+    max_in_flight: int | None = None,
+    flush_size: int = DEFAULT_FLUSH_SIZE,
+    flush_s: float = DEFAULT_FLUSH_S,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    limit: int | None = None,
+    planned: bool = False,
+    include_unversioned: bool = False,
+    full_page_ocr: bool = False,
+    cache_path: str | None = None,
+    templates_path: str | None = DEFAULT_SNAPSHOT_PATH,
+    ocr_tiers: str = DEFAULT_TIERS,
+) -> dict:
+    """Stream, process and write back pending rows. Returns the throughput summary."""
+    checkpoint = checkpoint or Checkpoint(planned=planned, include_unversioned=include_unversioned)
+    counts = {'processed': 0, 'succeeded': 0, 'failed': 0, 'writes': 0}
+    ocr_stats = TierStats()
+    start = time.perf_counter()
+
+    with connect(database_url) as conn:
+        conn.autocommit = True
+        buffer: list[dict] = []
+        flushed_at = time.monotonic()
+
+        def flush() -> None:
+            nonlocal flushed_at
+            if buffer:
+                write_results(conn, buffer)
+                counts['writes'] += 1
+                checkpoint.written([result['id'] for result in buffer], counts)
+                buffer.clear()
+            flushed_at = time.monotonic()
+
+        entries = (
+            checkpoint.issue({**entry, 'full_page_ocr': True} if full_page_ocr else entry)
+            for entry in iter_pending(
+                conn, checkpoint.load(), max_attempts=max_attempts, limit=limit,
+                planned=planned, include_unversioned=include_unversioned,
+            )
+        )
+        for result in iter_results(entries, workers, max_in_flight, cache_path, templates_path, ocr_tiers):
+            counts['processed'] += 1
+            if not result.get('cache_hit'):
+                ocr_stats.record(result.get('ocr_tiers'))
+            counts['succeeded' if result.get('success') else 'failed'] += 1
+            buffer.append(result)
+            if len(buffer) >= flush_size or time.monotonic() - flushed_at >= flush_s:
+                flush()
+        flush()
+
+    # A finished pass starts the next run from the beginning, so rows re-queued
+    # behind the checkpoint (reextract.py --apply) are picked up
+    if limit is None or counts['processed'] < limit:
+        checkpoint.reset()
+
+    elapsed = time.perf_counter() - start
+    return {
+        **counts,
+        'elapsed_s': round(elapsed, 3),
+        'receipts_per_sec': round(counts['processed'] / elapsed, 2) if elapsed > 0 else 0.0,
+        'ocr': ocr_stats.stats(),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Reprocess unprocessed and stale-version raw receipts')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Receipts queued at once (default: 4 per worker)')
+    parser.add_argument('--flush-size', type=int, default=DEFAULT_FLUSH_SIZE, help='Rows per bulk write')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help='Skip rows that failed this many times in a row')
+    parser.add_argument('--limit', type=int, default=None, help='Stop after this many rows')
+    parser.add_argument('--planned', action='store_true', help='Only rows re-queued by reextract.py, not every older version')
+    parser.add_argument('--include-unversioned', action='store_true',
+                        help='Also reprocess rows Python never processed (the whole pre-Python corpus)')
+    parser.add_argument('--full-page-ocr', action='store_true',
+                        help='Skip the partial roi tier so every row gets line items')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help='Checkpoint file (default: %(default)s)')
+    parser.add_argument('--reset', action='store_true', help='Ignore the checkpoint and start from the beginning')
+    parser.add_argument('--templates', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH))
+    parser.add_argument('--cache-path', default=None, help='Share the server result cache (skips already-processed images)')
+    parser.add_argument('--ocr-tiers', default=os.environ.get('PYTHON_PROCESSOR_OCR_TIERS', DEFAULT_TIERS),
+                        help='OCR engines, cheapest first (see ocr_tiers.py)')
+    args = parser.parse_args(argv)
+
+    checkpoint = Checkpoint(args.checkpoint, planned=args.planned, include_unversioned=args.include_unversioned)
+    if args.reset:
+        checkpoint.reset()
+
+    summary = run_backfill(
+        database_url=args.database_url,
+        checkpoint=checkpoint,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        flush_size=args.flush_size,
+        max_attempts=args.max_attempts,
+        limit=args.limit,
+        planned=args.planned,
+        include_unversioned=args.include_unversioned,
+        full_page_ocr=args.full_page_ocr,
+        cache_path=args.cache_path,
+        templates_path=args.templates,
+        ocr_tiers=args.ocr_tiers,
+    )
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
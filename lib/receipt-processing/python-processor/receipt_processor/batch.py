@@ -0,0 +1,253 @@
+"""
+BATCH RECEIPT PROCESSING
+
+Bulk entry point for backfills and paper-to-digital imports. Reads a manifest
+of images, runs each through the pipeline on a process pool sized to the
+machine, and streams one JSON line per receipt as soon as it finishes
+(completion order, not manifest order). A throughput summary is written to
+stderr at the end.
+
+Manifest: one entry per line, either a bare image path or a JSON object
+`{"id": "...", "path": "...", "mobile_qr_url": "..."}`. Entries may give a
+`url` instead of a `path` to download the image (backfill.py does), and
+`"full_page_ocr": true` to skip the partial `roi` tier so the result has line
+items; `--full-page-ocr` sets it on every entry.
+
+A malformed line gets an `invalid_request` result under its line number and
+the run carries on. A worker that dies (OOM kill, crash in a native library)
+breaks the pool: it is replaced and the entries that were in flight are
+re-run one at a time; one that crashes again is reported as `worker_crashed`.
+
+Usage:
+    python3 -m receipt_processor.batch manifest.jsonl [--workers 8] [--output results.jsonl]
+    python3 -m receipt_processor.batch manifest.jsonl --full-page-ocr   # with line items
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import IO, Iterable, Iterator
+
+from .cache import DEFAULT_MAX_BYTES
+from .errors import ProcessorError, error_result
+from .ocr_tiers import DEFAULT_TIERS, TierStats
+from .snapshot import DEFAULT_SNAPSHOT_PATH
+from .worker import init_worker, process_image
+
+DOWNLOAD_TIMEOUT_S = 30
+
+
+def read_manifest(lines: Iterable[str]) -> Iterator[dict]:
+    """Yield `{id, path, ...}` entries from manifest lines, skipping blanks and comments."""
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if not line.startswith('{'):
+            yield {'id': line, 'path': line}
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError as exc:
+            entry = {'invalid': f'Manifest line {line_number} is not valid JSON: {exc}'}
+        entry.setdefault('id', entry.get('path') or str(line_number))
+        yield entry
+
+
+def process_entry(entry: dict) -> dict:
+    """Process one manifest entry (`path` or `url`) inside a worker. Never raises."""
+    try:
+        if entry.get('invalid'):
+            raise ProcessorError('invalid_request', entry['invalid'])
+        if entry.get('url'):
+            image_bytes = download_image(entry['url'])
+        else:
+            with open(entry['path'], 'rb') as handle:
+                image_bytes = handle.read()
+        result = process_image(
+            image_bytes, mobile_qr_url=entry.get('mobile_qr_url'), full_page_ocr=bool(entry.get('full_page_ocr')),
+        )
+    except Exception as exc:
+        result = error_result(exc)
+    return {'id': entry['id'], 'path': entry.get('path'), **result}
+
+
+def iter_results(
+    entries: Iterable[dict],
+    workers: int | None = None,
+    max_in_flight: int | None = None,
+    cache_path: str | None = None,
+    templates_path: str | None = DEFAULT_SNAPSHOT_PATH,
+    ocr_tiers: str = DEFAULT_TIERS,
+) -> Iterator[dict]:
+    """Process entries on a pool, yielding each result as soon as it finishes.
+
+    At most `max_in_flight` entries are queued at once so huge manifests do not
+    build an unbounded backlog of futures; the next entry is only pulled from
+    `entries` when a slot frees up. Invalid manifest lines are answered here
+    without a worker.
+
+    A worker that dies fails every future on the pool. The pool is replaced and
+    the entries it took down are re-run one at a time, so only the entry that
+    crashes again is reported as `worker_crashed`.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+
+    def start_pool() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(cache_path, DEFAULT_MAX_BYTES, templates_path, ocr_tiers),
+        )
+
+    executor = start_pool()
+    try:
+        pending: dict = {}  # future -> (entry, whether it is a crash retry)
+        retries: deque[dict] = deque()
+        entries = iter(entries)
+        exhausted = False
+
+        while pending or retries or not exhausted:
+            if retries and not pending:
+                entry = retries.popleft()
+                pending[executor.submit(process_entry, entry)] = (entry, True)
+            while not retries and not exhausted and len(pending) < max_in_flight:
+                entry = next(entries, None)
+                if entry is None:
+                    exhausted = True
+                elif entry.get('invalid'):
+                    yield process_entry(entry)
+                else:
+                    pending[executor.submit(process_entry, entry)] = (entry, False)
+
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            crashed = []
+            for future in done:
+                entry, retried = pending.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    crashed.append((entry, retried))
+            if not crashed:
+                continue
+
+            # Every other future on the broken pool fails as well
+            for future in wait(pending)[0]:
+                entry, retried = pending.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    crashed.append((entry, retried))
+            executor.shutdown(wait=False)
+            executor = start_pool()
+            for entry, retried in crashed:
+                if retried:
+                    error = ProcessorError('worker_crashed', 'Processor worker exited unexpectedly')
+                    yield {'id': entry['id'], 'path': entry.get('path'), **error_result(error)}
+                else:
+                    retries.append(entry)
+    finally:
+        executor.shutdown()
+
+
+def download_image(url: str) -> bytes:
+    """Fetch a stored receipt image, authenticating to Supabase Storage when a service key is set."""
+    headers = {}
+    service_key = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
+    if service_key:
+        headers = {'Authorization': f'Bearer {service_key}', 'apikey': service_key}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT_S) as response:
+            return response.read()
+    except (OSError, ValueError) as exc:
+        raise ProcessorError('image_unavailable', f'Could not download {url}: {exc}') from exc
+
+
+def run_batch(
+    entries: Iterable[dict],
+    output: IO[str],
+    workers: int | None = None,
+    max_in_flight: int | None = None,
+    cache_path: str | None = None,
+    templates_path: str | None = DEFAULT_SNAPSHOT_PATH,
+    ocr_tiers: str = DEFAULT_TIERS,
+) -> dict:
+    """Process entries on a pool, writing JSON lines to `output` as they finish.
+
+    Returns the throughput summary.
+    """
+    workers = workers or os.cpu_count() or 1
+    total = succeeded = 0
+    ocr_stats = TierStats()
+    start = time.perf_counter()
+
+    for result in iter_results(entries, workers, max_in_flight, cache_path, templates_path, ocr_tiers):
+        total += 1
+        succeeded += bool(result.get('success'))
+        if not result.get('cache_hit'):
+            ocr_stats.record(result.get('ocr_tiers'))
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'total': total,
+        'succeeded': succeeded,
+        'failed': total - succeeded,
+        'workers': workers,
+        'elapsed_s': round(elapsed, 3),
+        'receipts_per_sec': round(total / elapsed, 2) if elapsed > 0 else 0.0,
+        'ocr': ocr_stats.stats(),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Process a manifest of receipt images')
+    parser.add_argument('manifest', help='Manifest file, or - for stdin')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--output', default='-', help='JSON-lines output file (default: stdout)')
+    parser.add_argument('--templates', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH))
+    parser.add_argument('--cache-path', default=None, help='Share the server result cache (skips already-processed images)')
+    parser.add_argument('--ocr-tiers', default=os.environ.get('PYTHON_PROCESSOR_OCR_TIERS', DEFAULT_TIERS),
+                        help='OCR engines, cheapest first (see ocr_tiers.py)')
+    parser.add_argument('--full-page-ocr', action='store_true',
+                        help='Skip the partial roi tier so every result has line items')
+    args = parser.parse_args(argv)
+
+    manifest = sys.stdin if args.manifest == '-' else open(args.manifest, encoding='utf-8')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        entries = read_manifest(manifest)
+        if args.full_page_ocr:
+            entries = ({**entry, 'full_page_ocr': True} for entry in entries)
+        summary = run_batch(
+            entries,
+            output,
+            workers=args.workers,
+            cache_path=args.cache_path,
+            templates_path=args.templates,
+            ocr_tiers=args.ocr_tiers,
+        )
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+RESULT CACHE
+
+On-disk, size-bounded LRU of processing results keyed by image SHA-256.
+Re-uploads of the same photo return the stored extraction without touching
+QR or OCR.
+
+Backed by SQLite (WAL) so every worker process in the pool shares one cache
+and one set of hit/miss counters. Entries are scoped to a namespace (derived
+from the processor and template snapshot versions); lookups ignore entries
+from other namespaces and `purge_stale()` deletes them, so a version bump or
+a new template snapshot invalidates the cache. `clear()` (or the server's
+`invalidate_cache` op) drops everything.
+
+BlobCache is the same LRU for raw bytes (image derivatives, image_service.py).
+
+Usage:
+    python3 -m receipt_processor.cache            # print hit/miss counters and size
+    python3 -m receipt_processor.cache --clear
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'kacha-receipt-cache.sqlite3')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total_bytes INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    evictions INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO meta (id) VALUES (1);
+"""
+
+
+class ResultCache:
+    """Shared LRU cache of JSON results, bounded by total stored bytes."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES, namespace: str = ''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def get(self, key: str) -> dict | None:
+        """Return the cached result for `key`, counting a hit or a miss."""
+        row = self._conn.execute(
+            'SELECT value FROM results WHERE key = ? AND namespace = ?',
+            (key, self.namespace),
+        ).fetchone()
+
+        with self._transaction():
+            if row is None:
+                self._conn.execute('UPDATE meta SET misses = misses + 1 WHERE id = 1')
+                return None
+            self._conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.execute('UPDATE meta SET hits = hits + 1 WHERE id = 1')
+        return self._decode(row[0])
+
+    def put(self, key: str, result: dict) -> None:
+        """Store a result, evicting least-recently-used entries over the size bound."""
+        value = self._encode(result)
+        size = len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._transaction():
+            old = self._conn.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, namespace, value, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, self.namespace, value, size, time.time()),
+            )
+            self._conn.execute(
+                'UPDATE meta SET total_bytes = total_bytes + ? WHERE id = 1',
+                (size - (old[0] if old else 0),),
+            )
+            self._evict()
+
+    def _encode(self, result: dict) -> str:
+        return json.dumps(result, separators=(',', ':'))
+
+    def _decode(self, value: str) -> dict:
+        return json.loads(value)
+
+    def purge_stale(self) -> int:
+        """Delete entries written under any other namespace. Returns rows removed."""
+        with self._transaction():
+            freed, count = self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM results WHERE namespace != ?',
+                (self.namespace,),
+            ).fetchone()
+            self._conn.execute('DELETE FROM results WHERE namespace != ?', (self.namespace,))
+            self._conn.execute('UPDATE meta SET total_bytes = total_bytes - ? WHERE id = 1', (freed,))
+        return count
+
+    def clear(self) -> None:
+        """Drop every entry and reset the counters."""
+        with self._transaction():
+            self._conn.execute('DELETE FROM results')
+            self._conn.execute('UPDATE meta SET total_bytes = 0, hits = 0, misses = 0, evictions = 0 WHERE id = 1')
+
+    def stats(self) -> dict:
+        total_bytes, hits, misses, evictions = self._conn.execute(
+            'SELECT total_bytes, hits, misses, evictions FROM meta WHERE id = 1'
+        ).fetchone()
+        (entries,) = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()
+        lookups = hits + misses
+        return {
+            'entries': entries,
+            'total_bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _evict(self) -> None:
+        (total,) = self._conn.execute('SELECT total_bytes FROM meta WHERE id = 1').fetchone()
+        while total > self.max_bytes:
+            victims = self._conn.execute(
+                'SELECT key, size FROM results ORDER BY last_access LIMIT 64'
+            ).fetchall()
+            if not victims:
+                break
+            for key, size in victims:
+                self._conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+                self._conn.execute(
+                    'UPDATE meta SET total_bytes = total_bytes - ?, evictions = evictions + 1 WHERE id = 1',
+                    (size,),
+                )
+                if total <= self.max_bytes:
+                    break
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, so concurrent workers serialise their writes."""
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+
+class BlobCache(ResultCache):
+    """ResultCache of raw bytes, stored as SQLite blobs."""
+
+    def _encode(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def _decode(self, value: bytes) -> bytes:
+        return value
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Inspect or clear the receipt result cache')
+    parser.add_argument('--path', default=os.environ.get('PYTHON_PROCESSOR_CACHE_PATH', DEFAULT_CACHE_PATH))
+    parser.add_argument('--clear', action='store_true', help='Delete every cached result')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.path)
+    if args.clear:
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
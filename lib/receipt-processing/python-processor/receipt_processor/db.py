@@ -0,0 +1,28 @@
+"""
+Postgres access for the bulk jobs.
+
+Only background work connects: offline jobs (dedupe, backfills), the KRA
+verification queue, and the socket server's store directory refresh. All use
+the Supabase connection string in DATABASE_URL; request handling never
+touches the database.
+"""
+
+import os
+
+from .errors import ProcessorError
+
+try:
+    import psycopg
+except ImportError:  # only the database-backed jobs need psycopg
+    psycopg = None
+
+
+def connect(database_url: str | None = None):
+    """Open a psycopg connection to `database_url` (default: $DATABASE_URL)."""
+    if psycopg is None:
+        raise ProcessorError('dependency_missing', 'psycopg is required for database jobs (pip install "psycopg[binary]")')
+
+    database_url = database_url or os.environ.get('DATABASE_URL')
+    if not database_url:
+        raise ProcessorError('invalid_request', 'No database URL: pass --database-url or set DATABASE_URL')
+    return psycopg.connect(database_url)
@@ -0,0 +1,137 @@
+"""
+BULK NEAR-DUPLICATE DETECTION
+
+Groups receipts whose perceptual hashes are within `--radius` bits of each
+other, per owner. Each row is looked up in a DuplicateIndex before being
+added, so the job is one index probe per receipt instead of an all-pairs
+comparison. Groups are written as JSON lines:
+`{"scope": ..., "ids": [...], "max_distance": N}`.
+
+Input is either the `raw_receipts` table (rows with `perceptual_hash` set,
+scoped by `user_email`) or JSON lines with `id`, `perceptual_hash` and an
+optional `scope` — batch.py output qualifies.
+
+Usage:
+    python3 -m receipt_processor.dedupe --database-url "$DATABASE_URL" [--radius 6]
+    python3 -m receipt_processor.dedupe results.jsonl --output duplicates.jsonl
+"""
+
+import argparse
+import json
+import sys
+import time
+from typing import IO, Iterable, Iterator
+
+from .db import connect
+from .phash import DEFAULT_RADIUS, DuplicateIndex, parse_hash
+
+FETCH_SIZE = 10_000
+
+
+def read_rows(lines: Iterable[str]) -> Iterator[tuple[str, str, str | None]]:
+    """Yield `(id, perceptual_hash, scope)` from JSON lines, skipping rows without a hash."""
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        if entry.get('perceptual_hash'):
+            yield str(entry['id']), entry['perceptual_hash'], entry.get('scope')
+
+
+def fetch_rows(database_url: str | None = None) -> Iterator[tuple[str, str, str | None]]:
+    """Stream `(id, perceptual_hash, user_email)` from raw_receipts with a server-side cursor."""
+    with connect(database_url) as conn:
+        with conn.cursor(name='dedupe_raw_receipts') as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(
+                'SELECT id::text, perceptual_hash, user_email FROM raw_receipts '
+                'WHERE perceptual_hash IS NOT NULL ORDER BY created_at'
+            )
+            yield from cursor
+
+
+def find_duplicate_groups(
+    rows: Iterable[tuple[str, str, str | None]],
+    radius: int = DEFAULT_RADIUS,
+) -> tuple[list[dict], int]:
+    """Cluster rows into near-duplicate groups. Returns (groups, rows_scanned)."""
+    index = DuplicateIndex()
+    parent: dict[str, str] = {}
+    edges: list[tuple[str, int]] = []
+    scopes: dict[str, str | None] = {}
+
+    def find(key: str) -> str:
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    scanned = 0
+    for row_id, text, scope in rows:
+        value = parse_hash(text)
+        scanned += 1
+        parent.setdefault(row_id, row_id)
+        scopes[row_id] = scope
+        for match_id, distance in index.query(value, radius=radius, scope=scope):
+            parent[find(row_id)] = find(match_id)
+            edges.append((row_id, distance))
+        index.add(row_id, value, scope)
+
+    members: dict[str, list[str]] = {}
+    for row_id in parent:
+        members.setdefault(find(row_id), []).append(row_id)
+    max_distance: dict[str, int] = {}
+    for row_id, distance in edges:
+        root = find(row_id)
+        max_distance[root] = max(max_distance.get(root, 0), distance)
+
+    groups = [
+        {'scope': scopes[root], 'ids': ids, 'max_distance': max_distance.get(root, 0)}
+        for root, ids in members.items()
+        if len(ids) > 1
+    ]
+    return groups, scanned
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Find near-duplicate receipts by perceptual hash')
+    parser.add_argument('input', nargs='?', help='JSON-lines file (or -) instead of the database')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    parser.add_argument('--radius', type=int, default=DEFAULT_RADIUS, help='Max differing bits (default: %(default)s)')
+    parser.add_argument('--output', default='-', help='JSON-lines output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    source: IO[str] | None = None
+    if args.input:
+        source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+        rows = read_rows(source)
+    else:
+        rows = fetch_rows(args.database_url)
+
+    try:
+        groups, scanned = find_duplicate_groups(rows, radius=args.radius)
+    finally:
+        if source is not None and source is not sys.stdin:
+            source.close()
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        for group in groups:
+            output.write(json.dumps(group) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    summary = {
+        'scanned': scanned,
+        'groups': len(groups),
+        'duplicates': sum(len(group['ids']) - 1 for group in groups),
+        'elapsed_s': round(time.perf_counter() - start, 3),
+    }
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+STORAGE DERIVATIVES
+
+Storage-optimised copies of a receipt photo, made before upload. The upload
+routes store the original 3-8 MB camera JPEG in the `receipts` bucket, and
+report pages download it just to show a thumbnail. From one decoded image
+this makes:
+
+- `storage`: long edge bounded to STORAGE_LONG_EDGE, EXIF orientation applied
+  (and EXIF, including GPS, dropped), grayscale when the photo has no real
+  colour (most thermal receipts), WebP (JPEG when Pillow lacks WebP).
+  Still legible for OCR and review, at a small fraction of the upload size.
+- `thumbnail`: long edge THUMBNAIL_LONG_EDGE, for report and list pages,
+  resized from the storage copy rather than the full-size image.
+
+The original is only worth keeping where OCR may have to run again on full
+resolution: `needs_original` is True unless the receipt carries an eTIMS QR
+(KRA is authoritative) or extraction succeeded.
+
+Inside the pipeline (`process` requests with `"derivatives": true`) the
+image the pipeline already decoded is reused. Standalone, JPEGs are decoded
+at reduced scale (libjpeg DCT scaling) since only the derivatives are needed.
+Files are written to DEFAULT_DERIVATIVES_DIR as `<sha256>-storage.webp` and
+`<sha256>-thumbnail.webp`; the caller uploads and deletes them. Files a
+caller never collected are removed by `expire_derivatives` once they are
+DEFAULT_MAX_AGE_S old (the server sweeps the directory in the background).
+
+Usage:
+    python3 -m receipt_processor.derivatives photo.jpg [--output-dir DIR]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .errors import ProcessorError
+from .imaging import Image, load_image
+
+try:
+    from PIL import ImageStat, features
+except ImportError:  # derivatives are only made once Pillow decodes the image
+    ImageStat = None
+    features = None
+
+STORAGE_LONG_EDGE = 2048
+STORAGE_QUALITY = 80
+THUMBNAIL_LONG_EDGE = 320
+THUMBNAIL_QUALITY = 70
+GRAYSCALE_MAX_SATURATION = 24  # mean HSV saturation (0-255) below which a photo is stored as grayscale
+DEFAULT_DERIVATIVES_DIR = os.path.join(tempfile.gettempdir(), 'kacha-receipt-derivatives')
+DEFAULT_MAX_AGE_S = 3600  # uploads finish in seconds; anything older was abandoned
+
+CONTENT_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+
+def output_format() -> str:
+    return 'WEBP' if features is not None and features.check('webp') else 'JPEG'
+
+
+def load_scaled(image_bytes: bytes, long_edge: int = STORAGE_LONG_EDGE):
+    """Decode for derivatives only: JPEGs are decoded at the smallest DCT scale still >= `long_edge`."""
+    return load_image(image_bytes, min_long_edge=long_edge)
+
+
+def is_grayscale(image) -> bool:
+    """True when a (small) RGB image has almost no colour saturation."""
+    saturation = ImageStat.Stat(image.convert('HSV').getchannel('S')).mean[0]
+    return saturation < GRAYSCALE_MAX_SATURATION
+
+
+def drop_colour(image) -> tuple:
+    """`(image, grayscale)`: a single-channel copy when a box-reduced probe shows no real colour."""
+    if not is_grayscale(image.reduce(max(max(image.size) // THUMBNAIL_LONG_EDGE, 1))):
+        return image, False
+    return image.convert('L'), True
+
+
+def bounded(image, long_edge: int):
+    """`image` resized so its long edge is at most `long_edge` (the image itself when already small)."""
+    scale = long_edge / max(image.size)
+    if scale >= 1:
+        return image
+    size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def encode(image, quality: int, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffer, 'WEBP', quality=quality, method=2)  # method 4+ doubles encode time for ~1% smaller files
+    else:
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def make_derivatives(image, original_bytes: int | None = None) -> dict:
+    """Storage copy and thumbnail of a decoded RGB image, as `{name: (bytes, info)}`."""
+    image_format = output_format()
+    # Decided before resizing, so grayscale photos are resized as one channel
+    image, grayscale = drop_colour(image)
+    storage = bounded(image, STORAGE_LONG_EDGE)
+    thumbnail = bounded(storage, THUMBNAIL_LONG_EDGE)
+
+    derivatives = {}
+    for name, derived, quality in (('storage', storage, STORAGE_QUALITY), ('thumbnail', thumbnail, THUMBNAIL_QUALITY)):
+        data = encode(derived, quality, image_format)
+        derivatives[name] = (data, {
+            'content_type': CONTENT_TYPES[image_format],
+            'width': derived.width,
+            'height': derived.height,
+            'bytes': len(data),
+            'grayscale': grayscale,
+        })
+    if original_bytes:
+        for _, info in derivatives.values():
+            info['ratio'] = round(info['bytes'] / original_bytes, 4)
+    return derivatives
+
+
+def write_derivatives(derivatives: dict, image_hash: str, output_dir: str = DEFAULT_DERIVATIVES_DIR) -> dict:
+    """Atomically write derivatives as `<image_hash>-<name>.<ext>`; returns their info with `path` added."""
+    os.makedirs(output_dir, exist_ok=True)
+    written = {}
+    for name, (data, info) in derivatives.items():
+        extension = info['content_type'].rsplit('/', 1)[1]
+        path = os.path.join(output_dir, f'{image_hash}-{name}.{extension}')
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix='.derivative-')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                handle.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        written[name] = {**info, 'path': path}
+    return written
+
+
+def expire_derivatives(
+    output_dir: str = DEFAULT_DERIVATIVES_DIR,
+    max_age_s: float = DEFAULT_MAX_AGE_S,
+    now: float | None = None,
+) -> int:
+    """Delete derivative (and leftover temp) files older than `max_age_s`. Returns files removed."""
+    cutoff = (now if now is not None else time.time()) - max_age_s
+    removed = 0
+    try:
+        entries = list(os.scandir(output_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:  # the caller deleted it first
+            continue
+    return removed
+
+
+def needs_original(result: dict) -> bool:
+    """Whether the full-resolution upload should be kept for this processing result."""
+    qr_data = result.get('qr_data') or {}
+    return not qr_data.get('is_etims_qr') and result.get('status') != 'success'
+
+
+def derive(image, image_bytes: bytes, image_hash: str | None = None, output_dir: str = DEFAULT_DERIVATIVES_DIR) -> dict:
+    """Make and write the derivatives of an already-decoded image."""
+    if ImageStat is None:
+        raise ProcessorError('dependency_missing', 'Pillow is required to make image derivatives')
+    image_hash = image_hash or hashlib.sha256(image_bytes).hexdigest()
+    return write_derivatives(make_derivatives(image, len(image_bytes)), image_hash, output_dir)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Make storage and thumbnail derivatives of receipt photos')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--output-dir', default=DEFAULT_DERIVATIVES_DIR)
+    args = parser.parse_args(argv)
+
+    for path in args.images:
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        written = derive(load_scaled(data), data, output_dir=args.output_dir)
+        print(json.dumps({'path': path, 'original_bytes': len(data), 'derivatives': written}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
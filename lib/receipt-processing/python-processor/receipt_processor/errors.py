@@ -0,0 +1,23 @@
+"""
+Processor errors.
+
+Every failure that should reach the API route is raised as a ProcessorError so
+the route can surface `error` and `error_type` without parsing tracebacks.
+"""
+
+
+class ProcessorError(Exception):
+    """A processing failure with a machine-readable error type."""
+
+    def __init__(self, error_type: str, message: str):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+def error_result(exc: BaseException) -> dict:
+    """Convert an exception into the `{success: False}` result the route expects."""
+    return {
+        'success': False,
+        'error': str(exc) or exc.__class__.__name__,
+        'error_type': getattr(exc, 'error_type', exc.__class__.__name__),
+    }
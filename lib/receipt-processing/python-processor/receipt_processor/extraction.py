@@ -0,0 +1,332 @@
+"""
+TEMPLATE EXTRACTION ENGINE
+
+Compiled counterpart of ReceiptProcessor.applyTemplate in orchestrator.ts.
+The TypeScript version loops templates -> fields -> patterns and runs every
+regex against the full OCR text. Here all templates are compiled once:
+
+- Identical patterns shared by several templates (TOTAL, Receipt #, ...) are
+  compiled and run once per text, no matter how many templates use them.
+- Every pattern is indexed by a literal it cannot match without (taken from
+  the parsed regex, e.g. "invoice" or any of "product"/"fuel"). One
+  case-folded copy of the text is checked for each distinct literal, and
+  only patterns whose literal is present are searched. A new vendor
+  template mostly adds literals that are absent from other vendors'
+  receipts, so its patterns cost a substring check rather than a regex scan.
+- Pattern results are computed lazily and shared, so one scan serves every
+  template (`extract_all`).
+- Regexes are compiled on first use, so patterns whose literal never shows
+  up are never compiled. An engine can be saved as a snapshot and loaded
+  without re-analysing any pattern (snapshot.py).
+
+Field resolution is unchanged: QR keys first, then the KRA field, then the
+field's OCR patterns in order (first match, group 1), then the transform.
+"""
+
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from urllib.parse import parse_qsl, urlsplit
+
+from .templates import DEFAULT_TEMPLATES, TRANSFORMS, ReceiptTemplate
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+_REPEATS = tuple(
+    getattr(sre_constants, name)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name)
+)
+
+
+@dataclass
+class CompiledField:
+    name: str
+    qr_keys: list[str]
+    kra_field: str | None
+    pattern_ids: list[int]  # indexes into TemplateEngine.sources, in priority order
+    transform: object
+
+
+class TextScan:
+    """Lazily evaluated pattern results for one OCR text."""
+
+    def __init__(self, engine: 'TemplateEngine', text: str):
+        self.engine = engine
+        self.text = text
+        self._folded = text.casefold()
+        self._literals: dict[str, bool] = {}
+        self._values: dict[int, str | None] = {}
+        self.searches = 0
+
+    def value(self, pattern_id: int) -> str | None:
+        """Group 1 of the pattern's first match, or None."""
+        if pattern_id not in self._values:
+            self._values[pattern_id] = self._search(pattern_id)
+        return self._values[pattern_id]
+
+    def _search(self, pattern_id: int) -> str | None:
+        literals = self.engine.literals[pattern_id]
+        if literals and not any(self._has_literal(literal) for literal in literals):
+            return None
+        self.searches += 1
+        match = self.engine.pattern(pattern_id).search(self.text)
+        if not match or match.lastindex is None:
+            return None
+        return match.group(1) or None
+
+    def _has_literal(self, literal: str) -> bool:
+        if literal not in self._literals:
+            self._literals[literal] = literal in self._folded
+        return self._literals[literal]
+
+
+class TemplateEngine:
+    """All templates' extraction rules, compiled once.
+
+    `version` fingerprints the rules, so results (and cache entries) can be
+    tied to the templates that produced them.
+    """
+
+    def __init__(self, templates: list[ReceiptTemplate] = DEFAULT_TEMPLATES):
+        self.sources: list[tuple[str, int]] = []
+        self.literals: list[tuple[str, ...]] = []
+        self.templates: dict[str, list[CompiledField]] = {}
+        self.confidence_thresholds: dict[str, int] = {}
+        self.required_fields: dict[str, list[str]] = {}
+        self.amount_tolerances: dict[str, float] = {}
+        pattern_ids: dict[tuple[str, int], int] = {}
+
+        for template in templates:
+            if not template.active:
+                continue
+            fields = []
+            for name, extractor in template.fields.items():
+                ids = []
+                for source, flags in extractor.ocr_patterns:
+                    key = (source, flags)
+                    if key not in pattern_ids:
+                        re.compile(source, flags)  # reject invalid patterns up front
+                        pattern_ids[key] = len(self.sources)
+                        self.sources.append(key)
+                        self.literals.append(required_literals(source, flags))
+                    ids.append(pattern_ids[key])
+                fields.append(CompiledField(name, extractor.qr_keys, extractor.kra_field, ids, extractor.transform))
+            self.templates[template.id] = fields
+            if template.confidence_threshold is not None:
+                self.confidence_thresholds[template.id] = template.confidence_threshold
+            if template.amount_tolerance is not None:
+                self.amount_tolerances[template.id] = template.amount_tolerance
+            # Required fields OCR can supply: the miss test for region-of-interest OCR
+            self.required_fields[template.id] = [
+                name
+                for name, extractor in template.fields.items()
+                if extractor.ocr_patterns
+                and (extractor.required or template.receipt_type in extractor.required_for)
+            ]
+
+        self._compiled: list[re.Pattern | None] = [None] * len(self.sources)
+        self._template_versions: dict[str, str] | None = None
+        self.version = _fingerprint(self._rules())
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> 'TemplateEngine':
+        """Rebuild an engine from `to_snapshot()` output without re-analysing patterns."""
+        engine = cls.__new__(cls)
+        engine.sources = [(source, flags) for source, flags, _ in snapshot['patterns']]
+        engine.literals = [tuple(literals) for _, _, literals in snapshot['patterns']]
+        engine.templates = {
+            template_id: [
+                CompiledField(name, qr_keys, kra_field, pattern_ids, TRANSFORMS[transform] if transform else None)
+                for name, qr_keys, kra_field, pattern_ids, transform in fields
+            ]
+            for template_id, fields in snapshot['templates'].items()
+        }
+        engine.confidence_thresholds = dict(snapshot.get('confidence_thresholds', {}))
+        engine.required_fields = dict(snapshot.get('required_fields', {}))
+        engine.amount_tolerances = dict(snapshot.get('amount_tolerances', {}))
+        engine._compiled = [None] * len(engine.sources)
+        engine._template_versions = None
+        engine.version = snapshot['version']
+        return engine
+
+    def to_snapshot(self) -> dict:
+        """JSON-serialisable form of the compiled rules.
+
+        Confidence thresholds, required fields and amount tolerances only
+        decide OCR escalation and line-item checks, not what a template
+        extracts, so they are not part of the version fingerprint.
+        """
+        return {
+            'version': self.version,
+            'confidence_thresholds': self.confidence_thresholds,
+            'required_fields': self.required_fields,
+            'amount_tolerances': self.amount_tolerances,
+            **self._rules(),
+        }
+
+    def template_versions(self) -> dict[str, str]:
+        """Per-template fingerprints: editing one template only changes its own version.
+
+        Patterns are fingerprinted by source, not by id, since ids shift when
+        other templates change.
+        """
+        if self._template_versions is None:
+            rules = self._rules()
+            self._template_versions = {
+                template_id: _fingerprint([
+                    [name, qr_keys, kra_field, [self.sources[pattern_id] for pattern_id in pattern_ids], transform]
+                    for name, qr_keys, kra_field, pattern_ids, transform in fields
+                ])
+                for template_id, fields in rules['templates'].items()
+            }
+        return self._template_versions
+
+    def pattern(self, pattern_id: int) -> re.Pattern:
+        compiled = self._compiled[pattern_id]
+        if compiled is None:
+            compiled = self._compiled[pattern_id] = re.compile(*self.sources[pattern_id])
+        return compiled
+
+    def _rules(self) -> dict:
+        transform_names = {function: name for name, function in TRANSFORMS.items()}
+        templates = {}
+        for template_id, fields in self.templates.items():
+            templates[template_id] = []
+            for compiled in fields:
+                if compiled.transform is not None and compiled.transform not in transform_names:
+                    raise ValueError(f'{template_id}.{compiled.name}: transform is not registered in TRANSFORMS')
+                templates[template_id].append([
+                    compiled.name,
+                    compiled.qr_keys,
+                    compiled.kra_field,
+                    compiled.pattern_ids,
+                    transform_names.get(compiled.transform),
+                ])
+        return {
+            'patterns': [[source, flags, list(literals)] for (source, flags), literals in zip(self.sources, self.literals)],
+            'templates': templates,
+        }
+
+    def scan(self, text: str) -> TextScan:
+        return TextScan(self, text or '')
+
+    def extract(
+        self,
+        template_id: str,
+        ocr_text: str | None = None,
+        qr_data: dict | None = None,
+        kra_data: dict | None = None,
+        scan: TextScan | None = None,
+    ) -> dict:
+        """Apply one template (applyTemplate semantics). Unknown ids raise KeyError."""
+        scan = scan or self.scan(ocr_text)
+        result = {}
+        for compiled in self.templates[template_id]:
+            value = None
+            if qr_data:
+                value = next((qr_data[key] for key in compiled.qr_keys if qr_data.get(key)), None)
+            if not value and compiled.kra_field and kra_data:
+                value = kra_data.get(compiled.kra_field)
+            if not value and scan.text:
+                value = next(
+                    (found for found in map(scan.value, compiled.pattern_ids) if found),
+                    None,
+                )
+            if value and compiled.transform:
+                value = compiled.transform(value)
+            if value:
+                result[compiled.name] = value
+        return result
+
+    def extract_all(
+        self,
+        ocr_text: str | None = None,
+        qr_data: dict | None = None,
+        kra_data: dict | None = None,
+    ) -> dict[str, dict]:
+        """Apply every active template over a single shared scan of the text."""
+        scan = self.scan(ocr_text)
+        return {
+            template_id: self.extract(template_id, qr_data=qr_data, kra_data=kra_data, scan=scan)
+            for template_id in self.templates
+        }
+
+
+def _fingerprint(rules: dict | list) -> str:
+    encoded = json.dumps(rules, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+
+def qr_payload(raw_text: str | None) -> dict:
+    """Raw QR key/value payload (the object `qrKeys` refer to), or {}."""
+    if not raw_text:
+        return {}
+    try:
+        data = json.loads(raw_text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return data
+
+    if raw_text.startswith(('http://', 'https://')):
+        return dict(parse_qsl(urlsplit(raw_text).query))
+
+    payload = {}
+    for pair in re.split(r'[,;|]', raw_text):
+        key, sep, value = pair.partition('=')
+        if sep and key.strip() and value.strip():
+            payload[key.strip()] = value.strip()
+    return payload
+
+
+def required_literals(source: str, flags: int = 0) -> tuple[str, ...]:
+    """Case-folded literals of which at least one occurs in every match.
+
+    Returns () when no literal is required (the pattern always runs).
+    """
+    try:
+        parsed = sre_parse.parse(source, flags)
+    except re.error:
+        return ()
+    return _best(_candidates(list(parsed))) or ()
+
+
+def _candidates(items) -> list[tuple[str, ...]]:
+    """Every literal alternative set required by a parsed sequence."""
+    candidates = []
+    run: list[str] = []
+
+    def flush():
+        if run:
+            candidates.append((''.join(run).casefold(),))
+            run.clear()
+
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        if op is sre_constants.SUBPATTERN:
+            candidates.extend(_candidates(av[-1]))
+        elif op in _REPEATS and av[0] >= 1:
+            candidates.extend(_candidates(av[2]))
+        elif op is sre_constants.BRANCH:
+            branches = [_best(_candidates(branch)) for branch in av[1]]
+            if all(branches):
+                candidates.append(tuple(sorted({literal for branch in branches for literal in branch})))
+    flush()
+    return candidates
+
+
+def _best(candidates: list[tuple[str, ...]]) -> tuple[str, ...] | None:
+    """Prefer the requirement whose shortest alternative is longest (most selective)."""
+    if not candidates:
+        return None
+    return max(candidates, key=lambda literals: (min(map(len, literals)), -len(literals)))
@@ -0,0 +1,267 @@
+"""
+RECEIPT IMAGE SERVICE
+
+Serves resized receipt images so list and report screens stop downloading
+the full-size `image_url` for every row. Derivatives are made on demand from
+the object in the `receipts` bucket and kept in a size-bounded on-disk LRU
+(cache.BlobCache, SQLite), so each image is fetched and resized once:
+
+    GET /thumbnail/<object path>   320px long edge (list rows)
+    GET /preview/<object path>     1024px long edge (detail pages)
+    GET /stats                     cache counters
+
+`<object path>` is the part of `image_url` after `/receipts/`. Stored receipt
+images are never overwritten (uploads use `upsert: false` with timestamped
+names), so a derivative never goes stale and responses are cacheable for a
+year. Responses carry a strong ETag (`If-None-Match` returns 304) and honour
+single byte ranges (206, or 416 when unsatisfiable).
+
+The source is Supabase Storage (`--storage-url`, authenticated with
+SUPABASE_SERVICE_ROLE_KEY like batch.py) or, for local runs, a directory
+laid out like the bucket (`--bucket-dir`). Concurrent requests for the same
+derivative wait for one render instead of each fetching the original.
+
+Usage:
+    python3 -m receipt_processor.image_service --bucket-dir ./bucket --port 8767
+    python3 -m receipt_processor.image_service --storage-url "$NEXT_PUBLIC_SUPABASE_URL"
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .batch import download_image
+from .cache import BlobCache
+from .derivatives import CONTENT_TYPES, bounded, drop_colour, encode, output_format
+from .errors import ProcessorError
+from .imaging import load_image
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'kacha-receipt-derivatives.sqlite3')
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_PORT = 8767
+BUCKET = 'receipts'
+
+# name -> (long edge, quality)
+SIZES = {
+    'thumbnail': (320, 70),
+    'preview': (1024, 75),
+}
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_ERROR_STATUS = {'invalid_request': 400, 'image_unavailable': 404, 'invalid_image': 422}
+
+
+class FilesystemBucket:
+    """Local stand-in for the bucket: objects are files under `root`."""
+
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+
+    def fetch(self, path: str) -> bytes:
+        full_path = os.path.realpath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep):
+            raise ProcessorError('invalid_request', f'Object path escapes the bucket: {path}')
+        try:
+            with open(full_path, 'rb') as handle:
+                return handle.read()
+        except OSError as exc:
+            raise ProcessorError('image_unavailable', f'No object {path}') from exc
+
+
+class StorageBucket:
+    """Objects from Supabase Storage's authenticated object endpoint."""
+
+    def __init__(self, storage_url: str, bucket: str = BUCKET):
+        self.base_url = f'{storage_url.rstrip("/")}/storage/v1/object/{bucket}/'
+
+    def fetch(self, path: str) -> bytes:
+        return download_image(self.base_url + urllib.parse.quote(path))
+
+
+def render(original: bytes, size: str) -> bytes:
+    """Encode the `size` derivative of an original image."""
+    long_edge, quality = SIZES[size]
+    image, _ = drop_colour(load_image(original, min_long_edge=long_edge))
+    return encode(bounded(image, long_edge), quality, output_format())
+
+
+def parse_range(header: str | None, length: int) -> tuple[int, int] | None:
+    """Inclusive `(start, end)` for a single `bytes=` range, None for the whole body.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:  # suffix range: the last N bytes
+        start, end = max(length - int(last), 0), length - 1
+    else:
+        start, end = int(first), min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        raise ValueError(f'Range {header} not satisfiable for {length} bytes')
+    return start, end
+
+
+class DerivativeStore:
+    """Derivatives by (size, object path): LRU cache first, then fetch and render once."""
+
+    def __init__(self, source, cache_path: str = DEFAULT_CACHE_PATH, cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.source = source
+        self.cache_path = cache_path
+        self.cache_max_bytes = cache_max_bytes
+        self.namespace = f'derivatives-{output_format()}-' + hashlib.sha256(json.dumps(SIZES).encode()).hexdigest()[:8]
+        self.renders = 0
+        self.render_ms = 0.0
+        self._local = threading.local()
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    @property
+    def cache(self) -> BlobCache:
+        """One SQLite connection per server thread."""
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = BlobCache(self.cache_path, self.cache_max_bytes, namespace=self.namespace)
+        return cache
+
+    def get(self, size: str, path: str) -> bytes:
+        key = f'{size}:{path}'
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+
+        with self._lock(key):
+            data = self.cache.get(key)  # rendered by the request we waited for
+            if data is None:
+                start = time.perf_counter()
+                data = render(self.source.fetch(path), size)
+                self.cache.put(key, data)
+                with self._locks_guard:
+                    self.renders += 1
+                    self.render_ms += (time.perf_counter() - start) * 1000
+        with self._locks_guard:
+            self._locks.pop(key, None)
+        return data
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            'renders': self.renders,
+            'avg_render_ms': round(self.render_ms / self.renders) if self.renders else 0,
+        }
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store: DerivativeStore = None
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def _serve(self, head: bool) -> None:
+        route = urllib.parse.urlsplit(self.path).path
+        if route == '/stats':
+            self._send_json(200, self.store.stats(), head)
+            return
+        size, _, path = route.lstrip('/').partition('/')
+        path = urllib.parse.unquote(path)
+        if size not in SIZES or not path:
+            self._send_json(404, {'error': f'Use /{{{"|".join(SIZES)}}}/<object path>'}, head)
+            return
+
+        try:
+            data = self.store.get(size, path)
+        except ProcessorError as exc:
+            self._send_json(_ERROR_STATUS.get(exc.error_type, 502), {'error': str(exc), 'error_type': exc.error_type}, head)
+            return
+
+        etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+        headers = {
+            'ETag': etag,
+            'Cache-Control': CACHE_CONTROL,
+            'Accept-Ranges': 'bytes',
+            'Content-Type': CONTENT_TYPES[output_format()],
+        }
+        if etag in (self.headers.get('If-None-Match') or ''):
+            self._send(304, headers, b'', head)
+            return
+        try:
+            # If-Range with a different ETag means the client's partial copy is stale: send it all
+            byte_range = None if self.headers.get('If-Range', etag) != etag else parse_range(self.headers.get('Range'), len(data))
+        except ValueError:
+            self._send(416, {'Content-Range': f'bytes */{len(data)}'}, b'', head)
+            return
+        if byte_range is None:
+            self._send(200, headers, data, head)
+            return
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        self._send(206, headers, data[start:end + 1], head)
+
+    def _send_json(self, status: int, body: dict, head: bool) -> None:
+        self._send(status, {'Content-Type': 'application/json'}, json.dumps(body).encode('utf-8'), head)
+
+    def _send(self, status: int, headers: dict, body: bytes, head: bool) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_service(store: DerivativeStore, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Serve `store` on a background thread (port 0 picks a free port)."""
+    handler = type('ImageHandler', (_ImageHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Serve resized receipt images with an on-disk LRU cache')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--bucket-dir', help='Directory laid out like the receipts bucket (local stand-in)')
+    source.add_argument('--storage-url', help='Supabase project URL')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PYTHON_PROCESSOR_IMAGE_PORT', DEFAULT_PORT)))
+    parser.add_argument('--cache-path', default=os.environ.get('PYTHON_PROCESSOR_IMAGE_CACHE_PATH', DEFAULT_CACHE_PATH))
+    parser.add_argument('--cache-max-mb', type=int,
+                        default=int(os.environ.get('PYTHON_PROCESSOR_IMAGE_CACHE_MAX_MB', DEFAULT_CACHE_MAX_BYTES // (1024 * 1024))))
+    args = parser.parse_args(argv)
+
+    bucket = FilesystemBucket(args.bucket_dir) if args.bucket_dir else StorageBucket(args.storage_url)
+    store = DerivativeStore(bucket, args.cache_path, args.cache_max_mb * 1024 * 1024)
+    server = start_image_service(store, args.host, args.port)
+    print(f'[image-service] serving on http://{args.host}:{server.server_address[1]}', file=sys.stderr, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
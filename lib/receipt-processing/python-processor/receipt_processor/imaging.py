@@ -0,0 +1,42 @@
+"""
+Image decoding helpers shared by the processing stages.
+"""
+
+import io
+import math
+
+from .errors import ProcessorError
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional until an image is actually decoded
+    Image = None
+    ImageOps = None
+
+
+def load_image(data: bytes, min_long_edge: int | None = None):
+    """Decode image bytes into an RGB PIL image with EXIF rotation applied.
+
+    With `min_long_edge`, JPEGs are decoded at the smallest DCT scale (1/2,
+    1/4, 1/8) whose long edge is still at least that, which is several times
+    faster than a full decode followed by a resize.
+    """
+    if Image is None:
+        raise ProcessorError('dependency_missing', 'Pillow is required to decode receipt images')
+    if not data:
+        raise ProcessorError('invalid_image', 'Image data is empty')
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if min_long_edge and image.format == 'JPEG' and max(image.size) > min_long_edge:
+            scale = min_long_edge / max(image.size)
+            image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        image = ImageOps.exif_transpose(image)
+        return image.convert('RGB')
+    except (OSError, ValueError) as exc:
+        raise ProcessorError('invalid_image', f'Could not decode image: {exc}') from exc
+
+
+def array_to_image(pixels):
+    """Wrap a uint8 NumPy array as a PIL image for the QR/OCR engines."""
+    return Image.fromarray(pixels)
@@ -0,0 +1,382 @@
+"""
+INDEX ADVISOR
+
+Proposes indexes for the query shapes the mobile routes issue and measures
+them on the seeded local database from loadtest.py (`setup` then `seed`),
+instead of adding indexes by hand after an incident. The result is a
+migration file to review and commit.
+
+Shapes (ROUTE_SHAPES) are the SQL PostgREST runs for the supabase-js calls,
+for example `.in('report_id', reportIds).order('created_at')` in
+mobile/expense-reports and the `.or(transaction_date..., created_at...)`
+filters of the stats fallback. Each shape names the columns it filters by
+equality and the columns it ranges over or sorts by; a shape can also name a
+partial key (created_at where transaction_date IS NULL). Candidates are the
+composite `(equality..., range)` and partial indexes those give, minus any an
+existing index already covers. A shape with a partial key is also tried with
+all of its candidates at once, since an OR of two ranges needs both indexes
+for a BitmapOr.
+
+Every candidate set is created for real, then dropped: an index built
+inside the measuring transaction may be invisible to that transaction's own
+snapshot (pg_index.indcheckxmin), so a rolled-back build can measure
+nothing. For each shape on the candidate's table the median `EXPLAIN ANALYZE` time as
+`authenticated` (RLS applies) is taken before and after, and the plan is
+checked for the indexes. Write overhead is the median time of inserting
+`--insert-rows` copied rows with user triggers off, with and without the
+set, per row. A set is proposed for a shape when the plan uses it and it is
+at least `--min-gain` faster; per shape only the fastest one.
+
+COALESCE(transaction_date::timestamptz, created_at) in the stats RPCs
+depends on the session time zone, so it cannot be indexed; the rollup
+(migration 037) serves those.
+
+Run it against the load-test database only.
+
+Usage:
+    python3 -m receipt_processor.index_advisor [--repeat 5] [--min-gain 0.2]
+    python3 -m receipt_processor.index_advisor --output /tmp/038-add-advised-indexes.sql
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from dataclasses import dataclass
+from datetime import date
+
+from .errors import ProcessorError
+from .loadtest import _MIGRATION, PAGE_LIMIT, REPO_ROOT, SHAPES, connect_local, impersonate
+from .rls_profile import explain, heaviest_user, median_run, shape_params
+
+try:
+    from psycopg import sql
+except ImportError:  # connect() reports the missing dependency
+    sql = None
+
+DEFAULT_REPEAT = 5
+DEFAULT_MIN_GAIN = 0.2
+DEFAULT_INSERT_ROWS = 1000
+CANDIDATE_PREFIX = 'advisor_'
+
+
+@dataclass(frozen=True)
+class Shape:
+    """One query a route issues, and the keys an index for it could use."""
+    name: str
+    route: str
+    query: str
+    table: str
+    equality: tuple[str, ...] = ()
+    ranges: tuple[str, ...] = ()
+    partial: tuple[tuple[str, str], ...] = ()  # (range column, predicate the query always implies)
+
+
+@dataclass(frozen=True)
+class Candidate:
+    table: str
+    keys: tuple[str, ...]
+    predicate: str | None = None
+
+    @property
+    def name(self) -> str:
+        suffix = '_partial' if self.predicate else ''
+        return f'idx_{self.table}_{"_".join(self.keys)}{suffix}'
+
+    def definition(self, name: str | None = None) -> str:
+        where = f' WHERE {self.predicate}' if self.predicate else ''
+        return f'CREATE INDEX IF NOT EXISTS {name or self.name}\n  ON {self.table} ({", ".join(self.keys)}){where};'
+
+
+# The stats fallback's .or() filters as PostgREST writes them
+_FALLBACK_RANGE = (
+    '(transaction_date >= %(month_start)s OR (transaction_date IS NULL AND created_at >= %(month_start)s)) '
+    'AND (transaction_date < %(next_month_start)s OR (transaction_date IS NULL AND created_at < %(next_month_start)s))'
+)
+
+ROUTE_SHAPES = (
+    Shape('list_reports', 'mobile/expense-reports', SHAPES['list_reports'], 'expense_reports', ranges=('created_at',)),
+    Shape(
+        'list_reports.cursor', 'mobile/expense-reports',
+        f'SELECT * FROM public.expense_reports WHERE created_at < %(cursor)s ORDER BY created_at DESC LIMIT {PAGE_LIMIT}',
+        'expense_reports', ranges=('created_at',),
+    ),
+    Shape(
+        'list_reports.items', 'mobile/expense-reports', SHAPES['list_reports.items'], 'expense_items',
+        equality=('report_id',), ranges=('created_at',),
+    ),
+    Shape(
+        'list_reports.items_one', 'mobile/expense-reports',
+        'SELECT id, report_id, image_url, amount FROM public.expense_items '
+        'WHERE report_id = %(report_id)s ORDER BY created_at ASC LIMIT 10',
+        'expense_items', equality=('report_id',), ranges=('created_at',),
+    ),
+    Shape(
+        'report_detail.items', 'mobile/expense-reports/[id]',
+        'SELECT * FROM public.expense_items WHERE report_id = %(report_id)s ORDER BY created_at DESC',
+        'expense_items', equality=('report_id',), ranges=('created_at',),
+    ),
+    Shape('list_receipts', 'mobile/receipts', SHAPES['list_receipts'], 'expense_items', ranges=('created_at',)),
+    Shape(
+        'stats_fallback.sum_amounts', 'mobile/stats',
+        f'SELECT amount, transaction_date, created_at FROM public.expense_items WHERE {_FALLBACK_RANGE}',
+        'expense_items', ranges=('transaction_date',), partial=(('created_at', 'transaction_date IS NULL'),),
+    ),
+    Shape(
+        'stats_fallback.count_items', 'mobile/stats',
+        'SELECT count(*) FROM public.expense_items '
+        'WHERE created_at >= %(month_start)s AND created_at < %(next_month_start)s',
+        'expense_items', ranges=('created_at',),
+    ),
+)
+
+_INDEXES_SQL = """
+SELECT array(SELECT pg_get_indexdef(i.indexrelid, k, true) FROM generate_series(1, i.indnkeyatts) k),
+       pg_get_expr(i.indpred, i.indrelid)
+FROM pg_index i
+WHERE i.indrelid = ('public.' || %s)::regclass AND i.indisvalid
+"""
+
+_INSERT_COLUMNS_SQL = """
+SELECT column_name FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = %s AND is_generated = 'NEVER' AND is_identity = 'NO'
+  AND column_name NOT IN (
+    SELECT a.attname FROM pg_constraint k
+    JOIN pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = ANY(k.conkey)
+    WHERE k.conrelid = ('public.' || %s)::regclass AND k.contype IN ('p', 'u')
+  )
+ORDER BY ordinal_position
+"""
+
+_CURSOR_SQL = f'SELECT created_at FROM public.expense_reports ORDER BY created_at DESC OFFSET {PAGE_LIMIT - 1} LIMIT 1'
+
+_LEFTOVERS_SQL = f"""
+SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND indexname LIKE '{CANDIDATE_PREFIX}%'
+"""
+
+_ROWS_SQL = "SELECT relname, reltuples::bigint FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = ANY(%s)"
+
+
+def _normalize(predicate: str | None) -> str | None:
+    return re.sub(r'[\s()]', '', predicate).lower() if predicate else None
+
+
+def candidates(shapes, existing: dict[str, list[tuple[tuple[str, ...], str | None]]]) -> list[tuple[Candidate, ...]]:
+    """Each uncovered composite or partial index of `shapes` alone, then each partial-keyed shape's together."""
+    found, combined = [], []
+    for shape in shapes:
+        uncovered = []
+        proposed = [Candidate(shape.table, shape.equality + (column,)) for column in shape.ranges]
+        proposed += [Candidate(shape.table, shape.equality + (column,), predicate) for column, predicate in shape.partial]
+        for candidate in proposed:
+            covered = any(
+                keys[:len(candidate.keys)] == candidate.keys
+                and (predicate is None or _normalize(predicate) == _normalize(candidate.predicate))
+                for keys, predicate in existing.get(candidate.table, ())
+            )
+            if covered:
+                continue
+            uncovered.append(candidate)
+            if (candidate,) not in found:
+                found.append((candidate,))
+        if shape.partial and len(uncovered) > 1 and tuple(uncovered) not in combined:
+            combined.append(tuple(uncovered))
+    return found + combined
+
+
+def uses_index(plan: dict, names: set[str]) -> bool:
+    """Whether any node of `plan` scans one of the indexes `names`."""
+    return plan.get('Index Name') in names or any(uses_index(child, names) for child in plan.get('Plans', ()))
+
+
+def existing_indexes(conn, tables) -> dict[str, list[tuple[tuple[str, ...], str | None]]]:
+    return {table: [(tuple(keys), predicate) for keys, predicate in conn.execute(_INDEXES_SQL, (table,))] for table in tables}
+
+
+def route_params(conn, user_id: str) -> dict:
+    """shape_params plus the single report and the second-page cursor the routes would send."""
+    params = shape_params(conn, user_id)
+    with conn.transaction(force_rollback=True):
+        impersonate(conn, user_id)
+        row = conn.execute(_CURSOR_SQL).fetchone()
+    params['report_id'] = params['report_ids'][0] if params['report_ids'] else None
+    params['cursor'] = row[0] if row else date.today()
+    return params
+
+
+def measure_shapes(conn, user_id: str, shapes, params: dict, repeat: int) -> dict[str, dict]:
+    """Median execution of each shape as the user, with its plan."""
+    measured = {}
+    for shape in shapes:
+        runs = []
+        for _ in range(repeat):
+            with conn.transaction(force_rollback=True):
+                impersonate(conn, user_id)
+                runs.append(explain(conn, shape.query, params))
+        measured[shape.name] = median_run(runs)
+    return measured
+
+
+def measure_insert(conn, table: str, rows: int, repeat: int) -> float | None:
+    """Median ms to insert `rows` copies of existing rows, user triggers off. None if rows cannot be copied."""
+    columns = [row[0] for row in conn.execute(_INSERT_COLUMNS_SQL, (table, table))]
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    query = sql.SQL('INSERT INTO {table} ({columns}) SELECT {columns} FROM {table} LIMIT {rows}').format(
+        table=sql.Identifier(table), columns=column_list, rows=sql.Literal(rows))
+    runs = []
+    for _ in range(repeat):
+        try:
+            with conn.transaction(force_rollback=True):
+                # Index maintenance only, not the stats rollup triggers
+                conn.execute("SET LOCAL session_replication_role = 'replica'")
+                runs.append(explain(conn, query))
+        except Exception as exc:
+            print(f'[index_advisor] insert into {table} failed: {str(exc).splitlines()[0]}', file=sys.stderr)
+            return None
+    return median_run(runs)['execution_ms']
+
+
+def drop_leftovers(conn) -> None:
+    """Drop candidate indexes left behind by an interrupted run."""
+    for (name,) in conn.execute(_LEFTOVERS_SQL).fetchall():
+        conn.execute(sql.SQL('DROP INDEX IF EXISTS {}').format(sql.Identifier(name)))
+
+
+def evaluate(
+    conn,
+    user_id: str,
+    shapes=ROUTE_SHAPES,
+    repeat: int = DEFAULT_REPEAT,
+    insert_rows: int = DEFAULT_INSERT_ROWS,
+) -> dict:
+    """Before/after cost of every candidate set on every shape of its table, and its write overhead."""
+    drop_leftovers(conn)
+    tables = sorted({shape.table for shape in shapes})
+    params = route_params(conn, user_id)
+    before = measure_shapes(conn, user_id, shapes, params, repeat)
+    insert_before = {table: measure_insert(conn, table, insert_rows, repeat) for table in tables}
+
+    results = []
+    for index, candidate_set in enumerate(candidates(shapes, existing_indexes(conn, tables))):
+        table = candidate_set[0].table
+        names = [f'{CANDIDATE_PREFIX}{index}_{position}' for position in range(len(candidate_set))]
+        table_shapes = [shape for shape in shapes if shape.table == table]
+        try:
+            for candidate, name in zip(candidate_set, names):
+                conn.execute(candidate.definition(name))
+            size = sum(conn.execute('SELECT pg_relation_size(%s::regclass)', (name,)).fetchone()[0] for name in names)
+            after = measure_shapes(conn, user_id, table_shapes, params, repeat)
+            insert_after = measure_insert(conn, table, insert_rows, repeat)
+        finally:
+            for name in names:
+                conn.execute(sql.SQL('DROP INDEX IF EXISTS {}').format(sql.Identifier(name)))
+
+        insert_base = insert_before[table]
+        results.append({
+            'indexes': [candidate.name for candidate in candidate_set],
+            'definitions': [candidate.definition() for candidate in candidate_set],
+            'table': table,
+            'size_bytes': size,
+            'insert_us_per_row': (
+                round((insert_after - insert_base) * 1000 / insert_rows, 3)
+                if insert_after is not None and insert_base is not None else None
+            ),
+            'shapes': [
+                {
+                    'shape': shape.name,
+                    'route': shape.route,
+                    'before_ms': round(before[shape.name]['execution_ms'], 3),
+                    'after_ms': round(after[shape.name]['execution_ms'], 3),
+                    'used': uses_index(after[shape.name]['plan'], set(names)),
+                }
+                for shape in table_shapes
+            ],
+        })
+    return {
+        'user_id': user_id,
+        'rows': dict(conn.execute(_ROWS_SQL, (tables,)).fetchall()),
+        'baseline': {name: round(run['execution_ms'], 3) for name, run in before.items()},
+        'candidates': results,
+    }
+
+
+def propose(results: list[dict], min_gain: float = DEFAULT_MIN_GAIN) -> list[dict]:
+    """Per shape, the fastest candidate set its plan uses that is at least `min_gain` faster. In candidate order."""
+    best = {}
+    for result in results:
+        for entry in result['shapes']:
+            gain = 1 - entry['after_ms'] / entry['before_ms'] if entry['before_ms'] else 0
+            if not entry['used'] or gain < min_gain:
+                continue
+            current = best.get(entry['shape'])
+            if current is None or entry['after_ms'] < current[1]['after_ms']:
+                best[entry['shape']] = (result, entry)
+    proposed = []
+    for result in results:
+        served = [entry for chosen, entry in best.values() if chosen is result]
+        if served:
+            proposed.append({**result, 'serves': served})
+    return proposed
+
+
+def next_migration_path(repo_root: str = REPO_ROOT, title: str = 'add-advised-indexes') -> str:
+    migrations_dir = os.path.join(repo_root, 'migrations')
+    numbers = [int(match[1]) for match in map(_MIGRATION.match, os.listdir(migrations_dir)) if match]
+    return os.path.join(migrations_dir, f'{max(numbers, default=0) + 1:03d}-{title}.sql')
+
+
+def render_migration(number: int, proposed: list[dict], rows: dict) -> str:
+    """Migration text for the proposed indexes, each with its measurements as comments."""
+    seeded = ', '.join(f'{table} {count}' for table, count in sorted(rows.items()))
+    lines = [
+        f'-- MIGRATION {number:03d}: Indexes for the mobile route query shapes',
+        f'-- Proposed by receipt_processor.index_advisor on {date.today().isoformat()} (seeded rows: {seeded}).',
+        '-- Times are median EXPLAIN ANALYZE executions as authenticated (RLS applied), before -> after.',
+        '-- Insert overhead is per copied row with user triggers off. Review before applying: CREATE INDEX',
+        '-- blocks writes to the table while it builds; on large tables run it as CREATE INDEX CONCURRENTLY.',
+        '',
+    ]
+    for result in proposed:
+        for entry in result['serves']:
+            lines.append(f'-- {entry["shape"]} ({entry["route"]}): {entry["before_ms"]} -> {entry["after_ms"]} ms')
+        overhead = result['insert_us_per_row']
+        lines.append(
+            f'-- Insert overhead {"unmeasured" if overhead is None else f"{overhead:+} us/row"}, '
+            f'{result["size_bytes"] / 1024 / 1024:.1f} MB on the seeded data'
+        )
+        lines.extend([*result['definitions'], ''])
+    lines.append("SELECT 'Advised indexes added' AS status;")
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Propose and measure indexes for the route query shapes')
+    parser.add_argument('--database-url', default=None, help='Local load-test Postgres (default: as loadtest.py)')
+    parser.add_argument('--allow-remote', action='store_true', help='Allow a non-local server (never production)')
+    parser.add_argument('--user', default=None, help='User to act as (default: the seeded user with the most reports)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Runs per measurement; the median is kept')
+    parser.add_argument('--min-gain', type=float, default=DEFAULT_MIN_GAIN, help='Fraction a shape must speed up by')
+    parser.add_argument('--insert-rows', type=int, default=DEFAULT_INSERT_ROWS, help='Rows per write-overhead insert')
+    parser.add_argument('--output', default=None, help='Migration file to write (default: next number in migrations/)')
+    args = parser.parse_args(argv)
+
+    with connect_local(args.database_url, args.allow_remote) as conn:
+        report = evaluate(conn, args.user or heaviest_user(conn), repeat=args.repeat, insert_rows=args.insert_rows)
+
+    proposed = propose(report['candidates'], args.min_gain)
+    report['proposed'] = [name for result in proposed for name in result['indexes']]
+    if proposed:
+        output = args.output or next_migration_path()
+        match = _MIGRATION.match(os.path.basename(output))
+        if match is None:
+            raise ProcessorError('invalid_request', f'{output}: migration files are named NNN-title.sql')
+        with open(output, 'w', encoding='utf-8') as handle:
+            handle.write(render_migration(int(match[1]), proposed, report['rows']))
+        report['migration'] = output
+    print(json.dumps(report, indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
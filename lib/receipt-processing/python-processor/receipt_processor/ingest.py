@@ -0,0 +1,259 @@
+"""
+BULK EXPENSE ITEM INGEST
+
+Loads expense_items for imports and onboarding (thousands of historical
+receipts at once). The upload route inserts one row per request and then
+calls `update_report_total` (migration 025) per receipt; here items are
+read from JSON lines and written `--batch-size` at a time:
+
+1. COPY the batch into a session temp table (one round trip, no per-row
+   statement parsing).
+2. One INSERT ... SELECT into expense_items. Rows whose report does not
+   exist are skipped, and rows carrying an `id` that is already present are
+   skipped too, so re-running an import that supplies ids is safe.
+3. One UPDATE recomputing `total_amount` for every report the batch
+   touched, the same sum update_report_total computes.
+
+Each batch is its own transaction. Keys must be expense_items columns
+(`report_id` is required); a column a row omits takes its table default
+(rows are copied in groups with the same keys, so one row's `id` or
+`created_at` never turns into NULL for another).
+
+Progress is checkpointed to a JSON file after every batch (the last input
+line committed), so a restarted import with the same input file resumes
+after it. Throughput (rows/s) is logged per batch and in the summary.
+
+Usage:
+    python3 -m receipt_processor.ingest items.jsonl [--batch-size 5000]
+    python3 -m receipt_processor.ingest items.jsonl --reset   # ignore the checkpoint
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import IO, Iterator
+
+from .db import connect
+from .errors import ProcessorError
+
+try:
+    from psycopg import sql
+except ImportError:  # connect() reports the missing dependency
+    sql = None
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_CHECKPOINT_PATH = os.path.join(tempfile.gettempdir(), 'kacha-ingest-checkpoint.json')
+STAGING_TABLE = 'ingest_expense_items'
+
+_COLUMNS_SQL = """
+SELECT column_name FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = 'expense_items'
+ORDER BY ordinal_position
+"""
+
+# Typed like expense_items, without its constraints or defaults
+_STAGING_SQL = f'CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ON COMMIT DELETE ROWS AS SELECT * FROM expense_items WITH NO DATA'
+
+_INSERT_SQL = """
+WITH inserted AS (
+  INSERT INTO expense_items ({columns})
+  SELECT {columns} FROM {staging} s
+  WHERE EXISTS (SELECT 1 FROM expense_reports er WHERE er.id = s.report_id)
+  ON CONFLICT (id) DO NOTHING
+  RETURNING report_id
+)
+SELECT report_id, COUNT(*) FROM inserted GROUP BY report_id
+"""
+
+# update_report_total (migration 025) for a set of reports at once
+_TOTALS_SQL = """
+UPDATE expense_reports er
+SET total_amount = t.total
+FROM (
+  SELECT report_id, COALESCE(SUM(amount), 0) AS total
+  FROM expense_items
+  WHERE report_id = ANY(%s::uuid[])
+  GROUP BY report_id
+) t
+WHERE er.id = t.report_id
+"""
+
+
+def read_items(lines: IO[str], columns: set[str], skip: int = 0) -> Iterator[tuple[int, dict]]:
+    """Yield `(line_number, item)` from JSON lines after line `skip`, validated against `columns`."""
+    for line_number, line in enumerate(lines, start=1):
+        if line_number <= skip or not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as exc:
+            raise ProcessorError('invalid_request', f'Line {line_number}: invalid JSON ({exc})') from exc
+        if not isinstance(item, dict) or not item.get('report_id'):
+            raise ProcessorError('invalid_request', f'Line {line_number}: expected an object with report_id')
+        unknown = item.keys() - columns
+        if unknown:
+            raise ProcessorError('invalid_request', f'Line {line_number}: not expense_items columns: {", ".join(sorted(unknown))}')
+        yield line_number, item
+
+
+def _copy_value(value):
+    # JSONB columns (receipt_details) arrive as objects
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+
+def group_by_columns(items: list[dict], table_columns: list[str]) -> dict[tuple[str, ...], list[dict]]:
+    """Items keyed by the columns they set, in table order; each group is copied with its own column list."""
+    groups: dict[tuple[str, ...], list[dict]] = {}
+    for item in items:
+        groups.setdefault(tuple(column for column in table_columns if column in item), []).append(item)
+    return groups
+
+
+def write_batch(conn, items: list[dict], table_columns: list[str]) -> tuple[int, int]:
+    """COPY, insert and re-total one batch in a single transaction. Returns (inserted, reports updated)."""
+    staging = sql.Identifier(STAGING_TABLE)
+    counts: dict = {}
+
+    with conn.transaction():
+        conn.execute(_STAGING_SQL)
+        with conn.cursor() as cursor:
+            for columns, group in group_by_columns(items, table_columns).items():
+                column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+                with cursor.copy(sql.SQL('COPY {} ({}) FROM STDIN').format(staging, column_list)) as copy:
+                    for item in group:
+                        copy.write_row([_copy_value(item[column]) for column in columns])
+                cursor.execute(sql.SQL(_INSERT_SQL).format(columns=column_list, staging=staging))
+                for report_id, count in cursor.fetchall():
+                    counts[report_id] = counts.get(report_id, 0) + count
+                cursor.execute(sql.SQL('TRUNCATE {}').format(staging))
+            if counts:
+                cursor.execute(_TOTALS_SQL, (list(counts),))
+    return sum(counts.values()), len(counts)
+
+
+class Checkpoint:
+    """Last input line committed, per input file, persisted atomically to a JSON file."""
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH, input_path: str | None = None):
+        self.path = path
+        self.job = None
+        if input_path:
+            stat = os.stat(input_path)
+            self.job = f'{os.path.abspath(input_path)}:{stat.st_size}:{int(stat.st_mtime)}'
+
+    def load(self) -> int:
+        """The input line to resume after (0 to start from the beginning)."""
+        if self.job is None:
+            return 0
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return 0
+        # A different (or edited) input file starts over
+        return state['line'] if state.get('job') == self.job else 0
+
+    def save(self, line: int, counts: dict) -> None:
+        if self.job is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ingest-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump({'job': self.job, 'line': line, 'updated_at': time.time(), **counts}, handle)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def reset(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def ingest(
+    conn,
+    lines: IO[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    checkpoint: Checkpoint | None = None,
+) -> dict:
+    """Load JSON-lines expense items in batches. Returns the run's counts.
+
+    `conn` must be in autocommit mode: each batch commits on its own.
+    """
+    checkpoint = checkpoint or Checkpoint()
+    table_columns = [row[0] for row in conn.execute(_COLUMNS_SQL).fetchall()]
+    if not table_columns:
+        raise ProcessorError('invalid_request', 'No expense_items table in this database')
+    resumed_after = checkpoint.load()
+
+    counts = {'rows': 0, 'inserted': 0, 'skipped': 0, 'batches': 0, 'reports_updated': 0}
+    start = time.perf_counter()
+
+    def flush(batch: list[dict], last_line: int) -> None:
+        batch_start = time.perf_counter()
+        inserted, reports = write_batch(conn, batch, table_columns)
+        counts['rows'] += len(batch)
+        counts['inserted'] += inserted
+        counts['skipped'] += len(batch) - inserted
+        counts['batches'] += 1
+        counts['reports_updated'] += reports
+        checkpoint.save(last_line, counts)
+        elapsed = time.perf_counter() - batch_start
+        print(
+            f'[ingest] batch {counts["batches"]}: {inserted}/{len(batch)} rows, {reports} reports, '
+            f'{len(batch) / elapsed:.0f} rows/s (total {counts["rows"]})',
+            file=sys.stderr, flush=True,
+        )
+
+    batch: list[dict] = []
+    line_number = resumed_after
+    for line_number, item in read_items(lines, set(table_columns), skip=resumed_after):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            flush(batch, line_number)
+            batch = []
+    if batch:
+        flush(batch, line_number)
+    checkpoint.reset()
+
+    elapsed = time.perf_counter() - start
+    return {
+        **counts,
+        'resumed_after_line': resumed_after,
+        'rows_per_s': round(counts['rows'] / elapsed) if elapsed else 0,
+        'elapsed_s': round(elapsed, 3),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Bulk-load expense_items from JSON lines')
+    parser.add_argument('input', help='JSON-lines file of expense_items rows, or - for stdin')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows per COPY batch (default: %(default)s)')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help='Checkpoint file (default: %(default)s)')
+    parser.add_argument('--reset', action='store_true', help='Ignore the checkpoint and start from the first line')
+    args = parser.parse_args(argv)
+
+    checkpoint = Checkpoint(args.checkpoint, None if args.input == '-' else args.input)
+    if args.reset:
+        checkpoint.reset()
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        with connect(args.database_url) as conn:
+            conn.autocommit = True
+            summary = ingest(conn, source, batch_size=args.batch_size, checkpoint=checkpoint)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
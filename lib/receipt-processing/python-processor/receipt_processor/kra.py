@@ -0,0 +1,577 @@
+"""
+KRA eTIMS INVOICE SCRAPER
+
+Async replacement for scrapeKRAInvoice (kra-scraper.ts), which opens a fresh
+connection per receipt and sleeps 2-6 s between retries.
+
+- Connections are HTTP/1.1 keep-alive and pooled per host, so a burst of
+  verifications pays one TCP/TLS handshake per connection, not per receipt.
+  At most `limit_per_host` requests run against a host at once.
+- Verified invoices never change, so they are cached in SQLite keyed by
+  invoice number (the `invoiceNo` query parameter of the QR URL). A repeat
+  lookup makes no network call, across restarts. Concurrent lookups of the
+  same invoice share a single fetch.
+- The page is parsed with the patterns kra-scraper.ts uses, over the page
+  text (one line per table cell) instead of a full DOM.
+
+For testing, `standin` serves recorded KRA pages (`DIR/<invoiceNo>.html`)
+over keep-alive HTTP/1.1. Point the scraper at it with `--base-url` or
+PYTHON_PROCESSOR_KRA_BASE_URL, which replaces the scheme and host of every
+eTIMS URL.
+
+Usage:
+    python3 -m receipt_processor.kra scrape "https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?actionCode=loadPage&invoiceNo=..."
+    python3 -m receipt_processor.kra standin --pages recorded/ --port 8765
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qsl, urljoin, urlsplit
+
+from .errors import ProcessorError, error_result
+
+DEFAULT_KRA_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'kacha-kra-invoices.sqlite3')
+DEFAULT_LIMIT_PER_HOST = 4
+DEFAULT_TIMEOUT_S = 15.0
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF_S = 1.0  # doubled after each failed attempt
+MAX_REDIRECTS = 5
+MAX_IDLE_PER_HOST = 8
+MAX_BODY_BYTES = 4 * 1024 * 1024
+KRA_DOMAIN = 'kra.go.ke'
+
+REQUEST_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+# Same patterns as kra-scraper.ts
+_PATTERNS = {
+    'invoice_number': re.compile(r'Control Unit Invoice Number\s+(\S+)'),
+    'trader_invoice_no': re.compile(r'Trader System Invoice No\s+(\S+)'),
+    'invoice_date': re.compile(r'Invoice Date\s+([\d/]+)'),
+    'taxable_amount': re.compile(r'Total Taxable Amount\s+([\d.,]+)'),
+    'vat_amount': re.compile(r'Total Tax Amount\s+([\d.,]+)'),
+    'total_amount': re.compile(r'Total Invoice Amount\s+([\d.,]+)'),
+    'merchant_name': re.compile(r'Supplier Name\s+([^\n]+)'),
+}
+_AMOUNT_FIELDS = ('taxable_amount', 'vat_amount', 'total_amount')
+_RETRY_STATUSES = (408, 429)
+
+_BLOCK_TAGS = {'br', 'div', 'li', 'p', 'td', 'th', 'tr', 'h1', 'h2', 'h3', 'h4', 'label', 'span'}
+_SKIP_TAGS = {'script', 'style', 'noscript'}
+
+
+class _PageText(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skipping += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def page_text(html: str) -> str:
+    """Visible text of a page with a line break at every block/table cell."""
+    parser = _PageText()
+    parser.feed(html)
+    parser.close()
+    lines = (' '.join(line.split()) for line in ''.join(parser.parts).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def parse_invoice(html: str) -> dict | None:
+    """Invoice fields from a KRA invoice-check page, or None if it has none."""
+    text = page_text(html)
+    fields = {}
+    for name, pattern in _PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            fields[name] = match.group(1).strip()
+    if not fields.get('invoice_number') and not fields.get('merchant_name'):
+        return None
+
+    invoice = {name: fields.get(name, '') for name in ('invoice_number', 'trader_invoice_no', 'invoice_date', 'merchant_name')}
+    for name in _AMOUNT_FIELDS:
+        invoice[name] = _amount(fields.get(name))
+    invoice['verified'] = True
+    return invoice
+
+
+def _amount(text: str | None) -> float:
+    try:
+        return float(re.sub(r'[^\d.]', '', text or '') or 0)
+    except ValueError:
+        return 0.0
+
+
+def is_kra_host(hostname: str) -> bool:
+    """True for kra.go.ke and its subdomains."""
+    return hostname == KRA_DOMAIN or hostname.endswith(f'.{KRA_DOMAIN}')
+
+
+def invoice_key(url: str) -> str:
+    """Cache key for an eTIMS URL: its `invoiceNo` parameter, else the URL itself."""
+    for name, value in parse_qsl(urlsplit(url).query):
+        if name.lower() in ('invoiceno', 'invoice_no', 'invoicenumber') and value.strip():
+            return value.strip()
+    return url
+
+
+class InvoiceCache:
+    """Persistent invoice cache (SQLite). Entries never expire."""
+
+    def __init__(self, path: str = DEFAULT_KRA_CACHE_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS invoices ('
+            'key TEXT PRIMARY KEY, invoice_number TEXT, value TEXT NOT NULL, fetched_at REAL NOT NULL)'
+        )
+
+    def get(self, key: str) -> dict | None:
+        row = self._conn.execute('SELECT value FROM invoices WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, invoice: dict) -> None:
+        self._conn.execute(
+            'INSERT OR REPLACE INTO invoices (key, invoice_number, value, fetched_at) VALUES (?, ?, ?, ?)',
+            (key, invoice.get('invoice_number'), json.dumps(invoice, separators=(',', ':')), time.time()),
+        )
+
+    def __len__(self) -> int:
+        return self._conn.execute('SELECT COUNT(*) FROM invoices').fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+@dataclass
+class HttpResponse:
+    status: int
+    headers: dict[str, str]
+    body: bytes
+    url: str
+
+    def text(self) -> str:
+        charset = re.search(r'charset=([\w-]+)', self.headers.get('content-type', ''))
+        try:
+            return self.body.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+        except LookupError:
+            return self.body.decode('utf-8', errors='replace')
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 GET client with per-host concurrency limits."""
+
+    def __init__(
+        self,
+        limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+        timeout: float = DEFAULT_TIMEOUT_S,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+    ):
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.connections_opened = 0
+        self.requests = 0
+        self._idle: dict[tuple, list[tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        self._limits: dict[tuple, asyncio.Semaphore] = {}
+        self._ssl: ssl.SSLContext | None = None
+
+    async def get(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+        max_redirects: int = MAX_REDIRECTS,
+        allow_host: Callable[[str], bool] | None = None,
+    ) -> HttpResponse:
+        """GET `url`, following redirects; with `allow_host`, every hop's host must pass it."""
+        for _ in range(max_redirects + 1):
+            if allow_host is not None and not allow_host(urlsplit(url).hostname or ''):
+                raise ProcessorError('invalid_request', f'Refusing to fetch {url}: not an allowed host')
+            response = await asyncio.wait_for(self._request(url, headers or {}), self.timeout)
+            location = response.headers.get('location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            url = urljoin(url, location)
+        raise ProcessorError('kra_unavailable', f'Too many redirects fetching {url}')
+
+    async def close(self) -> None:
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def _request(self, url: str, headers: dict[str, str]) -> HttpResponse:
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ProcessorError('invalid_request', f'Unsupported URL: {url}')
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        host = parts.hostname if parts.port is None else f'{parts.hostname}:{parts.port}'
+        request = ''.join(
+            [f'GET {target} HTTP/1.1\r\nHost: {host}\r\n']
+            + [f'{name}: {value}\r\n' for name, value in headers.items()]
+            + ['\r\n']
+        ).encode('latin-1')
+
+        limit = self._limits.setdefault(origin, asyncio.Semaphore(self.limit_per_host))
+        async with limit:
+            connection = self._checkout(origin)
+            if connection is not None:
+                try:
+                    return await self._exchange(origin, connection, request, url)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    pass  # the server closed an idle keep-alive connection; use a fresh one
+            return await self._exchange(origin, await self._connect(origin), request, url)
+
+    def _checkout(self, origin: tuple):
+        idle = self._idle.get(origin)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def _connect(self, origin: tuple):
+        scheme, hostname, port = origin
+        context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        connection = await asyncio.open_connection(hostname, port, ssl=context)
+        self.connections_opened += 1
+        return connection
+
+    async def _exchange(self, origin: tuple, connection, request: bytes, url: str) -> HttpResponse:
+        reader, writer = connection
+        try:
+            writer.write(request)
+            await writer.drain()
+            self.requests += 1
+            status, headers, body, keep_alive = await _read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        idle = self._idle.setdefault(origin, [])
+        if keep_alive and len(idle) < self.max_idle_per_host:
+            idle.append(connection)
+        else:
+            writer.close()
+        return HttpResponse(status, headers, _decode_body(body, headers.get('content-encoding', '')), url)
+
+
+async def _read_response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str], bytes, bool]:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed before the response')
+    version, _, rest = status_line.decode('latin-1').partition(' ')
+    status = int(rest.split(' ', 1)[0])
+
+    headers: dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        size = 0
+        while True:
+            length = int((await reader.readline()).split(b';', 1)[0].strip() or b'0', 16)
+            if length == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass  # trailers
+                break
+            size += length
+            if size > MAX_BODY_BYTES:
+                raise ProcessorError('kra_unavailable', 'KRA response too large')
+            chunks.append(await reader.readexactly(length))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        length = int(headers['content-length'])
+        if length > MAX_BODY_BYTES:
+            raise ProcessorError('kra_unavailable', 'KRA response too large')
+        body = await reader.readexactly(length)
+    else:
+        body = await reader.read(MAX_BODY_BYTES)
+        keep_alive = False
+    return status, headers, body, keep_alive
+
+
+def _decode_body(body: bytes, encoding: str) -> bytes:
+    encoding = encoding.lower()
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class _Final(Exception):
+    """Wraps an error that retrying cannot fix (e.g. HTTP 404)."""
+
+    def __init__(self, error: ProcessorError):
+        super().__init__(str(error))
+        self.error = error
+
+
+class KRAScraper:
+    """Cached, pooled KRA invoice lookups. One instance per event loop."""
+
+    def __init__(
+        self,
+        cache_path: str | None = DEFAULT_KRA_CACHE_PATH,
+        limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+        timeout: float = DEFAULT_TIMEOUT_S,
+        retries: int = DEFAULT_RETRIES,
+        base_url: str | None = None,
+    ):
+        self.cache = InvoiceCache(cache_path) if cache_path else None
+        self.pool = ConnectionPool(limit_per_host, timeout)
+        self.retries = retries
+        self.base_url = base_url
+        self.lookups = 0
+        self.cache_hits = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def scrape(self, url: str) -> tuple[dict, bool]:
+        """`(invoice, cache_hit)` for an eTIMS QR URL. Raises ProcessorError."""
+        if not is_kra_host(urlsplit(url).hostname or ''):
+            raise ProcessorError('invalid_request', 'Not a valid KRA URL')
+        key = invoice_key(url)
+        self.lookups += 1
+
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            self.cache_hits += 1
+            return cached, True
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending), False
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this waiter was cancelled, not the lookup it joined
+                # The request that owned the lookup went away; the waiters get an error result
+                raise ProcessorError('kra_unavailable', 'KRA lookup was cancelled before it finished') from None
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            invoice = await self._fetch(url)
+            if self.cache is not None:
+                self.cache.put(key, invoice)
+            future.set_result(invoice)
+            return invoice, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # retrieved: waiters re-raise it, nobody else has to
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def scrape_many(self, urls: list[str]) -> list[dict]:
+        """Scrape concurrently; one `{success, invoice, cache_hit}` or error result per URL."""
+        async def one(url: str) -> dict:
+            try:
+                invoice, cache_hit = await self.scrape(url)
+            except ProcessorError as exc:
+                return error_result(exc)
+            return {'success': True, 'invoice': invoice, 'cache_hit': cache_hit}
+
+        return await asyncio.gather(*(one(url) for url in urls))
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'cache_hits': self.cache_hits,
+            'cached_invoices': len(self.cache) if self.cache is not None else 0,
+            'requests': self.pool.requests,
+            'connections_opened': self.pool.connections_opened,
+        }
+
+    async def close(self) -> None:
+        await self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    async def _fetch(self, url: str) -> dict:
+        target = self._rewrite(url)
+        delay = RETRY_BACKOFF_S
+        for attempt in range(1, self.retries + 1):
+            try:
+                response = await self.pool.get(target, REQUEST_HEADERS, allow_host=self._allow_host)
+                if response.status != 200:
+                    error = ProcessorError('kra_unavailable', f'KRA returned HTTP {response.status}')
+                    if response.status < 500 and response.status not in _RETRY_STATUSES:
+                        raise _Final(error)
+                    raise error
+                invoice = parse_invoice(response.text())
+                if invoice is None:
+                    raise ProcessorError('kra_no_data', 'KRA page returned no invoice data')
+                return {**invoice, 'scraped_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+            except _Final as final:
+                raise final.error from None
+            except (ProcessorError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, zlib.error) as exc:
+                if isinstance(exc, ProcessorError) and exc.error_type == 'invalid_request':
+                    raise  # an off-domain redirect is followed again on every retry
+                if attempt == self.retries:
+                    if isinstance(exc, ProcessorError):
+                        raise
+                    raise ProcessorError('kra_unavailable', f'KRA request failed: {exc!r}') from exc
+                await asyncio.sleep(delay)
+                delay *= 2
+        raise AssertionError('unreachable')
+
+    def _allow_host(self, hostname: str) -> bool:
+        """KRA hosts only; with a base URL (the stand-in), only its host."""
+        if self.base_url:
+            return hostname == urlsplit(self.base_url).hostname
+        return is_kra_host(hostname)
+
+    def _rewrite(self, url: str) -> str:
+        if not self.base_url:
+            return url
+        parts, base = urlsplit(url), urlsplit(self.base_url)
+        return parts._replace(scheme=base.scheme, netloc=base.netloc).geturl()
+
+
+class _StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real portal
+    pages_dir = '.'
+    delay_s = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay_s)
+        key = invoice_key(self.path)
+        path = os.path.join(self.pages_dir, f'{os.path.basename(key)}.html')
+        if key == self.path or not os.path.isfile(path):
+            body, status = b'<html><body>Invoice not found</body></html>', 404
+        else:
+            with open(path, 'rb') as handle:
+                body, status = handle.read(), 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(pages_dir: str, host: str = '127.0.0.1', port: int = 0, delay_s: float = 0.0) -> ThreadingHTTPServer:
+    """Serve recorded KRA pages (`<invoiceNo>.html`) on a background thread."""
+    handler = type('StandinHandler', (_StandinHandler,), {'pages_dir': pages_dir, 'delay_s': delay_s})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def _scrape_command(args) -> int:
+    scraper = KRAScraper(
+        cache_path=None if args.no_cache else args.cache_path,
+        limit_per_host=args.limit_per_host,
+        base_url=args.base_url,
+    )
+    start = time.perf_counter()
+    try:
+        results = await scraper.scrape_many(args.urls)
+    finally:
+        await scraper.close()
+    for result in results:
+        print(json.dumps(result))
+    summary = {**scraper.stats(), 'elapsed_s': round(time.perf_counter() - start, 3)}
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0 if all(result['success'] for result in results) else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Scrape KRA eTIMS invoices, or serve recorded pages')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scrape = commands.add_parser('scrape', help='Look up eTIMS QR URLs (JSON line per URL)')
+    scrape.add_argument('urls', nargs='+')
+    scrape.add_argument('--cache-path', default=os.environ.get('PYTHON_PROCESSOR_KRA_CACHE_PATH', DEFAULT_KRA_CACHE_PATH))
+    scrape.add_argument('--no-cache', action='store_true')
+    scrape.add_argument('--limit-per-host', type=int, default=DEFAULT_LIMIT_PER_HOST)
+    scrape.add_argument('--base-url', default=os.environ.get('PYTHON_PROCESSOR_KRA_BASE_URL'),
+                        help='Send requests here instead of the KRA host (e.g. a stand-in)')
+
+    standin = commands.add_parser('standin', help='Serve recorded KRA pages over keep-alive HTTP')
+    standin.add_argument('--pages', required=True, help='Directory of <invoiceNo>.html files')
+    standin.add_argument('--host', default='127.0.0.1')
+    standin.add_argument('--port', type=int, default=8765)
+    standin.add_argument('--delay-ms', type=float, default=0.0, help='Simulated portal latency')
+
+    args = parser.parse_args(argv)
+    if args.command == 'scrape':
+        return asyncio.run(_scrape_command(args))
+
+    server = start_standin(args.pages, args.host, args.port, args.delay_ms / 1000)
+    print(f'[kra-standin] serving {args.pages} on http://{args.host}:{server.server_address[1]}', file=sys.stderr, flush=True)
+    with contextlib.suppress(KeyboardInterrupt):
+        threading.Event().wait()
+    server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
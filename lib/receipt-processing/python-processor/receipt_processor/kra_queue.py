@@ -0,0 +1,338 @@
+"""
+KRA VERIFICATION QUEUE
+
+Background KRA verification for uploads, so a slow KRA portal never holds up
+an upload response. The queue is the `raw_receipts` table itself (migration
+034): the orchestrator marks eTIMS receipts it could not verify within its
+inline budget as `kra_status = 'pending'`, and this worker verifies them.
+
+Workers claim due rows with `FOR UPDATE SKIP LOCKED`. Each claim carries a
+lease (`kra_claimed_until`), so several workers can run at once and rows held
+by a crashed worker are picked up again when the lease expires. Invoices are
+fetched through the pooled, cached scraper (kra.py), at most `--workers` at a
+time. A verified invoice is written to `raw_kra_data` with `kra_status =
+'verified'`. Failures are retried with exponential backoff and marked
+`failed` after `--max-attempts`.
+
+The verification also reaches the expense: the `expense_items` rows linked
+through `raw_receipt_id` get `kra_verified` and the invoice number, and the
+KRA amount and merchant replace the ones the upload saved from OCR. A value
+the user has since edited (it no longer matches the OCR value kept in the
+old `raw_kra_data`) is left alone. Report totals are recomputed with
+`update_report_total` (migration 025).
+
+Backlog depth and the age of the oldest pending receipt come from the
+`kra_verification_backlog` view. `run` logs them every `--report-s` seconds,
+and `backlog` prints them once.
+
+Usage:
+    python3 -m receipt_processor.kra_queue run [--workers 8] [--once]
+    python3 -m receipt_processor.kra_queue backlog
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import connect
+from .errors import ProcessorError
+from .kra import DEFAULT_KRA_CACHE_PATH, DEFAULT_LIMIT_PER_HOST, KRAScraper
+
+DEFAULT_WORKERS = 8
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_LEASE_S = 120
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_POLL_S = 5.0
+DEFAULT_REPORT_S = 60.0
+RETRY_BASE_S = 60  # doubled per attempt
+RETRY_MAX_S = 6 * 3600
+
+_CLAIM_SQL = """
+UPDATE raw_receipts
+SET kra_claimed_until = NOW() + make_interval(secs => %s),
+    kra_attempts = kra_attempts + 1
+WHERE id IN (
+    SELECT id FROM raw_receipts
+    WHERE kra_status = 'pending'
+      AND kra_next_attempt_at <= NOW()
+      AND (kra_claimed_until IS NULL OR kra_claimed_until < NOW())
+    ORDER BY kra_next_attempt_at
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id::text, etims_qr_url, kra_attempts
+"""
+
+_VERIFIED_SQL = """
+UPDATE raw_receipts AS r
+SET kra_status = 'verified',
+    raw_kra_data = %(kra_data)s::jsonb,
+    kra_verified_at = NOW(),
+    kra_claimed_until = NULL,
+    kra_last_error = NULL
+FROM (SELECT id, raw_kra_data FROM raw_receipts WHERE id = %(id)s FOR UPDATE) AS old
+WHERE r.id = old.id
+RETURNING old.raw_kra_data
+"""
+
+# Until then the expense holds what the upload saved: the OCR values, which
+# the old raw_kra_data still records. Anything else was edited by the user.
+_EXPENSE_SQL = """
+UPDATE expense_items
+SET kra_verified = TRUE,
+    kra_invoice_number = COALESCE(NULLIF(%(invoice_number)s, ''), kra_invoice_number),
+    amount = CASE
+      WHEN %(amount)s::numeric > 0 AND (COALESCE(amount, 0) = 0 OR amount = %(ocr_amount)s::numeric) THEN %(amount)s::numeric
+      ELSE amount
+    END,
+    merchant_name = CASE
+      WHEN %(merchant)s <> '' AND (merchant_name IS NULL OR merchant_name IN ('Unknown Merchant', %(ocr_merchant)s::text))
+        THEN %(merchant)s
+      ELSE merchant_name
+    END
+WHERE raw_receipt_id = %(id)s
+RETURNING report_id
+"""
+
+_FAILED_SQL = """
+UPDATE raw_receipts
+SET kra_status = %s,
+    kra_next_attempt_at = NOW() + make_interval(secs => %s),
+    kra_claimed_until = NULL,
+    kra_last_error = %s
+WHERE id = %s
+"""
+
+
+def backlog(conn) -> dict:
+    """Depth and age of the verification backlog (the kra_verification_backlog view)."""
+    cursor = conn.execute('SELECT * FROM kra_verification_backlog')
+    row = cursor.fetchone()
+    return {
+        column.name: float(value) if column.name.endswith('_s') else value
+        for column, value in zip(cursor.description, row)
+    }
+
+
+def retry_delay(attempts: int) -> int:
+    """Seconds before the next attempt after `attempts` failures."""
+    return min(RETRY_BASE_S * 2 ** max(attempts - 1, 0), RETRY_MAX_S)
+
+
+def expense_params(receipt_id: str, invoice: dict, ocr: dict | None) -> dict:
+    """Parameters of _EXPENSE_SQL for a verified invoice and the OCR data the upload saved."""
+    ocr = ocr or {}
+    ocr_amount = ocr.get('totalAmount')
+    return {
+        'id': receipt_id,
+        'invoice_number': invoice['invoice_number'],
+        'amount': invoice['total_amount'],
+        'merchant': invoice['merchant_name'].strip(),
+        'ocr_amount': ocr_amount if isinstance(ocr_amount, (int, float)) and not isinstance(ocr_amount, bool) else None,
+        'ocr_merchant': ocr.get('merchantName') if isinstance(ocr.get('merchantName'), str) else None,
+    }
+
+
+def kra_data(invoice: dict) -> dict:
+    """The invoice in the shape raw_kra_data holds (KRAInvoiceData in kra-scraper.ts)."""
+    return {
+        'invoiceNumber': invoice['invoice_number'],
+        'traderInvoiceNo': invoice['trader_invoice_no'],
+        'invoiceDate': invoice['invoice_date'],
+        'merchantName': invoice['merchant_name'],
+        'totalAmount': invoice['total_amount'],
+        'taxableAmount': invoice['taxable_amount'],
+        'vatAmount': invoice['vat_amount'],
+        'verified': invoice['verified'],
+        'scrapedAt': invoice['scraped_at'],
+    }
+
+
+class VerificationQueue:
+    """Claims pending receipts and verifies up to `workers` of them at a time.
+
+    Database calls are blocking psycopg calls on one connection, run on a
+    dedicated thread so the scraper's event loop keeps going.
+    """
+
+    def __init__(
+        self,
+        scraper: KRAScraper,
+        database_url: str | None = None,
+        workers: int = DEFAULT_WORKERS,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        lease_s: int = DEFAULT_LEASE_S,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.scraper = scraper
+        self.database_url = database_url
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.verified = 0
+        self.failed = 0  # receipts marked failed for good, not failed attempts
+        self.retried = 0
+        self._db = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kra-queue-db')
+        self._conn = None
+
+    async def run(self, once: bool = False, poll_s: float = DEFAULT_POLL_S, report_s: float = DEFAULT_REPORT_S) -> None:
+        """Verify until cancelled, or until nothing is due when `once`."""
+        tasks: set[asyncio.Task] = set()
+        reported_at = 0.0
+        try:
+            while True:
+                if time.monotonic() - reported_at >= report_s:
+                    reported_at = time.monotonic()
+                    print(json.dumps({'kra_queue': {**await self.backlog(), **self.stats()}}), file=sys.stderr, flush=True)
+
+                # Only claim what can start now, so leases are not spent waiting
+                free = self.workers - len(tasks)
+                rows = await self._call(self._claim, min(free, self.batch_size)) if free else []
+                for row in rows:
+                    task = asyncio.create_task(self._verify(*row))
+                    task.add_done_callback(tasks.discard)
+                    tasks.add(task)
+
+                if rows:
+                    continue
+                if once and not tasks:
+                    return
+                if tasks:
+                    await asyncio.wait(tasks, timeout=poll_s, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(poll_s)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def backlog(self) -> dict:
+        return await self._call(lambda: backlog(self._connection()))
+
+    def stats(self) -> dict:
+        return {'verified': self.verified, 'failed': self.failed, 'retried': self.retried, 'scraper': self.scraper.stats()}
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._db.submit(self._conn.close).result()
+        self._db.shutdown()
+
+    async def _verify(self, receipt_id: str, url: str | None, attempts: int) -> None:
+        try:
+            if not url:
+                raise ProcessorError('invalid_request', 'No eTIMS URL stored')
+            invoice, _ = await self.scraper.scrape(url)
+            await self._call(self._write_verified, receipt_id, invoice)
+        except ProcessorError as exc:
+            # A URL that is not a KRA invoice will never verify
+            final = attempts >= self.max_attempts or exc.error_type == 'invalid_request'
+            await self._reschedule(receipt_id, attempts, final, f'{exc.error_type}: {exc}')
+            return
+        except Exception as exc:
+            # A database error or a scraper bug: log it and retry the row like any failure
+            print(f'[kra-queue] verifying {receipt_id} failed: {exc!r}', file=sys.stderr, flush=True)
+            await self._reschedule(receipt_id, attempts, attempts >= self.max_attempts, f'{exc.__class__.__name__}: {exc}')
+            return
+        self.verified += 1
+
+    async def _reschedule(self, receipt_id: str, attempts: int, final: bool, error: str) -> None:
+        """Release the lease: retry after `retry_delay(attempts)`, or mark the row failed when `final`."""
+        if final:
+            self.failed += 1
+        else:
+            self.retried += 1
+        try:
+            await self._call(
+                self._execute, _FAILED_SQL,
+                ('failed' if final else 'pending', retry_delay(attempts), error, receipt_id),
+            )
+        except Exception as exc:
+            # The row stays leased and is claimed again when the lease expires
+            print(f'[kra-queue] rescheduling {receipt_id} failed: {exc!r}', file=sys.stderr, flush=True)
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db, function, *args)
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = connect(self.database_url)
+            self._conn.autocommit = True
+        return self._conn
+
+    def _claim(self, limit: int) -> list[tuple]:
+        return self._connection().execute(_CLAIM_SQL, (self.lease_s, limit)).fetchall()
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        self._connection().execute(sql, params)
+
+    def _write_verified(self, receipt_id: str, invoice: dict) -> None:
+        """Store the invoice and carry it into the linked expense items, in one transaction."""
+        conn = self._connection()
+        with conn.transaction():
+            row = conn.execute(_VERIFIED_SQL, {'id': receipt_id, 'kra_data': json.dumps(kra_data(invoice))}).fetchone()
+            if row is None:
+                return
+            reports = {
+                report_id
+                for (report_id,) in conn.execute(_EXPENSE_SQL, expense_params(receipt_id, invoice, row[0])).fetchall()
+                if report_id is not None
+            }
+            for report_id in reports:
+                conn.execute('SELECT update_report_total(%s)', (report_id,))
+
+
+async def _run_command(args) -> int:
+    scraper = KRAScraper(args.kra_cache_path, limit_per_host=args.limit_per_host, base_url=args.kra_base_url)
+    queue = VerificationQueue(
+        scraper,
+        database_url=args.database_url,
+        workers=args.workers,
+        lease_s=args.lease_s,
+        max_attempts=args.max_attempts,
+    )
+    try:
+        await queue.run(once=args.once, poll_s=args.poll_s, report_s=args.report_s)
+        print(json.dumps({'summary': {**await queue.backlog(), **queue.stats()}}), file=sys.stderr)
+    finally:
+        queue.close()
+        await scraper.close()
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Background KRA verification of uploaded receipts')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Verify pending receipts until stopped')
+    run.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Verifications in flight')
+    run.add_argument('--limit-per-host', type=int, default=DEFAULT_LIMIT_PER_HOST, help='Concurrent requests to the KRA portal')
+    run.add_argument('--lease-s', type=int, default=DEFAULT_LEASE_S)
+    run.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    run.add_argument('--poll-s', type=float, default=DEFAULT_POLL_S)
+    run.add_argument('--report-s', type=float, default=DEFAULT_REPORT_S, help='Seconds between backlog log lines')
+    run.add_argument('--once', action='store_true', help='Exit when nothing is due')
+    run.add_argument('--kra-cache-path', default=os.environ.get('PYTHON_PROCESSOR_KRA_CACHE_PATH', DEFAULT_KRA_CACHE_PATH))
+    run.add_argument('--kra-base-url', default=os.environ.get('PYTHON_PROCESSOR_KRA_BASE_URL'))
+
+    commands.add_parser('backlog', help='Print backlog depth and age')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        try:
+            return asyncio.run(_run_command(args))
+        except KeyboardInterrupt:
+            return 0
+
+    with connect(args.database_url) as conn:
+        print(json.dumps(backlog(conn), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+LINE ITEMS
+
+Turns the item block of a receipt's OCR text into columns: description,
+quantity, unit price, amount and KRA tax code. The TypeScript parsers keep
+only scalar totals (ocr-free.ts) or a list of `{name, amount}` objects
+(comprehensive-processor.ts); here each numeric column is one `array('d')`
+(8 bytes per value, NaN where a line has no quantity or unit price), so a
+200-line receipt is three small buffers rather than 200 dicts, and NumPy
+checks them without copying.
+
+Recognised layouts, one compiled regex each:
+
+    SUGAR 2KG              2 x 250.00     500.00 B
+    BREAD WHITE 400G                       65.00 A
+    MILK BROOKSIDE 500ML                             (description line)
+        3 @ 60.00                         180.00 B   (quantity line below it)
+    PMS               12.50 L @ 182.00  2,275.00
+
+Amounts must carry two decimals, which keeps phone numbers, PINs and till
+numbers out. Lines starting with a total, tax, payment or change keyword are
+skipped, and the block ends at the first TOTAL line carrying an amount.
+
+`check_totals` compares the items against the receipt total within the
+template's `validation.amountTolerance` (a fraction of the total) and flags
+rows where quantity x unit price is not the amount.
+
+Usage:
+    python3 -m receipt_processor.line_items receipt.txt [--total 1234.00]
+"""
+
+import argparse
+import json
+import math
+import re
+import sys
+from array import array
+from dataclasses import dataclass, field
+
+from .preprocess import np
+
+DEFAULT_AMOUNT_TOLERANCE = 0.01  # validation.amountTolerance in template-registry.ts
+ROW_TOLERANCE = 0.05  # currency units; qty x unit price is rounded on the receipt
+
+_NUMBER = r'\d{1,3}(?:,\d{3})+(?:\.\d{1,3})?|\d+(?:\.\d{1,3})?'
+_AMOUNT = r'-?(?:\d{1,3}(?:,\d{3})+|\d+)\.\d{2}'
+_UNIT = r'(?:L|LTRS?|LITRES?|KGS?|G|PCS?|EA)'
+_QUANTITY = rf'(?P<qty>{_NUMBER})\s*{_UNIT}?\s*[xX@*]\s*(?P<price>{_NUMBER})'
+_TAX = r'(?:\s+(?P<tax>[A-E]|[*#]))?'
+
+ITEM_LINE = re.compile(rf'^(?P<desc>.*?[A-Za-z].*?)\s+(?:{_QUANTITY}\s+)?(?P<amount>{_AMOUNT}){_TAX}$', re.I)
+QUANTITY_LINE = re.compile(rf'^{_QUANTITY}\s+(?P<amount>{_AMOUNT}){_TAX}$', re.I)
+DESCRIPTION_LINE = re.compile(r'^[A-Za-z][^\d]*(?:\d+\s*(?:ML|L|KG|G|PCS?)\b[^\d]*)*$', re.I)
+SUMMARY_LINE = re.compile(
+    r'^(?:SUB\s*TOTAL|TOTAL|VAT|TAX(?:ABLE)?|CASH|CHANGE|M-?PESA|CARD|BALANCE|ROUNDING|TENDERED|PAID|AMOUNT\s+DUE)\b',
+    re.I,
+)
+# "Total Kenya" in a header is a merchant, not the end of the items
+END_LINE = re.compile(rf'^(?:GRAND\s+|NET\s+)?TOTAL\b.*?{_AMOUNT}', re.I)
+
+
+def _number(text: str | None) -> float:
+    return float(text.replace(',', '')) if text else math.nan
+
+
+@dataclass
+class LineItems:
+    """Columnar line items; row i is `description[i]`, `qty[i]`, ... NaN marks a missing value."""
+    description: list[str] = field(default_factory=list)
+    qty: array = field(default_factory=lambda: array('d'))
+    unit_price: array = field(default_factory=lambda: array('d'))
+    amount: array = field(default_factory=lambda: array('d'))
+    tax_code: list[str | None] = field(default_factory=list)
+    line_no: array = field(default_factory=lambda: array('i'))
+
+    def __len__(self) -> int:
+        return len(self.amount)
+
+    def append(self, description: str, qty: float, unit_price: float, amount: float, tax_code: str | None, line_no: int) -> None:
+        self.description.append(description)
+        self.qty.append(qty)
+        self.unit_price.append(unit_price)
+        self.amount.append(amount)
+        self.tax_code.append(tax_code)
+        self.line_no.append(line_no)
+
+    def to_json(self) -> dict:
+        """Column lists for results and JSONB (NaN becomes null)."""
+        def column(values: array) -> list:
+            return [None if math.isnan(value) else value for value in values]
+
+        return {
+            'description': self.description,
+            'qty': column(self.qty),
+            'unit_price': column(self.unit_price),
+            'amount': list(self.amount),
+            'tax_code': self.tax_code,
+            'line_no': list(self.line_no),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'LineItems':
+        def column(values: list) -> array:
+            return array('d', (math.nan if value is None else value for value in values))
+
+        return cls(
+            description=list(data['description']),
+            qty=column(data['qty']),
+            unit_price=column(data['unit_price']),
+            amount=array('d', data['amount']),
+            tax_code=list(data['tax_code']),
+            line_no=array('i', data['line_no']),
+        )
+
+    def rows(self) -> zip:
+        """Row tuples `(line_no, description, qty, unit_price, amount, tax_code)` for bulk inserts."""
+        columns = self.to_json()
+        return zip(
+            columns['line_no'], columns['description'], columns['qty'],
+            columns['unit_price'], columns['amount'], columns['tax_code'],
+        )
+
+
+def extract_line_items(text: str) -> LineItems:
+    """Columnar line items from OCR text, in receipt order."""
+    items = LineItems()
+    pending: tuple[str, int] | None = None  # description line waiting for its quantity line
+
+    for line_no, raw in enumerate(text.split('\n')):
+        line = ' '.join(raw.split())
+        if not line:
+            continue
+        if END_LINE.match(line):
+            break
+
+        if pending:
+            match = QUANTITY_LINE.match(line)
+            if match:
+                description, description_line = pending
+                pending = None
+                items.append(
+                    description,
+                    _number(match['qty']),
+                    _number(match['price']),
+                    _number(match['amount']),
+                    (match['tax'] or '').upper() or None,
+                    description_line,
+                )
+                continue
+
+        if SUMMARY_LINE.match(line):
+            pending = None
+            continue
+        match = ITEM_LINE.match(line)
+        if match:
+            pending = None
+            items.append(
+                match['desc'].strip(),
+                _number(match['qty']),
+                _number(match['price']),
+                _number(match['amount']),
+                (match['tax'] or '').upper() or None,
+                line_no,
+            )
+        elif DESCRIPTION_LINE.match(line):
+            pending = (line, line_no)
+        else:
+            pending = None
+    return items
+
+
+def check_totals(items: LineItems, total: float | None, tolerance: float = DEFAULT_AMOUNT_TOLERANCE) -> dict | None:
+    """Vectorised consistency checks of `items` against the receipt `total`.
+
+    `within_tolerance` is True when the items sum to the total within
+    `tolerance` x total; `row_mismatches` lists rows whose qty x unit price
+    differs from their amount. None without NumPy or items.
+    """
+    if np is None or not len(items):
+        return None
+    amount = np.frombuffer(items.amount, dtype=np.float64)
+    qty = np.frombuffer(items.qty, dtype=np.float64)
+    unit_price = np.frombuffer(items.unit_price, dtype=np.float64)
+
+    items_total = round(float(amount.sum()), 2)
+    priced = ~(np.isnan(qty) | np.isnan(unit_price))
+    mismatched = priced & (np.abs(qty * unit_price - amount) > np.maximum(np.abs(amount) * tolerance, ROW_TOLERANCE))
+
+    check = {
+        'count': len(items),
+        'items_total': items_total,
+        'row_mismatches': np.flatnonzero(mismatched).tolist(),
+    }
+    if total:
+        difference = round(items_total - float(total), 2)
+        check['difference'] = difference
+        check['within_tolerance'] = abs(difference) <= max(abs(float(total)) * tolerance, ROW_TOLERANCE)
+    return check
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Extract columnar line items from OCR text')
+    parser.add_argument('path', help='OCR text file, or - for stdin')
+    parser.add_argument('--total', type=float, default=None, help='Receipt total to check the items against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_AMOUNT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    if args.path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.path, encoding='utf-8') as handle:
+            text = handle.read()
+    items = extract_line_items(text)
+    print(json.dumps({'line_items': items.to_json(), 'check': check_totals(items, args.total, args.tolerance)}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+MERCHANT NAME INDEX
+
+Fuzzy merchant-name lookup replacing StoreRecognizer.namesMatch (a full
+Levenshtein matrix per candidate store) and extractChainName (a hard-coded
+chain list checked with `includes`).
+
+Names are normalized the way namesMatch does it (lowercase, [a-z0-9] only)
+and indexed SymSpell-style: every string reachable by deleting up to
+MAX_DISTANCE characters from the first PREFIX_LENGTH characters maps back to
+the names that produced it. A query generates its own deletes, so candidates
+come from a few dozen dict probes instead of a scan, and only those are
+checked with a bounded edit distance that gives up as soon as the bound is
+exceeded.
+
+OCR lines carry more than the name ("TOTAL KENYA LTD JUNCTION"), so a query
+is also matched word-window by word-window; window hits are reported as
+`partial` (namesMatch's "one contains the other").
+
+Short names get fewer edits (len // 4): at two edits "kfc" would match any
+three-letter word.
+"""
+
+import re
+from dataclasses import dataclass
+from itertools import combinations
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+MAX_WINDOW_WORDS = 4
+DEFAULT_LIMIT = 5
+
+# extractChainName's list; chains seen in the stores table are added to it
+KNOWN_CHAINS = ('Total', 'Shell', 'Carrefour', 'Naivas', 'Quickmart', 'Chandarana')
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]')
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+@dataclass
+class NameMatch:
+    key: str
+    name: str
+    distance: int
+    partial: bool  # matched a run of words inside the query, not the whole query
+
+
+def normalize(name: str) -> str:
+    return _NON_ALNUM.sub('', name.lower())
+
+
+def allowed_distance(normalized: str, max_distance: int = MAX_DISTANCE) -> int:
+    return min(max_distance, len(normalized) // 4)
+
+
+def bounded_distance(a: str, b: str, bound: int) -> int | None:
+    """Levenshtein distance, or None as soon as it must exceed `bound`.
+
+    Shared prefixes/suffixes are skipped and only the diagonal band of width
+    2 * bound + 1 is filled, so a candidate costs O(len * bound).
+    """
+    if a == b:
+        return 0
+    if abs(len(a) - len(b)) > bound:
+        return None
+    if len(a) > len(b):
+        a, b = b, a
+
+    start = 0
+    while start < len(a) and a[start] == b[start]:
+        start += 1
+    end_a, end_b = len(a), len(b)
+    while end_a > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    a, b = a[start:end_a], b[start:end_b]
+    if not a:
+        return len(b)
+
+    over = bound + 1
+    previous = [i if i <= bound else over for i in range(len(a) + 1)]
+    for j, char_b in enumerate(b, 1):
+        current = [over] * (len(a) + 1)
+        current[0] = j if j <= bound else over
+        row_min = current[0]
+        for i in range(max(1, j - bound), min(len(a), j + bound) + 1):
+            cost = min(previous[i] + 1, current[i - 1] + 1, previous[i - 1] + (a[i - 1] != char_b))
+            current[i] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > bound:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= bound else None
+
+
+def _deletes(word: str, max_distance: int) -> set[str]:
+    prefix = word[:PREFIX_LENGTH]
+    variants = {prefix}
+    for count in range(1, min(max_distance, len(prefix)) + 1):
+        for positions in combinations(range(len(prefix)), count):
+            variants.add(''.join(char for index, char in enumerate(prefix) if index not in positions))
+    return variants
+
+
+class NameIndex:
+    """SymSpell-style index of names keyed by id. Re-adding a key replaces it."""
+
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._names: dict[str, tuple[str, str]] = {}  # key -> (name, normalized)
+        self._deletes: dict[str, set[str]] = {}
+        self._max_words = 1
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._names
+
+    def add(self, key: str, name: str) -> None:
+        self.remove(key)
+        normalized = normalize(name)
+        if not normalized:
+            return
+        self._names[key] = (name, normalized)
+        for variant in _deletes(normalized, self.max_distance):
+            self._deletes.setdefault(variant, set()).add(key)
+        self._max_words = min(MAX_WINDOW_WORDS, max(self._max_words, len(_WORD.findall(name.lower()))))
+
+    def remove(self, key: str) -> None:
+        entry = self._names.pop(key, None)
+        if entry is None:
+            return
+        for variant in _deletes(entry[1], self.max_distance):
+            keys = self._deletes.get(variant)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._deletes[variant]
+
+    def search(
+        self,
+        query: str,
+        limit: int = DEFAULT_LIMIT,
+        max_distance: int = MAX_DISTANCE,
+    ) -> list[NameMatch]:
+        """Top `limit` names within the edit bound of the query or of a run of its words."""
+        max_distance = min(max_distance, self.max_distance)
+        best: dict[str, NameMatch] = {}
+
+        whole = normalize(query)
+        words = _WORD.findall(query.lower())
+        probes = [(whole, False)]
+        for size in range(1, min(self._max_words, len(words)) + 1):
+            for start in range(len(words) - size + 1):
+                window = ''.join(words[start:start + size])
+                if window != whole:
+                    probes.append((window, True))
+
+        for probe, partial in probes:
+            bound = allowed_distance(probe, max_distance)
+            for key in self._candidates(probe, bound):
+                name, normalized = self._names[key]
+                distance = bounded_distance(probe, normalized, bound)
+                if distance is None:
+                    continue
+                match = NameMatch(key, name, distance, partial)
+                current = best.get(key)
+                if current is None or (distance, partial) < (current.distance, current.partial):
+                    best[key] = match
+
+        ranked = sorted(best.values(), key=lambda match: (match.distance, match.partial, -len(match.name), match.key))
+        return ranked[:limit]
+
+    def _candidates(self, probe: str, bound: int) -> set[str]:
+        if not probe:
+            return set()
+        keys: set[str] = set()
+        for variant in _deletes(probe, bound):
+            keys.update(self._deletes.get(variant, ()))
+        return keys
+
+
+class ChainIndex(NameIndex):
+    """Chain names, for extractChainName."""
+
+    def __init__(self, chains=KNOWN_CHAINS, max_distance: int = MAX_DISTANCE):
+        super().__init__(max_distance)
+        for chain in chains:
+            self.add_chain(chain)
+
+    def add_chain(self, chain: str) -> None:
+        key = normalize(chain)
+        if key and key not in self:
+            self.add(key, chain)
+
+    def extract(self, merchant_name: str) -> str | None:
+        """The chain named in `merchant_name` (fuzzily), or None."""
+        matches = self.search(merchant_name, limit=1)
+        if matches:
+            return matches[0].name
+        # Glued to other text ("TotalEnergies"): fall back to plain containment
+        normalized = normalize(merchant_name)
+        contained = [name for name, chain in self._names.values() if len(chain) >= 4 and chain in normalized]
+        return max(contained, key=len) if contained else None
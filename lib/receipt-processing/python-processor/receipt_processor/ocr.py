@@ -0,0 +1,109 @@
+"""
+OCR STAGE
+
+Runs Tesseract over the receipt image and parses the text with the same
+Kenyan receipt patterns the orchestrator applies to Google Vision output.
+"""
+
+import datetime
+import re
+
+try:
+    import pytesseract
+except ImportError:  # OCR is skipped when Tesseract bindings are not installed
+    pytesseract = None
+
+_AMOUNT = r'(\d+(?:,\d{3})*(?:\.\d{1,2})?)'
+_CURRENCY = r'(?:KES|KSH|Ksh)?'
+
+# Wide pattern set for Kenyan receipt formats (same order as orchestrator.ts)
+AMOUNT_PATTERNS = [
+    re.compile(rf'TOTAL\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'GRAND\s+TOTAL\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'NET\s+TOTAL\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'TOTAL\s+AMOUNT\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'AMOUNT\s+DUE\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'(?:CASH|MPESA|M-PESA|CARD)\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+    re.compile(rf'(?:KES|KSH|Ksh)\.?\s*{_AMOUNT}', re.I),
+    re.compile(r'(\d+(?:,\d{3})*\.\d{1,2})\s*(?:KES|KSH|Ksh)', re.I),
+    re.compile(rf'{_AMOUNT}\s*/='),
+    re.compile(rf'(?:Sum|Sub\s*Total|Subtotal)\s*[:\-]?\s*{_CURRENCY}\s*{_AMOUNT}', re.I),
+]
+
+DATE_PATTERN = re.compile(r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})')
+INVOICE_PATTERN = re.compile(r'Invoice\s+(?:Nr|No|Number|#)[:\s]*(\w+)', re.I)
+
+
+def extract_text(image) -> str | None:
+    """Run Tesseract over a PIL image, or None if Tesseract is unavailable."""
+    if pytesseract is None:
+        return None
+    text = pytesseract.image_to_string(image)
+    return text if text.strip() else None
+
+
+def parse_receipt_text(text: str, today: datetime.date | None = None) -> dict:
+    """Extract merchant, total, date and invoice number from OCR text."""
+    today = today or datetime.date.today()
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+
+    # Merchant is the line after "START OF LEGAL RECEIPT", else the first line
+    merchant_name = lines[0] if lines else 'Unknown Merchant'
+    for index, line in enumerate(lines[:-1]):
+        if 'START OF LEGAL RECEIPT' in line:
+            merchant_name = lines[index + 1]
+            break
+
+    total_amount = 0.0
+    for pattern in AMOUNT_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            total_amount = float(match.group(1).replace(',', ''))
+            if total_amount > 0:
+                break
+
+    invoice_date, date_needs_review, original_date = parse_receipt_date(text, today)
+    invoice_match = INVOICE_PATTERN.search(text)
+
+    return {
+        'merchant_name': merchant_name,
+        'total_amount': total_amount,
+        'invoice_date': invoice_date,
+        'invoice_number': invoice_match.group(1) if invoice_match else None,
+        'raw_text': text,
+        'date_needs_review': date_needs_review,
+        'original_date_ocr': original_date,
+    }
+
+
+def parse_receipt_date(text: str, today: datetime.date) -> tuple[str, bool, str | None]:
+    """Parse a DD/MM/YYYY date, fixing common OCR year errors.
+
+    Returns (iso_date, needs_review, original_ocr_text).
+    """
+    match = DATE_PATTERN.search(text)
+    if not match:
+        return today.isoformat(), True, None
+
+    original = match.group(1)
+    day, month, year = (int(part) for part in re.split(r'[-/]', original))
+    needs_review = False
+
+    if year > 2100:
+        # OCR read 2825 instead of 2025
+        needs_review = True
+        year = 2000 + year % 100
+    elif year < 100:
+        year = 2000 + year if year < 50 else 1900 + year
+
+    if year < today.year - 2 or year > today.year + 1:
+        needs_review = True
+        year = today.year
+    if not 1 <= month <= 12:
+        needs_review = True
+        month = today.month
+    if not 1 <= day <= 31:
+        needs_review = True
+        day = today.day
+
+    return f'{year}-{month:02d}-{day:02d}', needs_review, original
@@ -0,0 +1,447 @@
+"""
+TIERED OCR
+
+Runs OCR engines cheapest first and only escalates while the extracted
+fields are not good enough. The TypeScript stack picks one engine per
+template (`parserConfig.ocrEngine`: Tesseract, Gemini or Google Vision);
+here local Tesseract reads every receipt, and Google Vision and then Gemini
+only see the receipts Tesseract could not read.
+
+After each tier the text is parsed and scored (`field_confidence`): the
+generic fields (amount, merchant, date, invoice number) and the share of the
+best-matching template's fields that were found. The tier is accepted when
+the score reaches that template's `parserConfig.confidenceThreshold`
+(DEFAULT_CONFIDENCE_THRESHOLD otherwise). If no tier gets there, the
+best-scoring reading is kept.
+
+The cheapest tier, `roi`, runs Tesseract over part of the page only. A
+layout pass (preprocess.find_text_lines) finds the text lines, and the
+header and footer lines (merchant, invoice/till numbers, date; totals,
+payment, PIN, eTIMS block) are stacked into one small image, skipping the
+line items in between. A partial reading is only accepted when the matched
+template's required fields (`required`, or `required_for` its receipt type)
+were all extracted; on a miss the next tier reads the full page. On a long
+supermarket receipt this reads ~25 lines instead of 60+.
+
+Tiers come from a spec such as `roi,tesseract,vision,gemini`
+(PYTHON_PROCESSOR_OCR_TIERS). Remote engines are plain REST clients, and
+`name=URL` points one at another origin. `standin` serves both APIs locally
+from recorded texts, so tests and load runs need no API keys or quota.
+
+Every result lists the tiers it tried (`ocr_tiers`). TierStats aggregates
+them into per-tier hit rates: how often a tier was reached, and how often it
+was the one accepted.
+
+Usage:
+    python3 -m receipt_processor.ocr_tiers standin --texts recorded/ --port 8766
+    PYTHON_PROCESSOR_OCR_TIERS=tesseract,vision=http://127.0.0.1:8766 python3 -m receipt_processor.server
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .errors import ProcessorError
+from .imaging import array_to_image
+from .ocr import extract_text
+from .preprocess import find_text_lines, np
+
+DEFAULT_TIERS = 'roi,tesseract'
+DEFAULT_CONFIDENCE_THRESHOLD = 70  # AI_CONFIDENCE_THRESHOLD in the TypeScript stack
+REMOTE_TIMEOUT_S = 30
+
+ROI_HEADER_LINES = 8
+ROI_FOOTER_LINES = 16
+ROI_MIN_SKIPPED_LINES = 8  # shorter receipts go straight to the full-page tier
+ROI_PADDING = 3  # pixels above and below each line
+ROI_SEPARATOR = 8  # blank rows between stacked lines
+
+VISION_URL = 'https://vision.googleapis.com'
+GEMINI_URL = 'https://generativelanguage.googleapis.com'
+GEMINI_MODEL = 'gemini-2.5-flash'
+GEMINI_PROMPT = (
+    'Transcribe all text on this receipt exactly as printed, line by line, top to bottom. '
+    'Return only the text, with no commentary or formatting.'
+)
+
+
+class OCREngine(ABC):
+    """One OCR tier. `read` returns the text, or None when nothing was read.
+
+    A `partial` engine reads only part of the page, so its reading must also
+    contain the matched template's required fields to be accepted.
+    """
+
+    name = 'engine'
+    partial = False
+
+    @abstractmethod
+    def read(self, image, image_bytes: bytes) -> str | None:
+        """Text read from `image` (decoded) or `image_bytes` (as uploaded)."""
+
+
+class TesseractEngine(OCREngine):
+    """Local Tesseract over the preprocessed image (ocr.py)."""
+
+    name = 'tesseract'
+
+    def read(self, image, image_bytes: bytes) -> str | None:
+        return extract_text(image)
+
+
+class RegionEngine(OCREngine):
+    """Tesseract over the header and footer lines only (region-of-interest OCR)."""
+
+    name = 'roi'
+    partial = True
+
+    def __init__(
+        self,
+        header_lines: int = ROI_HEADER_LINES,
+        footer_lines: int = ROI_FOOTER_LINES,
+        min_skipped_lines: int = ROI_MIN_SKIPPED_LINES,
+    ):
+        self.header_lines = header_lines
+        self.footer_lines = footer_lines
+        self.min_skipped_lines = min_skipped_lines
+
+    def read(self, image, image_bytes: bytes) -> str | None:
+        if np is None:
+            return None
+        gray = np.asarray(image.convert('L'))
+        regions = self.regions(find_text_lines(gray))
+        if not regions:
+            return None
+        return extract_text(array_to_image(stack_regions(gray, regions)))
+
+    def regions(self, lines: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        """Header and footer lines, or [] when too few lines would be skipped to pay off."""
+        if len(lines) < self.header_lines + self.footer_lines + self.min_skipped_lines:
+            return []
+        return lines[:self.header_lines] + lines[-self.footer_lines:]
+
+
+def stack_regions(gray: 'np.ndarray', regions: list[tuple[int, int]]) -> 'np.ndarray':
+    """Stack padded row bands of `gray` into one image, separated by blank rows."""
+    separator = np.full((ROI_SEPARATOR, gray.shape[1]), 255, dtype=np.uint8)
+    parts = [separator]
+    for top, bottom in regions:
+        parts.append(gray[max(top - ROI_PADDING, 0):bottom + ROI_PADDING])
+        parts.append(separator)
+    return np.vstack(parts)
+
+
+class RemoteEngine(OCREngine):
+    """JSON-over-HTTPS engine; subclasses build the request and pick the text out."""
+
+    api_key_env = ''
+
+    def __init__(self, base_url: str | None = None, api_key: str | None = None, timeout: float = REMOTE_TIMEOUT_S):
+        self.base_url = (base_url or self.default_url).rstrip('/')
+        self.api_key = api_key if api_key is not None else os.environ.get(self.api_key_env, '')
+        self.timeout = timeout
+
+    def read(self, image, image_bytes: bytes) -> str | None:
+        path, payload = self.request(base64.b64encode(image_bytes).decode('ascii'))
+        url = f'{self.base_url}{path}?key={self.api_key}'
+        request = urllib.request.Request(
+            url,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = json.loads(response.read())
+        except urllib.error.HTTPError as exc:
+            raise ProcessorError('ocr_unavailable', f'{self.name} returned HTTP {exc.code}') from exc
+        except (OSError, ValueError) as exc:
+            raise ProcessorError('ocr_unavailable', f'{self.name} request failed: {exc}') from exc
+        text = self.text(body)
+        return text if text and text.strip() else None
+
+    @abstractmethod
+    def request(self, image_base64: str) -> tuple[str, dict]:
+        """`(path, JSON payload)` of the API call for a base64 image."""
+
+    @abstractmethod
+    def text(self, body: dict) -> str | None:
+        """The text in the API's JSON response."""
+
+
+class VisionEngine(RemoteEngine):
+    """Google Vision DOCUMENT_TEXT_DETECTION (extractWithGoogleVision in orchestrator.ts)."""
+
+    name = 'vision'
+    default_url = VISION_URL
+    api_key_env = 'GOOGLE_VISION_API_KEY'
+
+    def request(self, image_base64: str) -> tuple[str, dict]:
+        return '/v1/images:annotate', {
+            'requests': [{'image': {'content': image_base64}, 'features': [{'type': 'DOCUMENT_TEXT_DETECTION'}]}],
+        }
+
+    def text(self, body: dict) -> str | None:
+        responses = body.get('responses') or [{}]
+        return (responses[0].get('fullTextAnnotation') or {}).get('text')
+
+
+class GeminiEngine(RemoteEngine):
+    """Gemini transcription of the receipt (the model ocr-ai.ts uses)."""
+
+    name = 'gemini'
+    default_url = GEMINI_URL
+    api_key_env = 'GEMINI_API_KEY'
+
+    def request(self, image_base64: str) -> tuple[str, dict]:
+        return f'/v1beta/models/{GEMINI_MODEL}:generateContent', {
+            'contents': [{'parts': [
+                {'text': GEMINI_PROMPT},
+                {'inline_data': {'mime_type': 'image/jpeg', 'data': image_base64}},
+            ]}],
+        }
+
+    def text(self, body: dict) -> str | None:
+        candidates = body.get('candidates') or [{}]
+        parts = (candidates[0].get('content') or {}).get('parts') or []
+        return ''.join(part.get('text', '') for part in parts) or None
+
+
+ENGINES = {
+    'roi': RegionEngine,
+    'tesseract': TesseractEngine,
+    'vision': VisionEngine,
+    'gemini': GeminiEngine,
+}
+
+
+def build_tiers(spec: str | None = DEFAULT_TIERS) -> list[OCREngine]:
+    """Engines from a comma-separated spec, cheapest first: `tesseract,vision=http://127.0.0.1:8766`."""
+    tiers = []
+    for item in (spec or DEFAULT_TIERS).split(','):
+        name, _, base_url = item.strip().partition('=')
+        if name not in ENGINES:
+            raise ProcessorError('invalid_request', f'Unknown OCR engine: {name}')
+        if base_url and not issubclass(ENGINES[name], RemoteEngine):
+            raise ProcessorError('invalid_request', f'OCR engine {name} is local and takes no URL')
+        tiers.append(ENGINES[name](base_url) if base_url else ENGINES[name]())
+    return tiers
+
+
+def tiers_key(tiers: list[OCREngine]) -> str:
+    """Engine names in order (the spec without URLs), for cache namespaces: results depend on which tiers exist."""
+    return ','.join(tier.name for tier in tiers)
+
+
+def field_confidence(ocr_data: dict | None, template_fields: dict[str, dict], engine) -> tuple[int, str | None]:
+    """Score (0-100) the fields read from one OCR text, and the best-matching template.
+
+    The score is the better of the generic fields (amount 40, merchant,
+    date and invoice number 20 each) and the share of the best template's
+    fields that were found.
+    """
+    if not ocr_data:
+        return 0, None
+    generic = (
+        (40 if ocr_data.get('total_amount') else 0)
+        + (20 if ocr_data.get('merchant_name') not in (None, '', 'Unknown Merchant') else 0)
+        + (20 if not ocr_data.get('date_needs_review') else 0)
+        + (20 if ocr_data.get('invoice_number') else 0)
+    )
+    best_template, best_share = None, 0.0
+    for template_id, fields in template_fields.items():
+        share = len(fields) / max(len(engine.templates[template_id]), 1)
+        if share > best_share:
+            best_template, best_share = template_id, share
+    return max(generic, round(best_share * 100)), best_template
+
+
+def missing_required(fields: dict, template_id: str | None, engine) -> list[str]:
+    """Required fields of `template_id` absent from `fields` (a partial reading's miss test)."""
+    if template_id is None:
+        return []
+    return [name for name in engine.required_fields.get(template_id, []) if name not in fields]
+
+
+class TierStats:
+    """Per-tier hit rates aggregated from results' `ocr_tiers`."""
+
+    def __init__(self):
+        self.receipts = 0
+        self.tiers: dict[str, dict] = {}
+
+    def record(self, attempts: list[dict] | None) -> None:
+        if not attempts:
+            return
+        self.receipts += 1
+        for attempt in attempts:
+            stats = self.tiers.setdefault(attempt['engine'], {'attempts': 0, 'hits': 0, 'errors': 0, 'total_ms': 0})
+            stats['attempts'] += 1
+            stats['hits'] += bool(attempt.get('accepted'))
+            stats['errors'] += bool(attempt.get('error'))
+            stats['total_ms'] += attempt.get('ms', 0)
+
+    def stats(self) -> dict:
+        return {
+            'receipts': self.receipts,
+            'tiers': {
+                name: {
+                    'attempts': stats['attempts'],
+                    'hits': stats['hits'],
+                    'errors': stats['errors'],
+                    'hit_rate': round(stats['hits'] / stats['attempts'], 4) if stats['attempts'] else 0.0,
+                    'reach_rate': round(stats['attempts'] / self.receipts, 4) if self.receipts else 0.0,
+                    'avg_ms': round(stats['total_ms'] / stats['attempts']) if stats['attempts'] else 0,
+                }
+                for name, stats in self.tiers.items()
+            },
+        }
+
+
+def read_tiered(image, image_bytes: bytes, tiers: list[OCREngine], parse, engine) -> tuple[dict | None, dict, list[dict]]:
+    """Run tiers until one reaches its template's confidence threshold.
+
+    `parse(text)` turns text into `(ocr_data, template_fields)`. Returns the
+    best reading's `(ocr_data, template_fields)` and the per-tier attempts:
+    the accepted one, else the most confident full-page reading, and a
+    rejected partial reading only when no full-page tier read anything.
+    """
+    attempts: list[dict] = []
+    best: tuple[tuple, dict | None, dict] = ((False, False, -1), None, {})
+    for tier in tiers:
+        start = time.perf_counter()
+        attempt = {'engine': tier.name}
+        try:
+            text = tier.read(image, image_bytes)
+        except ProcessorError as exc:
+            text = None
+            attempt['error'] = str(exc)
+        ocr_data, template_fields = parse(text) if text else (None, {})
+        confidence, template_id = field_confidence(ocr_data, template_fields, engine)
+        threshold = engine.confidence_thresholds.get(template_id, DEFAULT_CONFIDENCE_THRESHOLD)
+        accepted = confidence >= threshold
+        if tier.partial:
+            missing = missing_required(template_fields.get(template_id, {}), template_id, engine)
+            attempt['missing'] = missing
+            accepted = accepted and not missing
+        attempt.update(
+            confidence=confidence,
+            threshold=threshold,
+            accepted=accepted,
+            ms=round((time.perf_counter() - start) * 1000),
+        )
+        attempts.append(attempt)
+        rank = (accepted, bool(ocr_data) and not tier.partial, confidence)
+        if rank > best[0]:
+            if ocr_data and tier.partial:
+                ocr_data['partial'] = True  # the item block was not read (line_items.py)
+            best = (rank, ocr_data, template_fields)
+        if attempt['accepted']:
+            break
+    return best[1], best[2], attempts
+
+
+class _StandinHandler(BaseHTTPRequestHandler):
+    """Google Vision and Gemini endpoints answering from `<sha256 of image>.txt`."""
+
+    protocol_version = 'HTTP/1.1'
+    texts_dir = '.'
+    delay_s = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length))
+            if ':generateContent' in self.path:
+                parts = payload['contents'][0]['parts']
+                image = next(part['inline_data']['data'] for part in parts if 'inline_data' in part)
+            else:
+                image = payload['requests'][0]['image']['content']
+            image_hash = hashlib.sha256(base64.b64decode(image)).hexdigest()
+        except (ValueError, KeyError, IndexError, StopIteration):
+            self._send(400, {'error': {'message': 'Malformed request'}})
+            return
+
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        try:
+            with open(os.path.join(self.texts_dir, f'{image_hash}.txt'), encoding='utf-8') as handle:
+                text = handle.read()
+        except OSError:
+            text = ''
+
+        if ':generateContent' in self.path:
+            body = {'candidates': [{'content': {'parts': [{'text': text}]}}]}
+        else:
+            body = {'responses': [{'fullTextAnnotation': {'text': text}} if text else {}]}
+        self._send(200, body)
+
+    def _send(self, status: int, body: dict) -> None:
+        encoded = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(texts_dir: str, host: str = '127.0.0.1', port: int = 0, delay_s: float = 0.0) -> ThreadingHTTPServer:
+    """Serve recorded OCR texts (`<sha256 of image>.txt`) as Vision and Gemini on a background thread."""
+    handler = type('StandinHandler', (_StandinHandler,), {'texts_dir': texts_dir, 'delay_s': delay_s})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Tiered OCR engines')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    standin = commands.add_parser('standin', help='Serve recorded texts as the Vision and Gemini APIs')
+    standin.add_argument('--texts', required=True, help='Directory of <sha256 of image>.txt files')
+    standin.add_argument('--host', default='127.0.0.1')
+    standin.add_argument('--port', type=int, default=8766)
+    standin.add_argument('--delay-ms', type=int, default=0, help='Simulated engine latency')
+
+    read = commands.add_parser('read', help='Run the tiers over images and print what each tier read')
+    read.add_argument('images', nargs='+')
+    read.add_argument('--tiers', default=os.environ.get('PYTHON_PROCESSOR_OCR_TIERS', DEFAULT_TIERS))
+    args = parser.parse_args(argv)
+
+    if args.command == 'standin':
+        server = start_standin(args.texts, args.host, args.port, args.delay_ms / 1000)
+        print(f'[ocr-standin] serving {args.texts} on http://{args.host}:{server.server_address[1]}', file=sys.stderr, flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    from .pipeline import process_receipt
+
+    tiers = build_tiers(args.tiers)
+    stats = TierStats()
+    for path in args.images:
+        with open(path, 'rb') as handle:
+            result = process_receipt(handle.read(), always_ocr=True, ocr_tiers=tiers)
+        stats.record(result.get('ocr_tiers'))
+        print(json.dumps({'path': path, 'ocr_tiers': result.get('ocr_tiers'), 'parsed_data': result.get('parsed_data')}))
+    print(json.dumps({'summary': stats.stats()}), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
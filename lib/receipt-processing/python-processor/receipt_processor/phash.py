@@ -0,0 +1,222 @@
+"""
+PERCEPTUAL HASH DUPLICATE INDEX
+
+`raw_receipts.image_hash` (SHA-256) only catches byte-identical uploads. The
+same receipt photographed twice, or recompressed by WhatsApp, hashes
+differently but looks the same, so every processed image also gets a 64-bit
+perceptual hash (DCT pHash of the grayscale plane). Near-duplicates are
+images whose hashes differ in only a few bits.
+
+DuplicateIndex answers "which stored receipts are within N bits of this
+hash?" without scanning every hash. It uses multi-index hashing: the 64-bit
+hash is split into four 16-bit chunks, each with its own bucket table. Two
+hashes within distance r must agree to within r // 4 bits on at least one
+chunk (pigeonhole), so a query only probes the buckets near each of its four
+chunks and popcounts that short candidate list. At the default radius that
+is 4 x 17 bucket lookups, which stays sub-millisecond at millions of entries.
+
+The server's index is persisted as an append-only JSON-lines log. With
+`max_entries` it keeps only the newest uploads: past the cap the oldest
+quarter is dropped and the log is rewritten, so neither memory nor the file
+grows without bound.
+"""
+
+import json
+import os
+import tempfile
+from itertools import combinations
+
+from .imaging import Image, array_to_image
+from .preprocess import np
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Recompressed/resized copies land within a few bits. Receipts from the same
+# till share a layout, so keep the radius tight and treat hits as "possible
+# duplicate" warnings, as findDuplicates does for byte-identical uploads.
+DEFAULT_RADIUS = 6
+MAX_RADIUS = 15  # wider radii probe thousands of buckets per chunk; use a scan instead
+DEFAULT_MAX_ENTRIES = 1_000_000  # ~200 MB resident; re-uploads come within weeks, not years
+
+_DCT_SIZE = 32
+_LOW_FREQ = 8
+
+
+def _dct_matrix(size: int) -> 'np.ndarray':
+    k = np.arange(size)[:, None]
+    i = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(_DCT_SIZE) if np is not None else None
+
+
+def phash(gray: 'np.ndarray') -> int:
+    """64-bit DCT perceptual hash of a uint8 grayscale plane.
+
+    The image is reduced to 32x32, transformed, and the 8x8 lowest
+    frequencies are thresholded against their median (DC term excluded).
+    """
+    small = np.asarray(array_to_image(gray).resize((_DCT_SIZE, _DCT_SIZE), Image.BOX), dtype=np.float32)
+    low = (_DCT @ small @ _DCT.T)[:_LOW_FREQ, :_LOW_FREQ].ravel()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def dhash(gray: 'np.ndarray') -> int:
+    """64-bit difference hash: sign of horizontal gradients on a 9x8 reduction."""
+    small = np.asarray(array_to_image(gray).resize((9, 8), Image.BOX), dtype=np.int16)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def format_hash(value: int) -> str:
+    return f'{value:016x}'
+
+
+def parse_hash(text: str) -> int:
+    value = int(text, 16)
+    if value >> HASH_BITS:
+        raise ValueError(f'Perceptual hash is wider than {HASH_BITS} bits: {text}')
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _neighbours(chunk: int, distance: int):
+    """Yield every CHUNK_BITS value within `distance` bits of `chunk`."""
+    for flips in range(distance + 1):
+        for positions in combinations(range(CHUNK_BITS), flips):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            yield chunk ^ mask
+
+
+class DuplicateIndex:
+    """Multi-index hash table of 64-bit perceptual hashes.
+
+    Entries are `(key, hash, scope)`; `key` is whatever identifies the stored
+    receipt (image SHA-256 for the server, row id for the bulk job) and
+    `scope` limits matches to one owner. When `path` is given, entries are
+    loaded from it and every add is appended to it as a JSON line. With
+    `max_entries`, the oldest entries are evicted in batches (`_compact`).
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int | None = None):
+        self.path = path
+        self.max_entries = max_entries
+        self._keys: list[str] = []
+        self._hashes: list[int] = []
+        self._scopes: list[str | None] = []
+        self._rows: set[tuple[str, str | None]] = set()
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(CHUNKS)]
+        self._log = None
+
+        if path:
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as handle:
+                    for line in handle:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self._insert(entry['key'], parse_hash(entry['hash']), entry.get('scope'))
+            if max_entries and len(self._keys) > max_entries:
+                self._compact(max_entries)
+            self._log = open(path, 'a', encoding='utf-8')
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, entry: tuple[str, str | None]) -> bool:
+        return entry in self._rows
+
+    def add(self, key: str, value: int, scope: str | None = None) -> bool:
+        """Index a hash under `key`. Returns False if `(key, scope)` is already indexed."""
+        if (key, scope) in self._rows:
+            return False
+        self._insert(key, value, scope)
+        if self._log is not None:
+            self._log.write(json.dumps({'key': key, 'hash': format_hash(value), 'scope': scope}) + '\n')
+            self._log.flush()
+        if self.max_entries and len(self._keys) > self.max_entries:
+            # Evicting a quarter at a time keeps the rewrite cost per add constant
+            self._compact(self.max_entries * 3 // 4)
+        return True
+
+    def query(
+        self,
+        value: int,
+        radius: int = DEFAULT_RADIUS,
+        scope: str | None = None,
+        limit: int | None = None,
+    ) -> list[tuple[str, int]]:
+        """Return `(key, distance)` for indexed hashes within `radius` bits, closest first."""
+        if not 0 <= radius <= MAX_RADIUS:
+            raise ValueError(f'radius must be between 0 and {MAX_RADIUS}')
+        probe = radius // CHUNKS
+        seen: set[int] = set()
+        matches = []
+
+        for index, table in enumerate(self._tables):
+            chunk = (value >> (index * CHUNK_BITS)) & CHUNK_MASK
+            for neighbour in _neighbours(chunk, probe):
+                for row in table.get(neighbour, ()):
+                    if row in seen:
+                        continue
+                    seen.add(row)
+                    if scope is not None and self._scopes[row] != scope:
+                        continue
+                    distance = (self._hashes[row] ^ value).bit_count()
+                    if distance <= radius:
+                        matches.append((self._keys[row], distance))
+
+        matches.sort(key=lambda match: match[1])
+        return matches[:limit] if limit else matches
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _compact(self, keep: int) -> None:
+        """Keep only the newest `keep` entries, rebuilding the tables and rewriting the log."""
+        entries = list(zip(self._keys, self._hashes, self._scopes))[-keep:]
+        self._keys, self._hashes, self._scopes = [], [], []
+        self._rows = set()
+        self._tables = [{} for _ in range(CHUNKS)]
+        for key, value, scope in entries:
+            self._insert(key, value, scope)
+        if not self.path:
+            return
+
+        reopen = self._log is not None
+        self.close()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.phash-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                for key, value, scope in entries:
+                    handle.write(json.dumps({'key': key, 'hash': format_hash(value), 'scope': scope}) + '\n')
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if reopen:
+            self._log = open(self.path, 'a', encoding='utf-8')
+
+    def _insert(self, key: str, value: int, scope: str | None) -> None:
+        row = len(self._keys)
+        self._keys.append(key)
+        self._hashes.append(value)
+        self._scopes.append(scope)
+        self._rows.add((key, scope))
+        for index, table in enumerate(self._tables):
+            chunk = (value >> (index * CHUNK_BITS)) & CHUNK_MASK
+            table.setdefault(chunk, []).append(row)
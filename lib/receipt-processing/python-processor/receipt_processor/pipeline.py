@@ -0,0 +1,196 @@
+"""
+RECEIPT PROCESSING PIPELINE
+
+Server-side counterpart of orchestrator.ts for a single image:
+decode -> preprocess -> QR -> OCR -> parse -> validate. Storage, KRA
+verification and store recognition stay in the TypeScript orchestrator.
+"""
+
+import hashlib
+import time
+
+from .derivatives import DEFAULT_DERIVATIVES_DIR, derive, needs_original
+from .extraction import TemplateEngine, qr_payload
+from .imaging import array_to_image, load_image
+from .line_items import DEFAULT_AMOUNT_TOLERANCE, check_totals, extract_line_items
+from .ocr import parse_receipt_text
+from .ocr_tiers import OCREngine, build_tiers, read_tiered
+from .phash import format_hash, phash
+from .preprocess import np, preprocess_receipt_image
+from .qr import detect_qr, is_etims_url
+from .version import PROCESSOR_VERSION, STAGE_VERSIONS
+
+# Built-in templates, used when the caller does not pass a snapshot engine
+template_engine = TemplateEngine()
+# Local Tesseract (regions of interest, then full page), used when the caller does not pass OCR tiers
+default_tiers: list[OCREngine] = build_tiers()
+# Used by `full_page_ocr` when every configured tier is partial
+full_page_tiers: list[OCREngine] = build_tiers('tesseract')
+
+
+def process_receipt(
+    image_bytes: bytes,
+    mobile_qr_url: str | None = None,
+    always_ocr: bool = False,
+    full_page_ocr: bool = False,
+    image_hash: str | None = None,
+    engine: TemplateEngine | None = None,
+    ocr_tiers: list[OCREngine] | None = None,
+    derivatives: bool = False,
+    derivatives_dir: str = DEFAULT_DERIVATIVES_DIR,
+) -> dict:
+    """Process one receipt image and return the JSON-serialisable result.
+
+    A valid eTIMS QR code short-circuits OCR: KRA verification of the QR URL
+    is authoritative, so OCR only runs when no eTIMS QR was found or the
+    caller sets `always_ocr`. OCR escalates through `ocr_tiers` (ocr_tiers.py)
+    until the fields read reach the matched template's confidence threshold.
+    Line items are only extracted from a full-page reading; `full_page_ocr`
+    skips the partial `roi` tier so the item block is always read.
+    With `derivatives`, storage and thumbnail copies are made from the same
+    decoded image (derivatives.py).
+    """
+    start = time.perf_counter()
+    warnings: list[str] = []
+
+    image = load_image(image_bytes)
+    prepared = preprocess_receipt_image(image) if np is not None else None
+
+    # Mobile ML Kit QR is authoritative when present (see orchestrator.ts)
+    if mobile_qr_url:
+        qr_data = {
+            'url': mobile_qr_url,
+            'raw_text': mobile_qr_url,
+            'is_etims_qr': is_etims_url(mobile_qr_url),
+            'source': 'mobile_mlkit',
+        }
+    else:
+        qr_data = detect_qr(image, prepared.gray if prepared else None)
+
+    ocr_skipped = bool(qr_data and qr_data.get('is_etims_qr')) and not always_ocr
+    engine = engine or template_engine
+    qr_fields = qr_payload(qr_data.get('raw_text')) if qr_data else None
+
+    def parse(text: str) -> tuple[dict, dict]:
+        return parse_receipt_text(text), engine.extract_all(ocr_text=text, qr_data=qr_fields)
+
+    ocr_data = None
+    ocr_attempts: list[dict] = []
+    if ocr_skipped:
+        template_fields = engine.extract_all(qr_data=qr_fields)
+    else:
+        # Tesseract reads the contrast-enhanced, sharpened plane when NumPy is
+        # available; remote engines get the original upload
+        ocr_image = array_to_image(prepared.enhanced) if prepared else image
+        tiers = ocr_tiers or default_tiers
+        if full_page_ocr:
+            tiers = [tier for tier in tiers if not tier.partial] or full_page_tiers
+        ocr_data, template_fields, ocr_attempts = read_tiered(ocr_image, image_bytes, tiers, parse, engine)
+        if ocr_data is None:
+            template_fields = engine.extract_all(qr_data=qr_fields)
+            warnings.append('No text extracted from receipt')
+
+    parsed_data = generic_parse(qr_data, ocr_data)
+    status, confidence = assess_result(qr_data, ocr_data, parsed_data, warnings)
+    template_fields = {template_id: fields for template_id, fields in template_fields.items() if fields}
+
+    # Line items need the full page; a region-of-interest reading skips the item block
+    line_items = line_item_check = None
+    if ocr_data and not ocr_data.get('partial'):
+        items = extract_line_items(ocr_data['raw_text'])
+        if len(items):
+            matched = max(template_fields, key=lambda template_id: len(template_fields[template_id]), default=None)
+            tolerance = engine.amount_tolerances.get(matched, DEFAULT_AMOUNT_TOLERANCE)
+            line_items = items.to_json()
+            line_item_check = check_totals(items, parsed_data.get('total_amount'), tolerance)
+
+    stages = ['parse']
+    if prepared is not None:
+        stages.append('preprocess')
+    if not mobile_qr_url:
+        stages.append('qr')
+    if not ocr_skipped:
+        stages.append('ocr')
+    template_versions = engine.template_versions()
+    image_hash = image_hash or hashlib.sha256(image_bytes).hexdigest()
+
+    result = {
+        'success': True,
+        'image_hash': image_hash,
+        'image_width': image.width,
+        'image_height': image.height,
+        'perceptual_hash': format_hash(phash(prepared.gray)) if prepared else None,
+        'qr_data': qr_data,
+        'ocr_data': ocr_data,
+        'ocr_skipped': ocr_skipped,
+        'ocr_tiers': ocr_attempts,
+        'parsed_data': parsed_data,
+        'template_fields': template_fields,
+        'line_items': line_items,
+        'line_item_check': line_item_check,
+        'template_version': engine.version,
+        # What produced this result, for selective re-extraction (reextract.py)
+        'versions': {
+            'processor': PROCESSOR_VERSION,
+            'stages': {stage: STAGE_VERSIONS[stage] for stage in sorted(stages)},
+            'templates': {template_id: template_versions[template_id] for template_id in template_fields},
+        },
+        'status': status,
+        'confidence': confidence,
+        'warnings': warnings,
+    }
+    if derivatives:
+        result['derivatives'] = derive(image, image_bytes, image_hash, derivatives_dir)
+        result['keep_original'] = needs_original(result)
+    result['processing_time_ms'] = round((time.perf_counter() - start) * 1000)
+    return result
+
+
+def generic_parse(qr_data: dict | None, ocr_data: dict | None) -> dict:
+    """Generic parsing fallback: QR fields first, then OCR fields."""
+    qr_data = qr_data or {}
+    ocr_data = ocr_data or {}
+    return {
+        'merchant_name': qr_data.get('merchant_name') or ocr_data.get('merchant_name'),
+        'total_amount': qr_data.get('total_amount') or ocr_data.get('total_amount'),
+        'invoice_number': qr_data.get('invoice_number') or ocr_data.get('invoice_number'),
+        'date': qr_data.get('date_time') or ocr_data.get('invoice_date'),
+    }
+
+
+def assess_result(
+    qr_data: dict | None,
+    ocr_data: dict | None,
+    parsed_data: dict,
+    warnings: list[str],
+) -> tuple[str, int]:
+    """Compute (status, confidence) using the orchestrator's validation rules.
+
+    An eTIMS QR counts as extracted data: merchant and amount come from the
+    KRA verification the caller performs on the QR URL.
+    """
+    has_etims = bool(qr_data and qr_data.get('is_etims_qr'))
+    has_amount = has_etims or bool(parsed_data.get('total_amount'))
+    has_merchant = has_etims or bool(parsed_data.get('merchant_name'))
+
+    if not has_amount:
+        warnings.append('Amount not detected')
+    if not has_merchant:
+        warnings.append('Merchant name not detected')
+    if ocr_data and ocr_data.get('date_needs_review'):
+        warnings.append(
+            f"Date uncertain (OCR: {ocr_data.get('original_date_ocr') or 'none'}) - please verify"
+        )
+
+    scores = []
+    if qr_data:
+        scores.append(100)
+    if ocr_data:
+        scores.append(85)
+    confidence = round(sum(scores) / len(scores)) if scores else 0
+
+    if not has_amount and not has_merchant:
+        return 'failed', confidence
+    if confidence < 60 or warnings:
+        return 'needs_review', confidence
+    return 'success', confidence
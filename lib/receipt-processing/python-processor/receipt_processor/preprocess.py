@@ -0,0 +1,150 @@
+"""
+RECEIPT IMAGE PREPROCESSOR
+
+NumPy port of image-preprocessor.ts. Every step works on whole arrays
+instead of per-pixel loops, and the QR/text regions are row slices (views)
+of the enhanced image, so splitting a receipt copies no pixel data.
+
+- Grayscale (luminosity method)
+- Contrast stretch around mid-grey
+- 3x3 sharpen
+- Adaptive (local mean) threshold
+- QR region = bottom 25%, text region = top 75%
+- Text lines from a row projection profile (layout pass for ROI OCR)
+"""
+
+from dataclasses import dataclass
+
+try:
+    import numpy as np
+except ImportError:  # preprocessing is skipped when NumPy is not installed
+    np = None
+
+QR_REGION_START = 0.75  # QR codes sit in the bottom ~25% of Kenyan receipts
+CONTRAST_FACTOR = 1.5
+LINE_INK_FRACTION = 0.02  # share of dark pixels that makes a row part of a text line
+LINE_MAX_GAP = 2  # rows; closes gaps inside a line (dots, descenders)
+LINE_MIN_HEIGHT = 4
+LINE_MAX_HEIGHT_RATIO = 3.0  # bands taller than this x the median line are logos/QR codes
+
+_LUMA = (0.299, 0.587, 0.114)
+
+
+@dataclass
+class ProcessedReceiptImage:
+    """Preprocessed receipt planes (uint8, H x W). Regions are views into `enhanced`."""
+    gray: 'np.ndarray'
+    enhanced: 'np.ndarray'
+    qr_region: 'np.ndarray'
+    text_region: 'np.ndarray'
+
+
+def preprocess_receipt_image(image) -> ProcessedReceiptImage:
+    """Enhance a PIL image and segment it for the QR and OCR stages."""
+    gray = to_grayscale(np.asarray(image))
+    enhanced = sharpen(stretch_contrast(gray))
+    qr_region, text_region = split_regions(enhanced)
+    return ProcessedReceiptImage(gray, enhanced, qr_region, text_region)
+
+
+def to_grayscale(pixels: 'np.ndarray') -> 'np.ndarray':
+    """RGB(A) or L array -> uint8 luminosity grayscale."""
+    if pixels.ndim == 2:
+        return pixels.astype(np.uint8, copy=False)
+    weights = np.asarray(_LUMA, dtype=np.float32)
+    return (pixels[..., :3] @ weights).astype(np.uint8)
+
+
+def stretch_contrast(gray: 'np.ndarray', factor: float = CONTRAST_FACTOR) -> 'np.ndarray':
+    """Stretch contrast around 128 via a 256-entry lookup table."""
+    levels = np.arange(256, dtype=np.float32)
+    lut = np.clip((levels - 128) * factor + 128, 0, 255).astype(np.uint8)
+    return lut[gray]
+
+
+def sharpen(gray: 'np.ndarray') -> 'np.ndarray':
+    """Apply the [0,-1,0; -1,5,-1; 0,-1,0] kernel; border pixels are kept as-is."""
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return gray.copy()
+
+    src = gray.astype(np.int16)
+    out = gray.copy()
+    center = src[1:-1, 1:-1]
+    result = (
+        5 * center
+        - src[:-2, 1:-1]
+        - src[2:, 1:-1]
+        - src[1:-1, :-2]
+        - src[1:-1, 2:]
+    )
+    out[1:-1, 1:-1] = np.clip(result, 0, 255)
+    return out
+
+
+def adaptive_threshold(gray: 'np.ndarray', block_size: int = 31, offset: float = 10) -> 'np.ndarray':
+    """Binarise against the local mean of a `block_size` window (integral image).
+
+    Handles uneven lighting on thermal receipts far better than a global
+    threshold. Text becomes 0, paper becomes 255.
+    """
+    height, width = gray.shape
+    radius = block_size // 2
+
+    integral = np.zeros((height + 1, width + 1), dtype=np.float64)
+    integral[1:, 1:] = gray.cumsum(axis=0, dtype=np.float64).cumsum(axis=1)
+
+    rows = np.arange(height)
+    cols = np.arange(width)
+    y0 = np.clip(rows - radius, 0, height)
+    y1 = np.clip(rows + radius + 1, 0, height)
+    x0 = np.clip(cols - radius, 0, width)
+    x1 = np.clip(cols + radius + 1, 0, width)
+
+    window_sum = (
+        integral[np.ix_(y1, x1)]
+        - integral[np.ix_(y0, x1)]
+        - integral[np.ix_(y1, x0)]
+        + integral[np.ix_(y0, x0)]
+    )
+    area = np.outer(y1 - y0, x1 - x0)
+    local_mean = window_sum / area
+
+    return np.where(gray > local_mean - offset, 255, 0).astype(np.uint8)
+
+
+def split_regions(pixels: 'np.ndarray', qr_start: float = QR_REGION_START) -> tuple['np.ndarray', 'np.ndarray']:
+    """Return (qr_region, text_region) as zero-copy row slices."""
+    split = int(pixels.shape[0] * qr_start)
+    return pixels[split:], pixels[:split]
+
+
+def find_text_lines(gray: 'np.ndarray', scale: int = 2) -> list[tuple[int, int]]:
+    """Row ranges `(top, bottom)` of the text lines in a receipt, top to bottom.
+
+    A layout pass, not OCR: the image is subsampled by `scale`, binarised
+    against its local mean and each row's share of dark pixels is taken.
+    Runs of inked rows are lines; bands much taller than the median line
+    (logos, QR codes) are dropped.
+    """
+    small = gray[::scale, ::scale]
+    if small.shape[0] < 3 or small.shape[1] < 3:
+        return []
+    ink = (adaptive_threshold(small, block_size=15) == 0).mean(axis=1) > LINE_INK_FRACTION
+
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], ink.astype(np.int8), [0]))))
+    bands: list[list[int]] = []
+    for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+        if bands and start - bands[-1][1] <= LINE_MAX_GAP:
+            bands[-1][1] = end
+        else:
+            bands.append([start, end])
+    bands = [band for band in bands if (band[1] - band[0]) * scale >= LINE_MIN_HEIGHT]
+    if not bands:
+        return []
+
+    median = float(np.median([end - start for start, end in bands]))
+    return [
+        (start * scale, min(end * scale, gray.shape[0]))
+        for start, end in bands
+        if end - start <= median * LINE_MAX_HEIGHT_RATIO
+    ]
@@ -0,0 +1,64 @@
+"""
+Wire protocol between the Next.js route and the processor server.
+
+Each message is a frame: a 4-byte big-endian length followed by that many
+bytes. A request is a UTF-8 JSON header frame, followed by one raw binary body
+frame when the header sets `"body": true` (the image bytes, never base64).
+Images can also be handed over by path (`"image_path"`) when the caller has
+already written them to a temp file. Each request gets one JSON response frame.
+"""
+
+import asyncio
+import json
+import struct
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes | None:
+    """Read one frame, or None if the peer closed the connection cleanly."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as exc:
+        if exc.partial:
+            raise ConnectionError('Connection closed mid-header') from exc
+        return None
+
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f'Frame of {length} bytes exceeds limit of {MAX_FRAME_BYTES}')
+    return await reader.readexactly(length)
+
+
+async def write_frame(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    """Write one frame and wait for the transport to drain."""
+    writer.write(HEADER.pack(len(payload)))
+    writer.write(payload)
+    await writer.drain()
+
+
+def encode_json(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(payload: bytes) -> dict:
+    message = json.loads(payload)
+    if not isinstance(message, dict):
+        raise ValueError('Request frame must contain a JSON object')
+    return message
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[dict, bytes | None] | None:
+    """Read a header frame and its optional binary body frame."""
+    payload = await read_frame(reader)
+    if payload is None:
+        return None
+
+    header = decode_json(payload)
+    body = None
+    if header.get('body'):
+        body = await read_frame(reader)
+        if body is None:
+            raise ConnectionError('Connection closed before request body')
+    return header, body
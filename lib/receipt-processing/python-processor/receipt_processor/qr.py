@@ -0,0 +1,167 @@
+"""
+QR CODE STAGE
+
+Python port of qr-decoder.ts: decodes the receipt QR code and classifies it as
+a KRA eTIMS verification URL or structured key/value data.
+
+Detection is multi-resolution: the cheap downscaled bottom crop (where eTIMS
+QR codes are printed) is tried first, and larger scales and the full frame
+only run when the cheaper attempts find nothing.
+"""
+
+import json
+import re
+
+from .imaging import array_to_image
+from .preprocess import split_regions
+
+try:
+    from pyzbar import pyzbar
+    from pyzbar.pyzbar import ZBarSymbol
+except ImportError:  # QR decoding is skipped when zbar is not installed
+    pyzbar = None
+    ZBarSymbol = None
+
+ETIMS_MARKERS = ('itax.kra.go.ke', 'etims.kra.go.ke', 'kra.go.ke/verify')
+
+# (region, max long edge in px) — None means native resolution
+QR_LADDER = (
+    ('bottom', 800),
+    ('bottom', None),
+    ('full', 1600),
+    ('full', None),
+)
+
+
+def is_etims_url(text: str) -> bool:
+    """Check if QR text is a KRA/eTIMS verification URL."""
+    return any(marker in text for marker in ETIMS_MARKERS)
+
+
+def decode_qr(image) -> dict | None:
+    """Decode the first QR code in a PIL image, or None if none is found."""
+    if pyzbar is None:
+        return None
+
+    for symbol in pyzbar.decode(image, symbols=[ZBarSymbol.QRCODE]):
+        text = symbol.data.decode('utf-8', errors='replace')
+        if text:
+            return build_qr_data(text)
+    return None
+
+
+def detect_qr(image, gray=None) -> dict | None:
+    """Walk QR_LADDER from cheapest to most expensive, stopping at the first hit.
+
+    `gray` is the preprocessed grayscale plane; when given, the bottom region
+    is a zero-copy slice of it instead of a PIL crop. The winning rung is
+    recorded in `qr_stage` (e.g. "bottom@800").
+    """
+    if pyzbar is None:
+        return None
+
+    tried: set[tuple[str, tuple[int, int]]] = set()
+    for region, max_edge in QR_LADDER:
+        candidate = _downscale(_region(image, gray, region), max_edge)
+        key = (region, candidate.size)
+        if key in tried:
+            continue  # image already smaller than this rung's limit
+        tried.add(key)
+
+        qr_data = decode_qr(candidate)
+        if qr_data:
+            qr_data['qr_stage'] = f"{region}@{max_edge or 'native'}"
+            return qr_data
+    return None
+
+
+def _region(image, gray, region: str):
+    if region == 'full':
+        return image if gray is None else array_to_image(gray)
+    if gray is not None:
+        qr_region, _ = split_regions(gray)
+        return array_to_image(qr_region)
+    width, height = image.size
+    return image.crop((0, int(height * 0.75), width, height))
+
+
+def _downscale(image, max_edge: int | None):
+    if max_edge is None or max(image.size) <= max_edge:
+        return image
+    scale = max_edge / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+
+
+def build_qr_data(text: str) -> dict:
+    """Build the QR result for decoded text (mirrors QRCodeData in qr-decoder.ts)."""
+    if is_etims_url(text):
+        return {
+            'raw_text': text,
+            'url': text,
+            'is_etims_qr': True,
+            'source': 'qr_code',
+            'confidence': 100,
+        }
+
+    return {
+        'raw_text': text,
+        'url': text if text.startswith(('http://', 'https://')) else None,
+        'is_etims_qr': False,
+        **parse_qr_data(text),
+        'source': 'qr_code',
+        'confidence': 100,
+    }
+
+
+def parse_qr_data(text: str) -> dict:
+    """Parse structured QR payloads (JSON or `KEY=value` pairs)."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict):
+        return _drop_empty({
+            'invoice_number': data.get('invoice') or data.get('invoiceNumber') or data.get('inv'),
+            'merchant_pin': data.get('pin') or data.get('merchantPIN') or data.get('tax_id'),
+            'merchant_name': data.get('merchant') or data.get('name') or data.get('business'),
+            'total_amount': _to_float(data.get('amount') or data.get('total') or data.get('totalAmount')),
+            'date_time': data.get('date') or data.get('dateTime') or data.get('timestamp'),
+            'till_number': data.get('till') or data.get('tillNumber'),
+            'receipt_number': data.get('receipt') or data.get('receiptNumber'),
+        })
+
+    parsed = {}
+    for pair in re.split(r'[,;|]', text):
+        key, _, value = re.sub(r'[=:]', '=', pair, count=1).partition('=')
+        key, value = key.strip().lower(), value.strip()
+        if not key or not value:
+            continue
+
+        if 'inv' in key:
+            parsed['invoice_number'] = value
+        if 'pin' in key or 'tax' in key:
+            parsed['merchant_pin'] = value
+        if 'merch' in key or 'name' in key:
+            parsed['merchant_name'] = value
+        if 'amt' in key or 'amount' in key or 'total' in key:
+            parsed['total_amount'] = _to_float(value)
+        if 'date' in key or 'time' in key:
+            parsed['date_time'] = value
+        if 'till' in key:
+            parsed['till_number'] = value
+        if 'receipt' in key or 'rcpt' in key:
+            parsed['receipt_number'] = value
+
+    return _drop_empty(parsed)
+
+
+def _to_float(value) -> float | None:
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return None
+
+
+def _drop_empty(data: dict) -> dict:
+    return {key: value for key, value in data.items() if value is not None}
@@ -0,0 +1,158 @@
+"""
+SELECTIVE RE-EXTRACTION PLANNER
+
+Decides which processed receipts an extraction change actually affects, so
+a parser or template fix re-runs on those receipts instead of the whole
+corpus. Every result is stamped with the stages it ran and the templates
+that extracted fields from it (`versions`, stored in
+raw_receipts.extraction_versions by backfill.py). A receipt is selected when:
+
+- a stage it ran has a different version in STAGE_VERSIONS (version.py);
+  receipts that skipped the stage (OCR on eTIMS early exit) are left alone,
+- a template that extracted fields from it has been edited or removed,
+- a template that extracted nothing from it now extracts fields from its
+  stored OCR text (a new template, or a pattern that now matches); only for
+  receipts that ran OCR, since an eTIMS early exit keeps older OCR text
+  that reprocessing would not use, or
+- it was processed before stamping existed.
+
+The last two checks run the current templates over `raw_ocr_text`, which is
+cheap: no image is downloaded and only templates missing from the stamp run.
+
+The plan is written as JSON lines (`{"id": ..., "reasons": [...]}`) with a
+summary on stderr. `--apply` sets `reextract_requested_at` (migration 036) on
+the selected rows so `backfill --planned` reprocesses exactly those.
+
+Usage:
+    python3 -m receipt_processor.reextract [--output plan.jsonl]
+    python3 -m receipt_processor.reextract --apply && python3 -m receipt_processor.backfill --planned
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Iterable, Iterator
+
+from .db import connect
+from .extraction import TemplateEngine
+from .snapshot import DEFAULT_SNAPSHOT_PATH, SnapshotLoader
+from .version import STAGE_VERSIONS
+
+FETCH_SIZE = 10_000
+APPLY_BATCH_SIZE = 1_000
+
+
+def fetch_stamps(database_url: str | None = None) -> Iterator[tuple[str, dict | None, str | None]]:
+    """Stream `(id, extraction_versions, raw_ocr_text)` for processed rows with a server-side cursor."""
+    with connect(database_url) as conn:
+        with conn.cursor(name='reextract_raw_receipts') as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(
+                'SELECT id::text, extraction_versions, raw_ocr_text FROM raw_receipts '
+                'WHERE processor_version IS NOT NULL ORDER BY created_at'
+            )
+            yield from cursor
+
+
+def receipt_reasons(versions: dict | None, ocr_text: str | None, engine: TemplateEngine) -> list[str]:
+    """Why a receipt stamped with `versions` needs re-extraction (empty: it does not)."""
+    if not versions:
+        return ['unstamped']
+
+    reasons = [
+        f'stage:{stage}'
+        for stage, version in sorted(versions.get('stages', {}).items())
+        if STAGE_VERSIONS.get(stage) != version
+    ]
+
+    current = engine.template_versions()
+    stamped = versions.get('templates', {})
+    reasons.extend(
+        f'template:{template_id}'
+        for template_id, version in sorted(stamped.items())
+        if current.get(template_id) != version
+    )
+
+    # Without an OCR stage (eTIMS early exit) the stored text is not what the
+    # pipeline extracts from, so a match there would re-queue the row forever
+    if ocr_text and 'ocr' in versions.get('stages', {}):
+        scan = None
+        for template_id in sorted(current):
+            if template_id in stamped:
+                continue
+            scan = scan or engine.scan(ocr_text)
+            if engine.extract(template_id, scan=scan):
+                reasons.append(f'new_match:{template_id}')
+    return reasons
+
+
+def plan(rows: Iterable[tuple[str, dict | None, str | None]], engine: TemplateEngine) -> Iterator[dict]:
+    """Yield `{id, reasons}` for every row that needs re-extraction."""
+    for row_id, versions, ocr_text in rows:
+        reasons = receipt_reasons(versions, ocr_text, engine)
+        if reasons:
+            yield {'id': row_id, 'reasons': reasons}
+
+
+def requeue(ids: list[str], database_url: str | None = None) -> int:
+    """Mark `ids` with reextract_requested_at so `backfill --planned` picks them up."""
+    updated = 0
+    with connect(database_url) as conn:
+        for start in range(0, len(ids), APPLY_BATCH_SIZE):
+            cursor = conn.execute(
+                'UPDATE raw_receipts SET reextract_requested_at = NOW() WHERE id = ANY(%s::uuid[])',
+                (ids[start:start + APPLY_BATCH_SIZE],),
+            )
+            updated += cursor.rowcount
+    return updated
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Plan re-extraction of receipts affected by stage or template changes')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    parser.add_argument('--templates', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH))
+    parser.add_argument('--output', default='-', help='JSON-lines plan (default: stdout)')
+    parser.add_argument('--apply', action='store_true', help='Re-queue the selected receipts for backfill --planned')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    engine = SnapshotLoader(args.templates).engine()
+    scanned = 0
+    selected: list[str] = []
+    reasons: Counter[str] = Counter()
+
+    def counted(rows):
+        nonlocal scanned
+        for row in rows:
+            scanned += 1
+            yield row
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        for entry in plan(counted(fetch_stamps(args.database_url)), engine):
+            selected.append(entry['id'])
+            reasons.update(entry['reasons'])
+            output.write(json.dumps(entry) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    summary = {
+        'scanned': scanned,
+        'selected': len(selected),
+        'selected_fraction': round(len(selected) / scanned, 4) if scanned else 0.0,
+        'reasons': dict(reasons.most_common()),
+        'template_version': engine.version,
+        'elapsed_s': round(time.perf_counter() - start, 3),
+    }
+    if args.apply:
+        summary['requeued'] = requeue(selected, args.database_url)
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
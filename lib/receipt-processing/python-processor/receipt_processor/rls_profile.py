@@ -0,0 +1,263 @@
+"""
+RLS POLICY COST PROFILER
+
+Measures what row-level security costs the hot query shapes, on the seeded
+local database from loadtest.py (`setup` then `seed`), and ranks the
+policies by the cost they add. The workspace and member policies have been
+rewritten in migrations 004, 006, 008, 013, 020, 022 and 026; this shows
+which of the current ones need an index or a SECURITY DEFINER helper (like
+is_workspace_member) behind their subqueries.
+
+Shapes: report listing, the enrichReports items fetch, receipt listing, the
+legacy stats queries, the user_stats_monthly rollup that replaced them and
+find_stores_nearby (loadtest.SHAPES). Each runs
+`--repeat` times under `EXPLAIN (ANALYZE, BUFFERS)`, once as `authenticated`
+with the user's JWT claims (RLS applies) and once with only the claims set
+as the connecting superuser (RLS bypassed). The median execution times,
+their difference and the buffers touched are reported.
+
+Policies: for every permissive SELECT policy of `--tables` that applies to
+`authenticated`, a rolled-back transaction drops the table's other permissive
+policies and times `SELECT count(*)` as the user. The baseline is the same
+table with a single `USING (true)` policy, so the difference is the cost of
+that policy alone, including RLS on any table its subqueries read. Plans are
+walked for per-row subplans that sequentially scan a table (index hint) or
+read an RLS-enabled table (helper hint).
+
+Nothing is committed. Run it against the load-test database only.
+
+Usage:
+    python3 -m receipt_processor.rls_profile [--user loadtest_0000001] [--repeat 5]
+    python3 -m receipt_processor.rls_profile --plans-dir ./plans
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+from .errors import ProcessorError
+from .loadtest import NAIROBI, SHAPES, USER_PREFIX, connect_local, impersonate
+
+try:
+    from psycopg import sql
+except ImportError:  # connect() reports the missing dependency
+    sql = None
+
+DEFAULT_REPEAT = 5
+DEFAULT_TABLES = ('expense_reports', 'expense_items', 'workspaces', 'workspace_members', 'stores', 'user_stats_monthly')
+BASELINE_POLICY = 'rls_profile_baseline'
+NEARBY_RADIUS_M = 500
+
+HOT_SHAPES = (
+    'list_reports',
+    'list_reports.items',
+    'list_receipts',
+    'stats_legacy.month_total',
+    'stats_legacy.month_count',
+    'stats_legacy.total_amount',
+    'stats.rollup',
+    'stores.nearby',
+)
+
+_HEAVIEST_USER_SQL = f"""
+SELECT user_id FROM expense_reports WHERE user_id LIKE '{USER_PREFIX}%'
+GROUP BY user_id ORDER BY COUNT(*) DESC, user_id LIMIT 1
+"""
+
+_POLICIES_SQL = """
+SELECT policyname, permissive FROM pg_policies
+WHERE schemaname = 'public' AND tablename = %s
+  AND cmd IN ('SELECT', 'ALL')
+  AND roles && ARRAY['authenticated', 'public']::name[]
+ORDER BY policyname
+"""
+
+_RLS_TABLES_SQL = """
+SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public' AND c.relrowsecurity
+"""
+
+
+def shape_params(conn, user_id: str) -> dict:
+    """Parameters for every hot shape, as the routes would send them for `user_id`."""
+    month_start = date.today().replace(day=1)
+    with conn.transaction(force_rollback=True):
+        impersonate(conn, user_id)
+        report_ids = [row[0] for row in conn.execute(SHAPES['list_reports']).fetchall()]
+    return {
+        'report_ids': report_ids,
+        'month_start': month_start,
+        'next_month_start': (month_start + timedelta(days=32)).replace(day=1),
+        'lat': NAIROBI[0],
+        'lng': NAIROBI[1],
+        'radius_m': NEARBY_RADIUS_M,
+    }
+
+
+def heaviest_user(conn) -> str:
+    """The seeded user with the most reports: the worst case for per-row policies."""
+    row = conn.execute(_HEAVIEST_USER_SQL).fetchone()
+    if row is None:
+        raise ProcessorError('invalid_request', 'No load-test users: run `loadtest setup` and `loadtest seed` first')
+    return row[0]
+
+
+def explain(conn, query, params: dict | None = None) -> dict:
+    """`EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` of `query`: the root plan plus its timings."""
+    if isinstance(query, str):
+        query = sql.SQL(query)
+    result = conn.execute(sql.SQL('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ') + query, params).fetchone()[0][0]
+    plan = result['Plan']
+    return {
+        'execution_ms': result['Execution Time'],
+        'planning_ms': result['Planning Time'],
+        'rows': plan['Actual Rows'],
+        'shared_hit': plan.get('Shared Hit Blocks', 0),
+        'shared_read': plan.get('Shared Read Blocks', 0),
+        'plan': plan,
+    }
+
+
+def median_run(runs: list[dict]) -> dict:
+    """The run with the median execution time (keeping its plan and buffers)."""
+    return sorted(runs, key=lambda run: run['execution_ms'])[len(runs) // 2]
+
+
+def findings(plan: dict, rls_tables: set[str]) -> list[str]:
+    """Hints from subplans that run per outer row: seq scans (index) and RLS-protected reads (helper)."""
+    hints = []
+
+    def walk(node: dict, in_subplan: bool) -> None:
+        in_subplan = in_subplan or node.get('Parent Relationship') in ('SubPlan', 'InitPlan')
+        relation = node.get('Relation Name')
+        loops = node.get('Actual Loops', 1)
+        if in_subplan and relation:
+            if node['Node Type'] == 'Seq Scan' and loops > 1:
+                hints.append(f'index: {relation} is scanned sequentially {loops}x, filter {node.get("Filter", "-")}')
+            if relation in rls_tables:
+                hints.append(f'helper: {relation} is read under its own RLS inside the policy ({loops}x)')
+        for child in node.get('Plans', ()):
+            walk(child, in_subplan)
+
+    walk(plan, False)
+    return sorted(set(hints))
+
+
+def profile_shapes(conn, user_id: str, repeat: int = DEFAULT_REPEAT, shapes=HOT_SHAPES) -> list[dict]:
+    """Per shape: median execution with RLS, without, and the difference. Slowest overhead first."""
+    params = shape_params(conn, user_id)
+    rls_tables = {row[0] for row in conn.execute(_RLS_TABLES_SQL)}
+    results = []
+    for shape in shapes:
+        # psycopg rejects parameters for a query without placeholders (stats.rollup)
+        shape_args = params if '%(' in SHAPES[shape] else None
+        measured = {}
+        for mode, role in (('rls', 'authenticated'), ('bypass', None)):
+            runs = []
+            for _ in range(repeat):
+                with conn.transaction(force_rollback=True):
+                    impersonate(conn, user_id, role)
+                    runs.append(explain(conn, SHAPES[shape], shape_args))
+            measured[mode] = median_run(runs)
+        rls, bypass = measured['rls'], measured['bypass']
+        results.append({
+            'shape': shape,
+            'rls_ms': round(rls['execution_ms'], 3),
+            'bypass_ms': round(bypass['execution_ms'], 3),
+            'overhead_ms': round(rls['execution_ms'] - bypass['execution_ms'], 3),
+            'rows': rls['rows'],
+            'rows_bypass': bypass['rows'],
+            'shared_hit': rls['shared_hit'],
+            'shared_read': rls['shared_read'],
+            'hints': findings(rls['plan'], rls_tables),
+            'plan': rls['plan'],
+        })
+    return sorted(results, key=lambda result: result['overhead_ms'], reverse=True)
+
+
+def _count_with_policies(conn, user_id: str, table: str, drop: list[str], baseline: bool) -> dict:
+    """Time `count(*)` on `table` as the user after dropping `drop` (and adding a `true` policy)."""
+    table_id = sql.Identifier(table)
+    with conn.transaction(force_rollback=True):
+        for name in drop:
+            conn.execute(sql.SQL('DROP POLICY {} ON {}').format(sql.Identifier(name), table_id))
+        if baseline:
+            conn.execute(sql.SQL('CREATE POLICY {} ON {} FOR SELECT TO authenticated USING (true)').format(
+                sql.Identifier(BASELINE_POLICY), table_id))
+        impersonate(conn, user_id)
+        return explain(conn, sql.SQL('SELECT count(*) FROM {}').format(table_id))
+
+
+def profile_policies(conn, user_id: str, tables=DEFAULT_TABLES, repeat: int = DEFAULT_REPEAT) -> list[dict]:
+    """Cost each permissive SELECT policy adds over a `USING (true)` baseline. Most expensive first."""
+    rls_tables = {row[0] for row in conn.execute(_RLS_TABLES_SQL)}
+    results = []
+    for table in tables:
+        if table not in rls_tables:
+            continue
+        permissive = [name for name, mode in conn.execute(_POLICIES_SQL, (table,)) if mode == 'PERMISSIVE']
+        if not permissive:
+            continue
+        baseline = median_run([_count_with_policies(conn, user_id, table, permissive, True) for _ in range(repeat)])
+        scanned = max(baseline['rows'], 1)
+        for policy in permissive:
+            others = [name for name in permissive if name != policy]
+            measured = median_run([_count_with_policies(conn, user_id, table, others, False) for _ in range(repeat)])
+            added_ms = measured['execution_ms'] - baseline['execution_ms']
+            results.append({
+                'table': table,
+                'policy': policy,
+                'added_ms': round(added_ms, 3),
+                'added_us_per_row': round(added_ms * 1000 / scanned, 3),
+                'rows_scanned': baseline['rows'],
+                'rows_visible': measured['plan']['Plans'][0]['Actual Rows'] if measured['plan'].get('Plans') else None,
+                'shared_hit': measured['shared_hit'],
+                'shared_read': measured['shared_read'],
+                'hints': findings(measured['plan'], rls_tables),
+                'plan': measured['plan'],
+            })
+    return sorted(results, key=lambda result: result['added_ms'], reverse=True)
+
+
+def write_plans(plans_dir: str, profile: dict) -> None:
+    """One JSON plan file per shape and policy."""
+    os.makedirs(plans_dir, exist_ok=True)
+    entries = [(f'shape-{entry["shape"]}', entry) for entry in profile['shapes']]
+    entries += [(f'policy-{entry["table"]}-{entry["policy"]}', entry) for entry in profile['policies']]
+    for name, entry in entries:
+        safe_name = ''.join(char if char.isalnum() or char in '.-_' else '_' for char in name)
+        with open(os.path.join(plans_dir, f'{safe_name}.json'), 'w', encoding='utf-8') as handle:
+            json.dump(entry['plan'], handle, indent=2)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Rank RLS policies by the cost they add to hot query shapes')
+    parser.add_argument('--database-url', default=None, help='Local load-test Postgres (default: as loadtest.py)')
+    parser.add_argument('--allow-remote', action='store_true', help='Allow a non-local server (never production)')
+    parser.add_argument('--user', default=None, help='User to act as (default: the seeded user with the most reports)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Runs per measurement; the median is kept')
+    parser.add_argument('--tables', default=','.join(DEFAULT_TABLES), help='Tables whose policies are ranked')
+    parser.add_argument('--plans-dir', default=None, help='Also write every JSON plan here')
+    args = parser.parse_args(argv)
+
+    with connect_local(args.database_url, args.allow_remote) as conn:
+        user_id = args.user or heaviest_user(conn)
+        profile = {
+            'user_id': user_id,
+            'shapes': profile_shapes(conn, user_id, args.repeat),
+            'policies': profile_policies(conn, user_id, args.tables.split(','), args.repeat),
+        }
+
+    if args.plans_dir:
+        write_plans(args.plans_dir, profile)
+    for entries in (profile['shapes'], profile['policies']):
+        for entry in entries:
+            del entry['plan']
+    print(json.dumps(profile, indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+USER STATS ROLLUP
+
+Checks and repairs `user_stats_monthly` (migration 037), the per user,
+workspace and month totals that /api/mobile/stats reads. Triggers on
+expense_items and expense_reports keep the table up to date in the same
+transaction as each change; this job is the safety net for anything they
+cannot see (restores, bulk loads with triggers disabled, TRUNCATE).
+
+`verify` recomputes every rollup from scratch (the
+`user_stats_monthly_expected` view) and diffs it against the table in one
+REPEATABLE READ snapshot, so in-flight writes never show up as mismatches.
+Both sides are streamed in key order and merged, so memory stays constant
+however many users there are. Each mismatch is written as a JSON line.
+
+`--repair` adds the difference (expected - stored) through
+`user_stats_apply`, the function the triggers use. Deltas commute with
+whatever the triggers apply concurrently, so no table lock is needed.
+Rows left at zero are deleted.
+
+Usage:
+    python3 -m receipt_processor.rollup verify --database-url "$DATABASE_URL"
+    python3 -m receipt_processor.rollup verify --repair
+"""
+
+import argparse
+import json
+import sys
+import time
+from decimal import Decimal
+from typing import Iterator
+
+from .db import connect
+
+FETCH_SIZE = 10_000
+COUNTERS = ('item_count', 'total_amount', 'report_count')
+
+# "C" collation and NULLS FIRST match Python's tuple ordering of the keys
+_ROLLUP_QUERY = (
+    'SELECT user_id, workspace_id::text, month, item_count, total_amount, report_count FROM {table} '
+    'ORDER BY user_id COLLATE "C", workspace_id NULLS FIRST, month'
+)
+
+
+def _stream(conn, name: str, table: str) -> Iterator[tuple[tuple, tuple]]:
+    """Yield `(key, counters)` from `table` in key order with a server-side cursor."""
+    with conn.cursor(name=name) as cursor:
+        cursor.itersize = FETCH_SIZE
+        cursor.execute(_ROLLUP_QUERY.format(table=table))
+        for user_id, workspace_id, month, *counters in cursor:
+            yield (user_id, workspace_id or '', month), tuple(counters)
+
+
+def diff_rollups(expected: Iterator[tuple[tuple, tuple]], stored: Iterator[tuple[tuple, tuple]]) -> Iterator[dict]:
+    """Merge two key-ordered streams and yield one dict per key whose counters differ.
+
+    A key missing on one side counts as all zeros there.
+    """
+    zero = (0, Decimal(0), 0)
+    expected_row, stored_row = next(expected, None), next(stored, None)
+    while expected_row or stored_row:
+        if stored_row is None or (expected_row and expected_row[0] < stored_row[0]):
+            key, want, have = expected_row[0], expected_row[1], zero
+            expected_row = next(expected, None)
+        elif expected_row is None or stored_row[0] < expected_row[0]:
+            key, want, have = stored_row[0], zero, stored_row[1]
+            stored_row = next(stored, None)
+        else:
+            key, want, have = expected_row[0], expected_row[1], stored_row[1]
+            expected_row, stored_row = next(expected, None), next(stored, None)
+        if want != have:
+            yield {
+                'user_id': key[0],
+                'workspace_id': key[1] or None,
+                'month': key[2].isoformat(),
+                'expected': dict(zip(COUNTERS, want)),
+                'stored': dict(zip(COUNTERS, have)),
+            }
+
+
+def verify(conn) -> Iterator[dict]:
+    """Mismatches between the recomputed and stored rollups, from one consistent snapshot."""
+    conn.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+    try:
+        yield from diff_rollups(
+            _stream(conn, 'rollup_expected', 'user_stats_monthly_expected'),
+            _stream(conn, 'rollup_stored', 'user_stats_monthly'),
+        )
+    finally:
+        conn.execute('COMMIT')
+
+
+def repair(conn, mismatches: list[dict]) -> int:
+    """Apply expected - stored for each mismatch and drop rows left at zero. Returns rows deleted."""
+    with conn.transaction():
+        with conn.cursor() as cursor:
+            cursor.executemany(
+                'SELECT user_stats_apply(%s, %s, %s, %s, %s, %s)',
+                [
+                    (
+                        mismatch['user_id'], mismatch['workspace_id'], mismatch['month'],
+                        *(mismatch['expected'][name] - mismatch['stored'][name] for name in COUNTERS),
+                    )
+                    for mismatch in mismatches
+                ],
+            )
+            cursor.execute(
+                'DELETE FROM user_stats_monthly WHERE item_count = 0 AND total_amount = 0 AND report_count = 0'
+            )
+            return cursor.rowcount
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Verify and repair the user_stats_monthly rollup')
+    parser.add_argument('--database-url', default=None, help='Postgres URL (default: $DATABASE_URL)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    verify_command = commands.add_parser('verify', help='Recompute rollups from scratch and diff them with the table')
+    verify_command.add_argument('--repair', action='store_true', help='Correct mismatched rows')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    mismatches = []
+    with connect(args.database_url) as conn:
+        conn.autocommit = True  # verify manages its own snapshot transaction
+        for mismatch in verify(conn):
+            mismatches.append(mismatch)
+            print(json.dumps(mismatch, default=str), flush=True)
+        deleted = repair(conn, mismatches) if args.repair and mismatches else 0
+
+    summary = {
+        'mismatches': len(mismatches),
+        'repaired': len(mismatches) if args.repair else 0,
+        'zero_rows_deleted': deleted,
+        'elapsed_s': round(time.perf_counter() - start, 3),
+    }
+    print(json.dumps({'summary': summary}), file=sys.stderr)
+    return 1 if mismatches and not args.repair else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
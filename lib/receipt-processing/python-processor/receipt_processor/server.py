@@ -0,0 +1,466 @@
+"""
+RECEIPT PROCESSOR SERVER
+
+Long-lived worker pool behind /api/receipts/process-python. A single asyncio
+process accepts framed requests on a Unix socket and hands the CPU work to N
+pre-started worker processes that have already imported Pillow, zbar and
+Tesseract, so a request pays only the socket round trip plus processing time.
+Workers share an on-disk result cache (cache.py) so re-uploaded photos skip
+processing entirely. The server process also keeps the perceptual-hash
+duplicate index (phash.py) and tags each result with near-duplicate uploads
+(`hash_image` does only that, for uploads the TypeScript pipeline processes),
+and the store directory (stores.py) used for geofenced store recognition,
+refreshed from the `stores` table in the background when DATABASE_URL is set.
+The directory also answers fuzzy merchant-name lookups (names.py). KRA
+invoice lookups (kra.py) run on the event loop over pooled keep-alive
+connections with a persistent invoice cache. Workers escalate OCR through
+the configured tiers (ocr_tiers.py); `ping` reports per-tier hit rates.
+Storage derivatives (derivatives.py) that no caller collected are expired in
+the background.
+
+Usage:
+    python3 -m receipt_processor.server --socket /tmp/kacha-receipt-processor.sock --workers 4
+"""
+
+import argparse
+import asyncio
+import fcntl
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES, ResultCache
+from .derivatives import DEFAULT_DERIVATIVES_DIR, DEFAULT_MAX_AGE_S, expire_derivatives
+from .errors import ProcessorError, error_result
+from .kra import DEFAULT_KRA_CACHE_PATH, KRAScraper
+from .names import DEFAULT_LIMIT as DEFAULT_NAME_LIMIT, MAX_DISTANCE
+from .ocr_tiers import DEFAULT_TIERS, TierStats, build_tiers, tiers_key
+from .phash import DEFAULT_MAX_ENTRIES, DEFAULT_RADIUS, DuplicateIndex, parse_hash
+from .protocol import encode_json, read_request, write_frame
+from .snapshot import DEFAULT_SNAPSHOT_PATH, SnapshotLoader
+from .stores import DEFAULT_LIMIT, DEFAULT_RADIUS_M, DEFAULT_SEED_PATH, StoreDirectory, name_match_result, store_result
+from .worker import cache_namespace, handle_hash_request, handle_request, init_worker
+
+DEFAULT_SOCKET_PATH = '/tmp/kacha-receipt-processor.sock'
+DEFAULT_DEDUPE_INDEX_PATH = os.path.join(tempfile.gettempdir(), 'kacha-receipt-phash.jsonl')
+DERIVATIVES_SWEEP_S = 300.0
+
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+
+class ProcessorServer:
+    """Unix-socket front end for a pool of receipt processing workers."""
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        workers: int | None = None,
+        cache_path: str | None = DEFAULT_CACHE_PATH,
+        cache_max_bytes: int = DEFAULT_MAX_BYTES,
+        dedupe_index_path: str | None = DEFAULT_DEDUPE_INDEX_PATH,
+        dedupe: bool = True,
+        dedupe_max_entries: int | None = DEFAULT_MAX_ENTRIES,
+        templates_path: str | None = DEFAULT_SNAPSHOT_PATH,
+        stores_seed_path: str | None = DEFAULT_SEED_PATH,
+        stores_database_url: str | None = None,
+        stores_refresh_s: float = 60.0,
+        kra_cache_path: str | None = DEFAULT_KRA_CACHE_PATH,
+        kra_base_url: str | None = None,
+        ocr_tiers: str = DEFAULT_TIERS,
+        derivatives_max_age_s: float = DEFAULT_MAX_AGE_S,
+    ):
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_path = cache_path
+        self.cache_max_bytes = cache_max_bytes
+        self.cache: ResultCache | None = None
+        self.dedupe_index_path = dedupe_index_path
+        self.dedupe = dedupe
+        self.dedupe_max_entries = dedupe_max_entries
+        self.duplicates: DuplicateIndex | None = None
+        self.templates = SnapshotLoader(templates_path)
+        self.stores = StoreDirectory()
+        self.stores_seed_path = stores_seed_path
+        self.stores_database_url = stores_database_url
+        self.stores_refresh_s = stores_refresh_s
+        self._stores_task: asyncio.Task | None = None
+        self.kra_cache_path = kra_cache_path
+        self.kra_base_url = kra_base_url
+        self.kra: KRAScraper | None = None
+        self.ocr_tiers = ocr_tiers
+        self.ocr_stats = TierStats()
+        self.derivatives_max_age_s = derivatives_max_age_s
+        self._derivatives_task: asyncio.Task | None = None
+        self.requests_handled = 0
+        self._executor: ProcessPoolExecutor | None = None
+        self._pool_generation = 0
+        self._pool_lock = asyncio.Lock()
+        self._server: asyncio.AbstractServer | None = None
+        self._socket_lock = None
+
+    async def start(self) -> None:
+        await self._claim_socket()
+        if self.cache_path:
+            namespace = cache_namespace(self.templates.engine().version, tiers_key(build_tiers(self.ocr_tiers)))
+            self.cache = ResultCache(self.cache_path, self.cache_max_bytes, namespace=namespace)
+            self.cache.purge_stale()
+        if self.dedupe:
+            self.duplicates = DuplicateIndex(self.dedupe_index_path, self.dedupe_max_entries)
+        if self.stores_seed_path and os.path.exists(self.stores_seed_path):
+            self.stores.load_seed(self.stores_seed_path)
+        if self.stores_database_url:
+            try:
+                await self._refresh_stores()
+            except Exception as exc:  # seed stores only; the follow task keeps retrying
+                print(f'[receipt-processor] store refresh failed: {exc}', file=sys.stderr, flush=True)
+            if self.stores_refresh_s > 0:
+                self._stores_task = asyncio.create_task(self._follow_stores())
+        self.kra = KRAScraper(self.kra_cache_path, base_url=self.kra_base_url)
+        if self.derivatives_max_age_s > 0:
+            self._derivatives_task = asyncio.create_task(self._expire_derivatives())
+        await self._start_pool()
+
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        print(
+            f'[receipt-processor] listening on {self.socket_path} with {self.workers} workers',
+            file=sys.stderr,
+            flush=True,
+        )
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._stores_task is not None:
+            self._stores_task.cancel()
+        if self._derivatives_task is not None:
+            self._derivatives_task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.kra is not None:
+            await self.kra.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.duplicates is not None:
+            self.duplicates.close()
+        if self._socket_lock is not None:
+            # Only the owner removes the socket; a server that lost the race leaves it alone
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._socket_lock.close()
+
+    async def _claim_socket(self) -> None:
+        """Take the socket path, or raise if another server is serving it.
+
+        Two clients can start a server at the same moment. An exclusive lock
+        on `<socket>.lock` decides which one serves; the winner still checks
+        that nothing answers on an existing socket (a server started without
+        the lock) before removing it as stale.
+        """
+        lock = open(f'{self.socket_path}.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise ProcessorError('socket_in_use', f'Another receipt processor is serving {self.socket_path}')
+        if os.path.exists(self.socket_path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)  # left behind by a server that died
+            else:
+                writer.close()
+                lock.close()
+                raise ProcessorError('socket_in_use', f'Another receipt processor is serving {self.socket_path}')
+        self._socket_lock = lock
+
+    async def _start_pool(self) -> None:
+        """Start the pool and block until every worker has initialised."""
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(self.cache_path, self.cache_max_bytes, self.templates.path, self.ocr_tiers),
+        )
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _worker_ready) for _ in range(self.workers)
+        ))
+
+    async def _restart_pool(self, generation: int) -> None:
+        """Replace a broken pool once, however many requests saw it break.
+
+        Every request in flight on a broken pool fails with BrokenProcessPool;
+        only the first to get here replaces `generation`, the rest find it
+        already replaced.
+        """
+        async with self._pool_lock:
+            if self._pool_generation != generation:
+                return
+            # A broken pool has already failed its pending futures: nothing to cancel
+            self._executor.shutdown(wait=False)
+            await self._start_pool()
+            self._pool_generation += 1
+
+    async def _refresh_stores(self) -> int:
+        """Apply `stores` rows changed since the last refresh. Returns rows applied."""
+        loop = asyncio.get_running_loop()
+        stores, watermark = await loop.run_in_executor(None, self.stores.fetch_changes, self.stores_database_url)
+        self.stores.apply_changes(stores, watermark)
+        return len(stores)
+
+    async def _follow_stores(self) -> None:
+        while True:
+            await asyncio.sleep(self.stores_refresh_s)
+            try:
+                await self._refresh_stores()
+            except Exception as exc:  # keep serving the last good directory
+                print(f'[receipt-processor] store refresh failed: {exc}', file=sys.stderr, flush=True)
+
+    async def _expire_derivatives(self) -> None:
+        """Remove derivative files callers never uploaded and deleted."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, expire_derivatives, DEFAULT_DERIVATIVES_DIR, self.derivatives_max_age_s)
+            except OSError as exc:
+                print(f'[receipt-processor] derivative sweep failed: {exc}', file=sys.stderr, flush=True)
+            await asyncio.sleep(min(DERIVATIVES_SWEEP_S, self.derivatives_max_age_s))
+
+    async def _dispatch(self, request: dict, body: bytes | None) -> dict:
+        op = request.get('op', 'process')
+        if op == 'ping':
+            return {
+                'success': True,
+                'op': 'pong',
+                'workers': self.workers,
+                'requests_handled': self.requests_handled,
+                'template_version': self.templates.engine().version,
+                'cache': self.cache.stats() if self.cache else None,
+                'dedupe_index_size': len(self.duplicates) if self.duplicates is not None else None,
+                'stores': len(self.stores),
+                'kra': self.kra.stats() if self.kra else None,
+                'ocr': self.ocr_stats.stats(),
+            }
+        if op == 'invalidate_cache':
+            if self.cache:
+                self.cache.clear()
+            return {'success': True, 'op': 'invalidate_cache'}
+        if op == 'find_duplicates':
+            return self._find_duplicates(request)
+        if op == 'nearby_stores':
+            return self._nearby_stores(request)
+        if op == 'match_merchant':
+            return self._match_merchant(request)
+        if op == 'scrape_kra':
+            return await self._scrape_kra(request)
+        if op == 'refresh_stores':
+            if not self.stores_database_url:
+                return error_result(ProcessorError('invalid_request', 'Store refresh needs a database URL'))
+            try:
+                applied = await self._refresh_stores()
+            except ProcessorError as exc:
+                return error_result(exc)
+            except Exception as exc:
+                return error_result(ProcessorError('store_refresh_failed', f'Store refresh failed: {exc}'))
+            return {'success': True, 'op': 'refresh_stores', 'applied': applied, 'stores': len(self.stores)}
+        if op not in ('process', 'hash_image'):
+            return error_result(ProcessorError('invalid_request', f'Unknown op: {op}'))
+
+        loop = asyncio.get_running_loop()
+        generation = self._pool_generation
+        handler = handle_request if op == 'process' else handle_hash_request
+        try:
+            result = await loop.run_in_executor(self._executor, handler, request, body)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge image): replace the pool and report
+            await self._restart_pool(generation)
+            result = error_result(ProcessorError('worker_crashed', 'Processor worker exited unexpectedly'))
+
+        if result.get('success') and not result.get('cache_hit'):
+            self.ocr_stats.record(result.get('ocr_tiers'))
+        if result.get('success') and result.get('perceptual_hash') and self.duplicates is not None:
+            result['near_duplicates'] = self._index_result(result, request.get('dedupe_scope'))
+
+        self.requests_handled += 1
+        return result
+
+    def _index_result(self, result: dict, scope: str | None) -> list[dict]:
+        """Look up earlier uploads that look like this one, then index it."""
+        value = parse_hash(result['perceptual_hash'])
+        image_hash = result['image_hash']
+        matches = [
+            {'image_hash': key, 'distance': distance}
+            for key, distance in self.duplicates.query(value, scope=scope, limit=10)
+            if key != image_hash
+        ]
+        self.duplicates.add(image_hash, value, scope)
+        return matches
+
+    def _find_duplicates(self, request: dict) -> dict:
+        if self.duplicates is None:
+            return error_result(ProcessorError('dedupe_disabled', 'Duplicate index is disabled'))
+        try:
+            matches = self.duplicates.query(
+                parse_hash(str(request.get('perceptual_hash', ''))),
+                radius=int(request.get('radius', DEFAULT_RADIUS)),
+                scope=request.get('dedupe_scope'),
+                limit=int(request.get('limit', 10)),
+            )
+        except ValueError as exc:
+            return error_result(ProcessorError('invalid_request', f'Invalid find_duplicates request: {exc}'))
+        return {
+            'success': True,
+            'op': 'find_duplicates',
+            'near_duplicates': [{'image_hash': key, 'distance': distance} for key, distance in matches],
+        }
+
+    def _nearby_stores(self, request: dict) -> dict:
+        """Stores near `latitude`/`longitude`, or near each of `points` for bulk imports."""
+        try:
+            radius_m = float(request.get('radius_m', DEFAULT_RADIUS_M))
+            limit = int(request.get('limit', DEFAULT_LIMIT))
+            if 'points' in request:
+                points = [(float(point['latitude']), float(point['longitude'])) for point in request['points']]
+            else:
+                points = [(float(request['latitude']), float(request['longitude']))]
+        except (KeyError, TypeError, ValueError) as exc:
+            return error_result(ProcessorError('invalid_request', f'Invalid nearby_stores request: {exc}'))
+
+        results = [
+            [store_result(store, distance) for store, distance in matches]
+            for matches in self.stores.nearby_many(points, radius_m, limit)
+        ]
+        if 'points' in request:
+            return {'success': True, 'op': 'nearby_stores', 'results': results}
+        return {'success': True, 'op': 'nearby_stores', 'stores': results[0]}
+
+    async def _scrape_kra(self, request: dict) -> dict:
+        """KRA invoice for `url`, or for each of `urls`."""
+        urls = request.get('urls')
+        if isinstance(urls, list) and all(isinstance(url, str) for url in urls):
+            return {'success': True, 'op': 'scrape_kra', 'results': await self.kra.scrape_many(urls)}
+        url = request.get('url')
+        if not isinstance(url, str) or not url:
+            return error_result(ProcessorError('invalid_request', 'scrape_kra needs a url'))
+        try:
+            invoice, cache_hit = await self.kra.scrape(url)
+        except ProcessorError as exc:
+            return error_result(exc)
+        return {'success': True, 'op': 'scrape_kra', 'invoice': invoice, 'cache_hit': cache_hit}
+
+    def _match_merchant(self, request: dict) -> dict:
+        """Fuzzy store matches and chain for an OCR'd merchant name."""
+        name = request.get('name')
+        if not isinstance(name, str) or not name.strip():
+            return error_result(ProcessorError('invalid_request', 'match_merchant needs a name'))
+        try:
+            limit = int(request.get('limit', DEFAULT_NAME_LIMIT))
+            max_distance = int(request.get('max_distance', MAX_DISTANCE))
+        except (TypeError, ValueError) as exc:
+            return error_result(ProcessorError('invalid_request', f'Invalid match_merchant request: {exc}'))
+
+        return {
+            'success': True,
+            'op': 'match_merchant',
+            'stores': [
+                name_match_result(store, match) for store, match in self.stores.match_name(name, limit, max_distance)
+            ],
+            'chain_name': self.stores.chains.extract(name),
+        }
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    message = await read_request(reader)
+                except ValueError as exc:
+                    await write_frame(writer, encode_json(error_result(ProcessorError('invalid_request', str(exc)))))
+                    break
+                if message is None:
+                    break
+                response = await self._dispatch(*message)
+                await write_frame(writer, encode_json(response))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _run(server: ProcessorServer) -> None:
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    except ProcessorError as exc:  # socket_in_use: the other server keeps serving
+        print(f'[receipt-processor] {exc}', file=sys.stderr, flush=True)
+    finally:
+        await server.close()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Kacha receipt processor worker pool')
+    parser.add_argument('--socket', default=os.environ.get('PYTHON_PROCESSOR_SOCKET', DEFAULT_SOCKET_PATH))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('PYTHON_PROCESSOR_WORKERS', 0)) or None)
+    parser.add_argument('--cache-path', default=os.environ.get('PYTHON_PROCESSOR_CACHE_PATH', DEFAULT_CACHE_PATH))
+    parser.add_argument('--cache-max-mb', type=int, default=int(os.environ.get('PYTHON_PROCESSOR_CACHE_MAX_MB', 256)))
+    parser.add_argument('--no-cache', action='store_true', help='Disable the result cache')
+    parser.add_argument('--templates', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH),
+                        help='Template snapshot; workers hot-reload it when its version changes')
+    parser.add_argument('--dedupe-index', default=os.environ.get('PYTHON_PROCESSOR_DEDUPE_INDEX', DEFAULT_DEDUPE_INDEX_PATH))
+    parser.add_argument('--no-dedupe', action='store_true', help='Disable near-duplicate detection')
+    parser.add_argument('--dedupe-max-entries', type=int,
+                        default=int(os.environ.get('PYTHON_PROCESSOR_DEDUPE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+                        help='Newest uploads kept in the near-duplicate index (0: unbounded)')
+    parser.add_argument('--stores-seed', default=DEFAULT_SEED_PATH, help='Seed SQL loaded into the store directory')
+    parser.add_argument('--stores-refresh-s', type=float,
+                        default=float(os.environ.get('PYTHON_PROCESSOR_STORES_REFRESH_S', 60)),
+                        help='Seconds between store table refreshes when DATABASE_URL is set (0: startup only)')
+    parser.add_argument('--kra-cache-path', default=os.environ.get('PYTHON_PROCESSOR_KRA_CACHE_PATH', DEFAULT_KRA_CACHE_PATH))
+    parser.add_argument('--kra-base-url', default=os.environ.get('PYTHON_PROCESSOR_KRA_BASE_URL'),
+                        help='Send KRA requests here instead (e.g. a stand-in serving recorded pages)')
+    parser.add_argument('--ocr-tiers', default=os.environ.get('PYTHON_PROCESSOR_OCR_TIERS', DEFAULT_TIERS),
+                        help='OCR engines, cheapest first (e.g. tesseract,vision,gemini; name=URL for a stand-in)')
+    parser.add_argument('--derivatives-max-age-s', type=float,
+                        default=float(os.environ.get('PYTHON_PROCESSOR_DERIVATIVES_MAX_AGE_S', DEFAULT_MAX_AGE_S)),
+                        help='Delete derivative files callers left behind after this long (0: never)')
+    args = parser.parse_args(argv)
+    build_tiers(args.ocr_tiers)  # reject a bad spec before starting workers
+
+    asyncio.run(_run(ProcessorServer(
+        args.socket,
+        args.workers,
+        cache_path=None if args.no_cache else args.cache_path,
+        cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+        dedupe_index_path=args.dedupe_index,
+        dedupe=not args.no_dedupe,
+        dedupe_max_entries=args.dedupe_max_entries or None,
+        templates_path=args.templates,
+        stores_seed_path=args.stores_seed,
+        stores_database_url=os.environ.get('DATABASE_URL'),
+        stores_refresh_s=args.stores_refresh_s,
+        kra_cache_path=args.kra_cache_path,
+        kra_base_url=args.kra_base_url,
+        ocr_tiers=args.ocr_tiers,
+        derivatives_max_age_s=args.derivatives_max_age_s,
+    )))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+TEMPLATE SNAPSHOT
+
+Precompiled, versioned template rules for the worker pool. Building an
+engine means parsing every pattern to find its required literals; a snapshot
+stores the result (deduplicated patterns, literals, field -> pattern ids) as
+JSON, so a worker start-up is one json.load. Regexes are then compiled
+lazily, only when a receipt contains their literal.
+
+Workers hot-reload: `SnapshotLoader.engine()` re-stats the file at most once
+per `check_interval` seconds and swaps in the new engine when the snapshot
+version changes, with no worker restart. Snapshots are written atomically
+(temp file + rename) so a worker never reads a half-written file.
+
+Without a snapshot file the built-in templates (templates.py) are used.
+
+Usage:
+    python3 -m receipt_processor.snapshot build [--output PATH] [--from-database]
+    python3 -m receipt_processor.snapshot show [--path PATH]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .db import connect
+from .errors import ProcessorError
+from .extraction import TemplateEngine
+from .templates import DEFAULT_TEMPLATES, template_from_row
+
+SNAPSHOT_FORMAT = 1
+DEFAULT_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), 'kacha-receipt-templates.json')
+
+
+def write_snapshot(engine: TemplateEngine, path: str = DEFAULT_SNAPSHOT_PATH) -> dict:
+    """Atomically write `engine` to `path`. Returns the snapshot header."""
+    snapshot = {'format': SNAPSHOT_FORMAT, 'built_at': time.time(), **engine.to_snapshot()}
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.templates-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+            json.dump(snapshot, handle, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return snapshot_header(snapshot)
+
+
+def read_snapshot(path: str = DEFAULT_SNAPSHOT_PATH) -> TemplateEngine:
+    try:
+        with open(path, encoding='utf-8') as handle:
+            snapshot = json.load(handle)
+    except (OSError, ValueError) as exc:
+        raise ProcessorError('invalid_snapshot', f'Could not read template snapshot {path}: {exc}') from exc
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise ProcessorError('invalid_snapshot', f'Unsupported template snapshot format: {snapshot.get("format")}')
+    return TemplateEngine.from_snapshot(snapshot)
+
+
+def snapshot_header(snapshot: dict) -> dict:
+    return {
+        'format': snapshot['format'],
+        'version': snapshot['version'],
+        'built_at': snapshot['built_at'],
+        'templates': len(snapshot['templates']),
+        'patterns': len(snapshot['patterns']),
+    }
+
+
+def load_templates_from_database(database_url: str | None = None) -> list:
+    """Active `receipt_templates` rows as ReceiptTemplates."""
+    with connect(database_url) as conn:
+        cursor = conn.execute(
+            'SELECT id, name, version, active, store_id, chain_name, receipt_type, format_type, '
+            'parser_type, field_mappings, parser_config, validation_rules FROM receipt_templates WHERE active ORDER BY created_at'
+        )
+        columns = [column.name for column in cursor.description]
+        return [template_from_row(dict(zip(columns, row))) for row in cursor]
+
+
+class SnapshotLoader:
+    """Per-process template engine that follows the snapshot file.
+
+    A broken or missing snapshot never takes a worker down: the previous
+    engine (initially the built-in templates) stays in use.
+    """
+
+    def __init__(self, path: str | None = DEFAULT_SNAPSHOT_PATH, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._engine: TemplateEngine | None = None
+        self._stat: tuple[int, int] | None = None
+        self._checked_at = 0.0
+
+    def engine(self) -> TemplateEngine:
+        now = time.monotonic()
+        if self._engine is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            self._refresh()
+        return self._engine
+
+    def _refresh(self) -> None:
+        try:
+            stat = os.stat(self.path) if self.path else None
+        except OSError:
+            stat = None
+
+        if stat is None:
+            if self._engine is None:
+                self._engine = TemplateEngine(DEFAULT_TEMPLATES)
+            return
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key == self._stat:
+            return
+        self._stat = key
+        try:
+            engine = read_snapshot(self.path)
+        except (ProcessorError, KeyError, TypeError, ValueError) as exc:
+            print(f'[receipt-processor] keeping current templates: {exc}', file=sys.stderr, flush=True)
+            if self._engine is None:
+                self._engine = TemplateEngine(DEFAULT_TEMPLATES)
+            return
+
+        if (
+            self._engine is None
+            or engine.version != self._engine.version
+            or engine.confidence_thresholds != self._engine.confidence_thresholds
+            or engine.required_fields != self._engine.required_fields
+            or engine.amount_tolerances != self._engine.amount_tolerances
+        ):
+            if self._engine is not None:
+                self.reloads += 1
+            self._engine = engine
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Build or inspect the template snapshot')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='Compile templates into a snapshot file')
+    build.add_argument('--output', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH))
+    build.add_argument('--from-database', action='store_true', help='Add active receipt_templates rows to the built-in templates')
+    build.add_argument('--database-url', default=None, help='Postgres URL for --from-database (default: $DATABASE_URL)')
+
+    show = commands.add_parser('show', help='Print the snapshot header')
+    show.add_argument('--path', default=os.environ.get('PYTHON_PROCESSOR_TEMPLATES', DEFAULT_SNAPSHOT_PATH))
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        templates = list(DEFAULT_TEMPLATES)
+        if args.from_database:
+            templates += load_templates_from_database(args.database_url)
+        print(json.dumps(write_snapshot(TemplateEngine(templates), args.output), indent=2))
+        return 0
+
+    with open(args.path, encoding='utf-8') as handle:
+        print(json.dumps(snapshot_header(json.load(handle)), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
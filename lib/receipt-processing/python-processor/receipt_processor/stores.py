@@ -0,0 +1,374 @@
+"""
+STORE DIRECTORY
+
+In-memory store registry for recognition, replacing the per-request
+Haversine scan in StoreRecognizer.findNearbyStores (store-recognition.ts).
+
+Stores are bucketed in a fixed lat/lng grid (~1.1 km cells). A radius query
+only visits the cells overlapping the circle's bounding box and compares
+unit-sphere chord lengths, so there is no trigonometry per candidate and a
+100 m geofence lookup touches a handful of stores regardless of how many are
+loaded. Results match the `find_stores_nearby` RPC: great-circle distance,
+closest first, at most 20.
+
+The directory starts from lib/supabase/seed-stores.sql and follows the
+`stores` table incrementally: `refresh()` pulls only rows whose updated_at
+is past the last one seen (keyset on updated_at, id), so stores inserted or
+moved by recordEncounter appear without a reload. Deleted rows are not
+detected; restart the server after removing stores.
+
+Store and chain names are kept in fuzzy name indexes (names.py) for
+merchant-name matching.
+
+Usage:
+    python3 -m receipt_processor.stores nearby -1.2921 36.8219 [--radius 100]
+    python3 -m receipt_processor.stores nearby --input points.jsonl   # bulk imports
+    python3 -m receipt_processor.stores match "CARREF0UR JUNCTI0N"
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from dataclasses import asdict, dataclass
+from typing import Iterable
+
+from .db import connect
+from .names import DEFAULT_LIMIT as DEFAULT_NAME_LIMIT, MAX_DISTANCE, ChainIndex, NameIndex, NameMatch
+
+EARTH_RADIUS_M = 6371e3
+CELL_DEGREES = 0.01
+LNG_CELLS = round(360 / CELL_DEGREES)
+DEFAULT_RADIUS_M = 100
+DEFAULT_LIMIT = 20
+REFRESH_PAGE_SIZE = 5000
+
+DEFAULT_SEED_PATH = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'supabase', 'seed-stores.sql',
+))
+
+_STORE_COLUMNS = (
+    'id', 'name', 'chain_name', 'category', 'kra_pin', 'till_number',
+    'latitude', 'longitude', 'address', 'verified',
+)
+
+
+@dataclass
+class Store:
+    """Mirrors the Store interface in store-recognition.ts."""
+    id: str
+    name: str
+    category: str
+    chain_name: str | None = None
+    kra_pin: str | None = None
+    till_number: str | None = None
+    latitude: float | None = None
+    longitude: float | None = None
+    address: str | None = None
+    verified: bool = False
+
+
+def _unit_vector(latitude: float, longitude: float) -> tuple[float, float, float]:
+    lat, lng = math.radians(latitude), math.radians(longitude)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def _cell(latitude: float, longitude: float) -> tuple[int, int]:
+    return math.floor(latitude / CELL_DEGREES), math.floor(longitude / CELL_DEGREES) % LNG_CELLS
+
+
+class GeoIndex:
+    """Grid of unit-sphere points keyed by id, with incremental upsert/remove."""
+
+    def __init__(self):
+        self._cells: dict[tuple[int, int], dict[str, tuple[float, float, float]]] = {}
+        self._where: dict[str, tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def upsert(self, key: str, latitude: float, longitude: float) -> None:
+        self.remove(key)
+        cell = _cell(latitude, longitude)
+        self._cells.setdefault(cell, {})[key] = _unit_vector(latitude, longitude)
+        self._where[key] = cell
+
+    def remove(self, key: str) -> None:
+        cell = self._where.pop(key, None)
+        if cell is not None:
+            bucket = self._cells[cell]
+            del bucket[key]
+            if not bucket:
+                del self._cells[cell]
+
+    def within(self, latitude: float, longitude: float, radius_m: float) -> list[tuple[str, float]]:
+        """`(key, distance_m)` for every point within `radius_m`, closest first."""
+        x, y, z = _unit_vector(latitude, longitude)
+        angle = min(radius_m / EARTH_RADIUS_M, math.pi)
+        max_chord_sq = (2 * math.sin(angle / 2)) ** 2
+
+        matches = []
+        for cell in self._cells_near(latitude, longitude, angle):
+            bucket = self._cells.get(cell)
+            if not bucket:
+                continue
+            for key, (px, py, pz) in bucket.items():
+                chord_sq = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                if chord_sq <= max_chord_sq:
+                    matches.append((key, 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(chord_sq) / 2))))
+
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    def _cells_near(self, latitude: float, longitude: float, angle: float):
+        span = math.degrees(angle)
+        lat_low = math.floor(max(-90.0, latitude - span) / CELL_DEGREES)
+        lat_high = math.floor(min(90.0, latitude + span) / CELL_DEGREES)
+
+        widest = min(90.0, abs(latitude) + span)
+        if widest >= 89.9:
+            lng_cells = range(LNG_CELLS)
+        else:
+            lng_span = math.degrees(angle / math.cos(math.radians(widest)))
+            first = math.floor((longitude - lng_span) / CELL_DEGREES)
+            last = math.floor((longitude + lng_span) / CELL_DEGREES)
+            lng_cells = range(LNG_CELLS) if last - first + 1 >= LNG_CELLS else range(first, last + 1)
+
+        if len(lng_cells) * (lat_high - lat_low + 1) > len(self._cells):
+            # Huge radius: walking the occupied cells is cheaper than the box
+            yield from list(self._cells)
+            return
+        for lat_cell in range(lat_low, lat_high + 1):
+            for lng_cell in lng_cells:
+                yield lat_cell, lng_cell % LNG_CELLS
+
+
+class StoreDirectory:
+    """All known stores, indexed for recognition lookups."""
+
+    def __init__(self):
+        self.stores: dict[str, Store] = {}
+        self.geo = GeoIndex()
+        self.names = NameIndex()
+        self.chains = ChainIndex()
+        self.watermark: tuple | None = None  # (updated_at, id) of the last row pulled from `stores`
+
+    def __len__(self) -> int:
+        return len(self.stores)
+
+    def upsert(self, store: Store) -> None:
+        self.stores[store.id] = store
+        self.names.add(store.id, store.name)
+        if store.chain_name:
+            self.chains.add_chain(store.chain_name)
+        if store.latitude is not None and store.longitude is not None:
+            self.geo.upsert(store.id, store.latitude, store.longitude)
+        else:
+            self.geo.remove(store.id)
+
+    def remove(self, store_id: str) -> None:
+        self.stores.pop(store_id, None)
+        self.names.remove(store_id)
+        self.geo.remove(store_id)
+
+    def nearby(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_m: float = DEFAULT_RADIUS_M,
+        limit: int = DEFAULT_LIMIT,
+    ) -> list[tuple[Store, float]]:
+        """Stores within `radius_m` of a point, closest first (find_stores_nearby)."""
+        return [(self.stores[key], distance) for key, distance in self.geo.within(latitude, longitude, radius_m)[:limit]]
+
+    def nearby_many(
+        self,
+        points: Iterable[tuple[float, float]],
+        radius_m: float = DEFAULT_RADIUS_M,
+        limit: int = DEFAULT_LIMIT,
+    ) -> list[list[tuple[Store, float]]]:
+        return [self.nearby(latitude, longitude, radius_m, limit) for latitude, longitude in points]
+
+    def match_name(
+        self,
+        merchant_name: str,
+        limit: int = DEFAULT_NAME_LIMIT,
+        max_distance: int = MAX_DISTANCE,
+    ) -> list[tuple[Store, NameMatch]]:
+        """Stores whose name fuzzily matches `merchant_name`, best first."""
+        return [(self.stores[match.key], match) for match in self.names.search(merchant_name, limit, max_distance)]
+
+    def load_seed(self, path: str = DEFAULT_SEED_PATH) -> int:
+        """Load `INSERT INTO stores` rows from a seed SQL file. Returns rows loaded."""
+        with open(path, encoding='utf-8') as handle:
+            rows = list(parse_store_inserts(handle.read()))
+        for row in rows:
+            self.upsert(_store_from_row({'id': f"seed:{row['name']}", **row}))
+        return len(rows)
+
+    def refresh(self, database_url: str | None = None) -> int:
+        """Pull stores inserted or updated since the last refresh. Returns rows applied."""
+        stores, watermark = self.fetch_changes(database_url)
+        self.apply_changes(stores, watermark)
+        return len(stores)
+
+    def fetch_changes(self, database_url: str | None = None) -> tuple[list[Store], tuple | None]:
+        """Read changed `stores` rows without touching the index.
+
+        Safe to run in a thread while the directory serves lookups; pass the
+        result to `apply_changes` on the owning thread.
+        """
+        stores, watermark = [], self.watermark
+        with connect(database_url) as conn:
+            while True:
+                where, params = '', []
+                if watermark is not None:
+                    where = 'WHERE (COALESCE(updated_at, created_at), id) > (%s, %s::uuid)'
+                    params = list(watermark)
+                rows = conn.execute(
+                    f'SELECT COALESCE(updated_at, created_at), id::text, {", ".join(_STORE_COLUMNS[1:])} '
+                    f'FROM stores {where} ORDER BY 1, id LIMIT {REFRESH_PAGE_SIZE}',
+                    params,
+                ).fetchall()
+                for changed_at, *values in rows:
+                    stores.append(_store_from_row(dict(zip(_STORE_COLUMNS, values))))
+                    watermark = (changed_at, stores[-1].id)
+                if len(rows) < REFRESH_PAGE_SIZE:
+                    return stores, watermark
+
+    def apply_changes(self, stores: list[Store], watermark: tuple | None) -> None:
+        for store in stores:
+            self.remove(f'seed:{store.name}')  # the table row supersedes its seed entry
+            self.upsert(store)
+        self.watermark = watermark
+
+
+def store_result(store: Store, distance_m: float) -> dict:
+    return {**asdict(store), 'distance_m': round(distance_m, 1)}
+
+
+def name_match_result(store: Store, match: NameMatch) -> dict:
+    return {**asdict(store), 'name_distance': match.distance, 'partial': match.partial}
+
+
+def _store_from_row(row: dict) -> Store:
+    return Store(
+        id=str(row['id']),
+        name=row['name'],
+        category=row.get('category') or 'uncategorized',
+        chain_name=row.get('chain_name'),
+        kra_pin=row.get('kra_pin'),
+        till_number=row.get('till_number'),
+        latitude=float(row['latitude']) if row.get('latitude') is not None else None,
+        longitude=float(row['longitude']) if row.get('longitude') is not None else None,
+        address=row.get('address'),
+        verified=bool(row.get('verified')),
+    )
+
+
+_SQL_TOKEN = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/|[(),;]|[^\s(),;']+", re.DOTALL)
+
+
+def parse_store_inserts(sql: str) -> Iterable[dict]:
+    """Yield column -> value dicts from `INSERT INTO stores (...) VALUES (...), ...;` statements."""
+    tokens = [token for token in _SQL_TOKEN.findall(sql) if not token.startswith(('--', '/*'))]
+    position = 0
+    while position < len(tokens) - 3:
+        if [token.upper() for token in tokens[position:position + 3]] != ['INSERT', 'INTO', 'STORES'] or tokens[position + 3] != '(':
+            position += 1
+            continue
+
+        position += 4
+        columns = []
+        while tokens[position] != ')':
+            if tokens[position] != ',':
+                columns.append(tokens[position])
+            position += 1
+        position += 1
+        if tokens[position].upper() != 'VALUES':
+            continue  # INSERT ... SELECT
+        position += 1
+
+        while position < len(tokens) and tokens[position] != ';':
+            if tokens[position] == '(':
+                values = []
+                position += 1
+                while tokens[position] != ')':
+                    if tokens[position] != ',':
+                        values.append(_sql_value(tokens[position]))
+                    position += 1
+                yield dict(zip(columns, values))
+            position += 1
+
+
+def _sql_value(token: str):
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    upper = token.upper()
+    if upper == 'NULL':
+        return None
+    if upper in ('TRUE', 'FALSE'):
+        return upper == 'TRUE'
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Query the store directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    nearby = commands.add_parser('nearby', help='Stores near a point, or near each point in --input')
+    nearby.add_argument('latitude', type=float, nargs='?')
+    nearby.add_argument('longitude', type=float, nargs='?')
+    nearby.add_argument('--input', help='JSON lines with latitude/longitude (or - for stdin)')
+    nearby.add_argument('--radius', type=float, default=DEFAULT_RADIUS_M, help='Metres (default: %(default)s)')
+    nearby.add_argument('--limit', type=int, default=DEFAULT_LIMIT)
+    match = commands.add_parser('match', help='Stores and chain matching a merchant name')
+    match.add_argument('name')
+    match.add_argument('--limit', type=int, default=DEFAULT_NAME_LIMIT)
+    match.add_argument('--max-distance', type=int, default=MAX_DISTANCE)
+    for command in (nearby, match):
+        command.add_argument('--seed', default=DEFAULT_SEED_PATH)
+        command.add_argument('--from-database', action='store_true', help='Also load the stores table')
+        command.add_argument('--database-url', default=None)
+    args = parser.parse_args(argv)
+
+    directory = StoreDirectory()
+    directory.load_seed(args.seed)
+    if args.from_database:
+        directory.refresh(args.database_url)
+
+    if args.command == 'match':
+        matches = directory.match_name(args.name, args.limit, args.max_distance)
+        print(json.dumps({
+            'stores': [name_match_result(*match) for match in matches],
+            'chain_name': directory.chains.extract(args.name),
+        }, indent=2))
+        return 0
+
+    if args.input:
+        source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+        try:
+            for line in source:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                matches = directory.nearby(entry['latitude'], entry['longitude'], args.radius, args.limit)
+                print(json.dumps({**entry, 'stores': [store_result(*match) for match in matches]}))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        return 0
+
+    if args.latitude is None or args.longitude is None:
+        parser.error('nearby needs LATITUDE LONGITUDE or --input')
+    matches = directory.nearby(args.latitude, args.longitude, args.radius, args.limit)
+    print(json.dumps([store_result(*match) for match in matches], indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+RECEIPT TEMPLATES
+
+Python port of the field-extraction rules in template-registry.ts. Only what
+extraction needs is carried over: OCR patterns, QR keys, KRA fields and the
+value transform, plus parserConfig.confidenceThreshold for OCR escalation
+(ocr_tiers.py) and validation.amountTolerance for line-item sum checks
+(line_items.py). The rest of validation and the rest of the parser configuration stay in
+TypeScript.
+
+Patterns are stored as (source, flags) pairs so a template is plain data;
+extraction.py compiles them. Transforms are module-level functions listed in
+TRANSFORMS so compiled snapshots (snapshot.py) can refer to them by name.
+Templates stored in the `receipt_templates` table are converted with
+`template_from_row`.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Callable
+
+
+@dataclass
+class FieldExtractor:
+    ocr_patterns: list[tuple[str, int]] = field(default_factory=list)
+    qr_keys: list[str] = field(default_factory=list)
+    kra_field: str | None = None
+    required: bool = False
+    required_for: list[str] = field(default_factory=list)
+    data_type: str | None = None
+    validation: str | None = None
+    transform: Callable | None = None
+
+
+@dataclass
+class ReceiptTemplate:
+    id: str
+    name: str
+    version: int
+    receipt_type: str
+    format_type: str
+    parser_type: str
+    fields: dict[str, FieldExtractor]
+    chain_name: str | None = None
+    store_id: str | None = None
+    active: bool = True
+    confidence_threshold: int | None = None  # parserConfig.confidenceThreshold
+    amount_tolerance: float | None = None  # validation.amountTolerance
+
+
+def to_amount(value) -> float | None:
+    """parseFloat(String(v).replace(/,/g, '')) from the TS templates."""
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def to_number(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _mapped_upper(value, mapping: dict[str, str]) -> str | None:
+    if value is None:
+        return None
+    upper = str(value).upper()
+    return mapping.get(upper, upper)
+
+
+def total_fuel_type(value) -> str | None:
+    return _mapped_upper(value, {'PMS': 'PETROL', 'AGO': 'DIESEL', 'DPK': 'KEROSENE'})
+
+
+def shell_fuel_type(value) -> str | None:
+    return _mapped_upper(value, {'V-POWER': 'SUPER', 'FUELSAVE': 'PETROL', 'DIESEL': 'DIESEL'})
+
+
+TRANSFORMS = {
+    'amount': to_amount,
+    'number': to_number,
+    'total_fuel_type': total_fuel_type,
+    'shell_fuel_type': shell_fuel_type,
+}
+
+# receipt_templates.field_mappings has no per-field transform; derive one from data_type
+_DATA_TYPE_TRANSFORMS = {'currency': to_amount, 'number': to_number, 'decimal': to_number}
+
+
+def template_from_row(row: dict) -> ReceiptTemplate:
+    """Build a template from a `receipt_templates` row.
+
+    Stored patterns are JavaScript regex sources without flags; they are
+    matched case-insensitively like the built-in templates.
+    """
+    fields = {}
+    for name, mapping in (row.get('field_mappings') or {}).items():
+        fields[name] = FieldExtractor(
+            ocr_patterns=[(source, re.IGNORECASE) for source in mapping.get('ocr_patterns') or []],
+            qr_keys=list(mapping.get('qr_keys') or []),
+            kra_field=mapping.get('kra_field'),
+            required=bool(mapping.get('required')),
+            required_for=list(mapping.get('required_for') or []),
+            data_type=mapping.get('data_type'),
+            validation=mapping.get('validation'),
+            transform=_DATA_TYPE_TRANSFORMS.get(mapping.get('data_type')),
+        )
+    return ReceiptTemplate(
+        id=str(row['id']),
+        name=row['name'],
+        version=row.get('version') or 1,
+        receipt_type=row['receipt_type'],
+        format_type=row['format_type'],
+        parser_type=row['parser_type'],
+        fields=fields,
+        chain_name=row.get('chain_name'),
+        store_id=str(row['store_id']) if row.get('store_id') else None,
+        active=row.get('active', True),
+        confidence_threshold=(row.get('parser_config') or {}).get('confidenceThreshold'),
+        amount_tolerance=(row.get('validation_rules') or {}).get('amountTolerance'),
+    )
+
+
+I = re.IGNORECASE
+M = re.MULTILINE
+
+
+DEFAULT_TEMPLATES = [
+    # ========================================
+    # FUEL STATION TEMPLATES
+    # ========================================
+    ReceiptTemplate(
+        id='total-kenya-fuel-v1',
+        name='Total Kenya Fuel Receipt',
+        version=1,
+        chain_name='Total',
+        receipt_type='fuel',
+        format_type='thermal',
+        parser_type='hybrid',
+        confidence_threshold=70,
+        amount_tolerance=0.01,
+        fields={
+            'invoiceNumber': FieldExtractor(
+                ocr_patterns=[
+                    (r'Invoice\s*No[.:]?\s*([A-Z0-9]+)', I),
+                    (r'INV[#:]?\s*([A-Z0-9]+)', I),
+                ],
+                qr_keys=['invoice', 'inv_no', 'invoiceNumber'],
+                kra_field='Control Unit Invoice Number',
+                required=True,
+                data_type='text',
+                validation='alphanumeric',
+            ),
+            'totalAmount': FieldExtractor(
+                ocr_patterns=[
+                    (r'TOTAL[:\s]*KES?\s*([0-9,]+\.?[0-9]*)', I),
+                    (r'Amount[:\s]*([0-9,]+\.?[0-9]*)', I),
+                ],
+                qr_keys=['amount', 'total', 'totalAmount'],
+                kra_field='Total Invoice Amount',
+                required=True,
+                data_type='currency',
+                validation='positive_number',
+                transform=to_amount,
+            ),
+            'litres': FieldExtractor(
+                ocr_patterns=[
+                    (r'([0-9]+\.?[0-9]*)\s*[Ll](?:itres?|trs?)', 0),
+                    (r'Volume[:\s]*([0-9.]+)', I),
+                    (r'QTY[:\s]*([0-9.]+)', I),
+                ],
+                qr_keys=['qty', 'litres', 'volume', 'quantity'],
+                required_for=['fuel'],
+                data_type='number',
+                validation='positive_number',
+                transform=to_number,
+            ),
+            'fuelType': FieldExtractor(
+                ocr_patterns=[
+                    (r'(?:Product|Fuel)[:\s]*(DIESEL|PETROL|SUPER|PMS|AGO)', I),
+                    (r'(DIESEL|PETROL|SUPER|PMS|AGO)\s*[0-9]', I),
+                ],
+                qr_keys=['product', 'fuel_type', 'fuelType'],
+                required_for=['fuel'],
+                data_type='text',
+                transform=total_fuel_type,
+            ),
+            'pricePerLitre': FieldExtractor(
+                ocr_patterns=[
+                    (r'(?:Price|Rate)[:\s]*([0-9]+\.?[0-9]*)', I),
+                    (r'([0-9]+\.?[0-9]*)\s*/\s*[Ll]', 0),
+                ],
+                qr_keys=['price_per_litre', 'rate', 'unitPrice'],
+                data_type='currency',
+                validation='positive_number',
+            ),
+            'pumpNumber': FieldExtractor(
+                ocr_patterns=[
+                    (r'Pump[:\s#]*([0-9A-Z]+)', I),
+                    (r'Nozzle[:\s#]*([0-9A-Z]+)', I),
+                ],
+                qr_keys=['pump', 'pump_number', 'nozzle'],
+                data_type='text',
+            ),
+            'vehicleNumber': FieldExtractor(
+                ocr_patterns=[
+                    (r'(?:Reg|Vehicle|Car)[:\s#]*([A-Z]{3}\s*[0-9]{3}[A-Z]?)', I),
+                    (r'([A-Z]{3}\s*[0-9]{3}[A-Z]?)', 0),
+                ],
+                qr_keys=['vehicle', 'registration', 'plate'],
+                data_type='text',
+            ),
+            'attendant': FieldExtractor(
+                ocr_patterns=[
+                    (r'Attendant[:\s]*([A-Za-z\s]+)', I),
+                    (r'Served\s*by[:\s]*([A-Za-z\s]+)', I),
+                ],
+                data_type='text',
+            ),
+        },
+    ),
+    ReceiptTemplate(
+        id='shell-kenya-fuel-v1',
+        name='Shell Kenya Fuel Receipt',
+        version=1,
+        chain_name='Shell',
+        receipt_type='fuel',
+        format_type='thermal',
+        parser_type='hybrid',
+        fields={
+            'invoiceNumber': FieldExtractor(
+                ocr_patterns=[
+                    (r'Receipt[:\s#]*([A-Z0-9]+)', I),
+                    (r'Trans[:\s#]*([A-Z0-9]+)', I),
+                ],
+                qr_keys=['receipt', 'transaction', 'trans_id'],
+                required=True,
+            ),
+            'totalAmount': FieldExtractor(
+                ocr_patterns=[(r'TOTAL[:\s]*([0-9,]+\.?[0-9]*)', I)],
+                qr_keys=['amount', 'total'],
+                required=True,
+                data_type='currency',
+                transform=to_amount,
+            ),
+            'litres': FieldExtractor(
+                ocr_patterns=[
+                    (r'([0-9]+\.?[0-9]*)\s*LTR', I),
+                    (r'Volume[:\s]*([0-9.]+)', I),
+                ],
+                required_for=['fuel'],
+                data_type='number',
+            ),
+            'fuelType': FieldExtractor(
+                ocr_patterns=[(r'(V-Power|FuelSave|Diesel)', I)],
+                transform=shell_fuel_type,
+            ),
+        },
+    ),
+    # ========================================
+    # GROCERY STORE TEMPLATES
+    # ========================================
+    ReceiptTemplate(
+        id='carrefour-kenya-v1',
+        name='Carrefour Kenya Receipt',
+        version=1,
+        chain_name='Carrefour',
+        receipt_type='grocery',
+        format_type='thermal',
+        parser_type='ocr_structured',
+        fields={
+            'invoiceNumber': FieldExtractor(
+                ocr_patterns=[(r'Receipt[:\s#]*([A-Z0-9]+)', I)],
+                required=True,
+            ),
+            'totalAmount': FieldExtractor(
+                ocr_patterns=[(r'TOTAL[:\s]*KES?\s*([0-9,]+\.?[0-9]*)', I)],
+                required=True,
+                data_type='currency',
+                transform=to_amount,
+            ),
+            'tillNumber': FieldExtractor(
+                ocr_patterns=[
+                    (r'Till[:\s#]*([0-9]+)', I),
+                    (r'Cashier[:\s#]*([0-9]+)', I),
+                ],
+            ),
+            'items': FieldExtractor(data_type='text'),
+        },
+    ),
+    # ========================================
+    # GENERIC TEMPLATES (Fallback)
+    # ========================================
+    ReceiptTemplate(
+        id='generic-kra-v1',
+        name='Generic KRA Receipt',
+        version=1,
+        receipt_type='other',
+        format_type='kra_compliant',
+        parser_type='qr_primary',
+        fields={
+            'invoiceNumber': FieldExtractor(
+                qr_keys=['invoice', 'inv_no'],
+                kra_field='Control Unit Invoice Number',
+                required=True,
+            ),
+            'totalAmount': FieldExtractor(
+                qr_keys=['amount', 'total'],
+                kra_field='Total Invoice Amount',
+                required=True,
+                data_type='currency',
+            ),
+            'merchantName': FieldExtractor(
+                qr_keys=['merchant', 'business_name'],
+                kra_field='Supplier Name',
+                required=True,
+            ),
+        },
+    ),
+    ReceiptTemplate(
+        id='generic-ocr-v1',
+        name='Generic OCR Receipt',
+        version=1,
+        receipt_type='other',
+        format_type='thermal',
+        parser_type='ai_vision',
+        confidence_threshold=50,
+        fields={
+            'merchantName': FieldExtractor(
+                ocr_patterns=[(r'^([A-Z][A-Za-z\s&]+)', M)],  # First line usually merchant
+            ),
+            'totalAmount': FieldExtractor(
+                ocr_patterns=[
+                    (r'TOTAL[:\s]*([0-9,]+\.?[0-9]*)', I),
+                    (r'Amount[:\s]*([0-9,]+\.?[0-9]*)', I),
+                ],
+                required=True,
+                data_type='currency',
+            ),
+        },
+    ),
+]
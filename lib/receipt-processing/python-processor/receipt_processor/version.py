@@ -0,0 +1,21 @@
+"""
+Processor version.
+
+Bump PROCESSOR_VERSION whenever a code change alters extraction output; cached
+results from older versions are ignored and purged on server start. Template
+changes are versioned separately by the template snapshot (snapshot.py).
+
+Also bump the version of each pipeline stage whose output the change alters.
+Every result records the stages it ran (`versions.stages`), so the
+re-extraction planner (reextract.py) only selects receipts that went through
+a changed stage: an OCR fix does not re-queue receipts whose OCR was skipped.
+"""
+
+PROCESSOR_VERSION = '1.5.0'
+
+STAGE_VERSIONS = {
+    'preprocess': '1',  # preprocess.py: grayscale/contrast/sharpen planes
+    'qr': '1',          # qr.py: QR decode (skipped for mobile ML Kit QR URLs)
+    'ocr': '1',         # ocr.py: Tesseract text + receipt patterns (skipped on eTIMS early exit)
+    'parse': '2',       # pipeline.py: generic_parse + assess_result + line items
+}
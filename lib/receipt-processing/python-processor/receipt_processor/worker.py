@@ -0,0 +1,151 @@
+"""
+Worker-process side of the pool.
+
+Per-process state (warm engines, the template snapshot, the shared result
+cache) and request handling used by both the socket server and the batch
+runner.
+"""
+
+import hashlib
+
+from .cache import DEFAULT_MAX_BYTES, ResultCache
+from .derivatives import derive, load_scaled, needs_original
+from .errors import ProcessorError, error_result
+from .imaging import load_image
+from .ocr_tiers import DEFAULT_TIERS, OCREngine, build_tiers, tiers_key
+from .phash import format_hash, phash
+from .pipeline import process_receipt
+from .preprocess import np, to_grayscale
+from .snapshot import DEFAULT_SNAPSHOT_PATH, SnapshotLoader
+from .version import PROCESSOR_VERSION
+
+_cache: ResultCache | None = None
+_templates: SnapshotLoader | None = None
+_tiers: list[OCREngine] | None = None
+
+
+def cache_namespace(template_version: str, ocr_tiers: str = DEFAULT_TIERS) -> str:
+    """Cached results are only valid for the processor, templates and OCR tiers (`tiers_key`) that produced them."""
+    return f'processor-{PROCESSOR_VERSION}-templates-{template_version}-ocr-{ocr_tiers}'
+
+
+def init_worker(
+    cache_path: str | None = None,
+    cache_max_bytes: int = DEFAULT_MAX_BYTES,
+    templates_path: str | None = DEFAULT_SNAPSHOT_PATH,
+    ocr_tiers: str | None = DEFAULT_TIERS,
+) -> None:
+    """Pool initializer: pay import and engine start-up once per worker."""
+    global _cache, _templates, _tiers
+    from . import ocr
+
+    if ocr.pytesseract is not None:
+        try:
+            ocr.pytesseract.get_tesseract_version()
+        except Exception:
+            pass
+
+    _tiers = build_tiers(ocr_tiers)
+    _templates = SnapshotLoader(templates_path)
+    engine = _templates.engine()
+    if cache_path:
+        _cache = ResultCache(cache_path, cache_max_bytes, namespace=cache_namespace(engine.version, tiers_key(_tiers)))
+
+
+def process_image(
+    image_bytes: bytes,
+    mobile_qr_url: str | None = None,
+    always_ocr: bool = False,
+    full_page_ocr: bool = False,
+    derivatives: bool = False,
+) -> dict:
+    """Process an image, serving repeat uploads from the result cache.
+
+    Derivative files are per request: they are never cached, and a cache hit
+    makes them with a reduced-scale decode.
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    engine = _templates.engine() if _templates else None
+    options = dict(
+        mobile_qr_url=mobile_qr_url, always_ocr=always_ocr, full_page_ocr=full_page_ocr, engine=engine, ocr_tiers=_tiers,
+    )
+    if _cache is None:
+        return process_receipt(image_bytes, image_hash=image_hash, derivatives=derivatives, **options)
+
+    # A hot-reloaded snapshot moves lookups to the new templates' namespace
+    _cache.namespace = cache_namespace(engine.version, tiers_key(_tiers))
+
+    key = cache_key(image_hash, mobile_qr_url, always_ocr, full_page_ocr)
+    cached = _cache.get(key)
+    if cached is not None:
+        if derivatives:
+            cached['derivatives'] = derive(load_scaled(image_bytes), image_bytes, image_hash)
+            cached['keep_original'] = needs_original(cached)
+        return {**cached, 'cache_hit': True}
+
+    result = process_receipt(image_bytes, image_hash=image_hash, derivatives=derivatives, **options)
+    if result['success']:
+        _cache.put(key, {name: value for name, value in result.items() if name not in ('derivatives', 'keep_original')})
+    return {**result, 'cache_hit': False}
+
+
+def cache_key(image_hash: str, mobile_qr_url: str | None, always_ocr: bool, full_page_ocr: bool = False) -> str:
+    """Image hash plus every option that can change the result."""
+    if not mobile_qr_url and not always_ocr and not full_page_ocr:
+        return image_hash
+    key = f'{image_hash}:{int(always_ocr)}:{mobile_qr_url or ""}'
+    return f'{key}:full' if full_page_ocr else key
+
+
+def handle_request(request: dict, body: bytes | None) -> dict:
+    """Run one socket request inside a worker process. Never raises."""
+    try:
+        return process_image(
+            load_request_image(request, body),
+            mobile_qr_url=request.get('mobile_qr_url'),
+            always_ocr=bool(request.get('always_ocr')),
+            full_page_ocr=bool(request.get('full_page_ocr')),
+            derivatives=bool(request.get('derivatives')),
+        )
+    except Exception as exc:
+        return error_result(exc)
+
+
+def hash_image(image_bytes: bytes) -> dict:
+    """SHA-256 and perceptual hash of an upload that is processed elsewhere (orchestrator.ts).
+
+    Decoded at full size like process_receipt: a reduced-scale JPEG decode
+    moves the hash a few bits, and these hashes are compared with the ones
+    `process` and the backfill store.
+    """
+    if np is None:
+        raise ProcessorError('dependency_missing', 'NumPy is required for perceptual hashes')
+    image = load_image(image_bytes)
+    return {
+        'success': True,
+        'image_hash': hashlib.sha256(image_bytes).hexdigest(),
+        'perceptual_hash': format_hash(phash(to_grayscale(np.asarray(image)))),
+    }
+
+
+def handle_hash_request(request: dict, body: bytes | None) -> dict:
+    """Run one `hash_image` socket request inside a worker process. Never raises."""
+    try:
+        return hash_image(load_request_image(request, body))
+    except Exception as exc:
+        return error_result(exc)
+
+
+def load_request_image(request: dict, body: bytes | None) -> bytes:
+    """Return the image bytes from the binary body frame or the temp-file handoff."""
+    if body:
+        return body
+
+    image_path = request.get('image_path')
+    if not image_path:
+        raise ProcessorError('invalid_request', 'No image data provided')
+    try:
+        with open(image_path, 'rb') as handle:
+            return handle.read()
+    except OSError as exc:
+        raise ProcessorError('invalid_request', f'Could not read image file: {exc}') from exc
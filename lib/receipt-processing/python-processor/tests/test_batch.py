@@ -0,0 +1,34 @@
+from receipt_processor.batch import process_entry, read_manifest
+
+
+def test_read_manifest():
+    lines = [
+        '# receipts from the March import\n',
+        'images/a.jpg\n',
+        '\n',
+        '{"id": "r2", "path": "images/b.jpg", "mobile_qr_url": "https://itax.kra.go.ke/x"}\n',
+        '{"path": "images/c.jpg"}\n',
+        '{"url": "https://example.com/d.jpg"}\n',
+    ]
+    assert list(read_manifest(lines)) == [
+        {'id': 'images/a.jpg', 'path': 'images/a.jpg'},
+        {'id': 'r2', 'path': 'images/b.jpg', 'mobile_qr_url': 'https://itax.kra.go.ke/x'},
+        {'id': 'images/c.jpg', 'path': 'images/c.jpg'},
+        {'id': '6', 'url': 'https://example.com/d.jpg'},
+    ]
+
+
+def test_process_entry_reports_errors(tmp_path):
+    result = process_entry({'id': 'r1', 'path': str(tmp_path / 'missing.jpg')})
+    assert result['id'] == 'r1'
+    assert result['success'] is False
+    assert result['error_type'] == 'FileNotFoundError'
+
+
+def test_invalid_manifest_line_fails_alone():
+    entries = list(read_manifest(['images/a.jpg', '{"path": "images/b.jpg"', 'images/c.jpg']))
+    assert [entry['id'] for entry in entries] == ['images/a.jpg', '2', 'images/c.jpg']
+    assert entries[1]['invalid'].startswith('Manifest line 2 is not valid JSON')
+
+    result = process_entry(entries[1])
+    assert (result['id'], result['success'], result['error_type']) == ('2', False, 'invalid_request')
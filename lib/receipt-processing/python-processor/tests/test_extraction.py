@@ -0,0 +1,112 @@
+import re
+
+import pytest
+
+from receipt_processor.extraction import TemplateEngine, qr_payload, required_literals
+from receipt_processor.templates import DEFAULT_TEMPLATES
+
+TEXTS = [
+    '',
+    'TOTAL KENYA\nPump: 4  Attendant: Jane Wanjiru\nProduct: DIESEL 20.5 Litres\nPrice: 182.30\n'
+    'Reg: KDA 123B\nTOTAL KES 3,737.15\nInvoice No: 0041230000012345\n',
+    'SHELL MOMBASA RD\nReceipt #A77812\nPMS 12.50 Ltr @ 189.84/L\nTotal: 2373.00\nNozzle 2\n',
+    'CARREFOUR JUNCTION\nSUGAR 2KG      2   250.00   500.00\nPMS            12.5 182.00  2275.00\n'
+    'TOTAL 2,775.00\nCASH 3000.00\nCHANGE 225.00\nTill No: 5512\nReceipt No: 88123\n',
+    'NAIVAS SUPERMARKET\nITEMS 14\nAmount: 1,204.50\nServed by: Otieno\nTrans: TX99812\n',
+    'the quick brown fox jumps over the lazy dog 12345',
+]
+QR = [None, {'invoice': 'QR123', 'amount': '999.00'}, {'receipt': 'R-1', 'qty': '5.5'}]
+KRA = [None, {'Control Unit Invoice Number': 'KRA-77', 'Total Invoice Amount': '5000'}]
+
+
+def apply_template(template, ocr_text, qr_data=None, kra_data=None) -> dict:
+    """orchestrator.ts applyTemplate: every field, every pattern, no shared work."""
+    result = {}
+    for name, extractor in template.fields.items():
+        value = None
+        if qr_data:
+            value = next((qr_data[key] for key in extractor.qr_keys if qr_data.get(key)), None)
+        if not value and extractor.kra_field and kra_data:
+            value = kra_data.get(extractor.kra_field)
+        if not value and ocr_text:
+            for source, flags in extractor.ocr_patterns:
+                match = re.search(source, ocr_text, flags)
+                if match and match.lastindex is not None and match.group(1):
+                    value = match.group(1)
+                    break
+        if value and extractor.transform:
+            value = extractor.transform(value)
+        if value:
+            result[name] = value
+    return result
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return TemplateEngine()
+
+
+@pytest.mark.parametrize('text', TEXTS)
+@pytest.mark.parametrize('qr_data', QR)
+@pytest.mark.parametrize('kra_data', KRA)
+def test_extract_all_matches_per_template_regex(engine, text, qr_data, kra_data):
+    expected = {
+        template.id: apply_template(template, text, qr_data, kra_data)
+        for template in DEFAULT_TEMPLATES
+        if template.active
+    }
+    assert engine.extract_all(ocr_text=text, qr_data=qr_data, kra_data=kra_data) == expected
+
+
+def test_snapshot_engine_extracts_the_same(engine):
+    restored = TemplateEngine.from_snapshot(engine.to_snapshot())
+    assert restored.version == engine.version
+    assert restored.template_versions() == engine.template_versions()
+    for text in TEXTS:
+        assert restored.extract_all(ocr_text=text) == engine.extract_all(ocr_text=text)
+
+
+def test_shared_scan_runs_each_pattern_once(engine):
+    scan = engine.scan(TEXTS[3])
+    for template_id in engine.templates:
+        engine.extract(template_id, scan=scan)
+    searched = scan.searches
+    for template_id in engine.templates:
+        engine.extract(template_id, scan=scan)
+    assert scan.searches == searched <= len(engine.sources)
+
+
+def test_required_literals_hold_for_every_match(engine):
+    # A pattern skipped for a missing literal must be one that could not have matched
+    for source, flags in engine.sources:
+        literals = required_literals(source, flags)
+        for text in TEXTS:
+            if re.search(source, text, flags) and literals:
+                assert any(literal in text.casefold() for literal in literals), source
+
+
+@pytest.mark.parametrize('source, expected', [
+    (r'Invoice\s*No[.:]?\s*([A-Z0-9]+)', ('invoice',)),
+    # Both alternations are required; the one with the longer shortest literal wins
+    (r'(?:Product|Fuel)[:\s]*(DIESEL|PETROL)', ('diesel', 'petrol')),
+    (r'([0-9]+\.?[0-9]*)', ()),
+])
+def test_required_literals(source, expected):
+    assert required_literals(source, re.I) == expected
+
+
+def test_editing_one_template_only_changes_its_version(engine):
+    templates = [template for template in DEFAULT_TEMPLATES if template.active]
+    edited = TemplateEngine(templates[:-1])
+    versions = engine.template_versions()
+    assert edited.template_versions() == {template_id: versions[template_id] for template_id in edited.templates}
+
+
+@pytest.mark.parametrize('raw, expected', [
+    (None, {}),
+    ('{"invoice": "A1"}', {'invoice': 'A1'}),
+    ('https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?invoiceNo=0041&amount=10', {'invoiceNo': '0041', 'amount': '10'}),
+    ('inv_no=77;total=12.50|junk', {'inv_no': '77', 'total': '12.50'}),
+])
+def test_qr_payload(raw, expected):
+    assert qr_payload(raw) == expected
@@ -0,0 +1,32 @@
+import pytest
+
+from receipt_processor.image_service import parse_range
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('bytes=-', None),
+    ('items=0-10', None),
+    ('bytes=0-1,5-9', None),
+    ('bytes=0-0', (0, 0)),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=10-', (10, 99)),
+    ('bytes=90-500', (90, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-500', (0, 99)),
+    (' bytes=5-9 ', (5, 9)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=150-200', 'bytes=9-5', 'bytes=-0'])
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_range_of_empty_body():
+    with pytest.raises(ValueError):
+        parse_range('bytes=0-', 0)
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from receipt_processor.errors import ProcessorError
+from receipt_processor.kra import KRAScraper, invoice_key, is_kra_host
+
+URL = 'https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?actionCode=loadPage&invoiceNo=0041230000012345'
+
+
+@pytest.fixture
+def redirecting_server():
+    """Answers every GET with a redirect to another host, counting requests."""
+    paths = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            paths.append(self.path)
+            self.send_response(302)
+            self.send_header('Location', 'http://attacker.example.com/steal')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', paths
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('hostname, expected', [
+    ('kra.go.ke', True),
+    ('itax.kra.go.ke', True),
+    ('kra.go.ke.example.com', False),
+    ('evilkra.go.ke', False),
+    ('', False),
+])
+def test_is_kra_host(hostname, expected):
+    assert is_kra_host(hostname) is expected
+
+
+def test_invoice_key():
+    assert invoice_key(URL) == '0041230000012345'
+    assert invoice_key('https://itax.kra.go.ke/x?invoice_no= 77 ') == '77'
+    assert invoice_key('https://itax.kra.go.ke/x') == 'https://itax.kra.go.ke/x'
+
+
+def test_off_domain_redirect_is_refused_without_retries(redirecting_server):
+    base_url, paths = redirecting_server
+
+    async def scrape():
+        scraper = KRAScraper(None, base_url=base_url)
+        try:
+            await scraper.scrape(URL)
+        finally:
+            await scraper.close()
+
+    with pytest.raises(ProcessorError) as error:
+        asyncio.run(scrape())
+    assert error.value.error_type == 'invalid_request'
+    assert len(paths) == 1
+
+
+def test_non_kra_url_is_rejected():
+    with pytest.raises(ProcessorError) as error:
+        asyncio.run(KRAScraper(None).scrape('https://example.com/invoiceChk.htm?invoiceNo=1'))
+    assert error.value.error_type == 'invalid_request'
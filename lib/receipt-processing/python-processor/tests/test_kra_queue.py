@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from receipt_processor.errors import ProcessorError
+from receipt_processor.kra_queue import RETRY_BASE_S, RETRY_MAX_S, VerificationQueue, retry_delay
+
+
+class Scraper:
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    async def scrape(self, url: str):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome, False
+
+    def stats(self) -> dict:
+        return {}
+
+
+def make_queue(outcome, write_error=None, execute_error=None):
+    """A queue whose database calls are recorded instead of run."""
+    queue = VerificationQueue(Scraper(outcome), max_attempts=3)
+    queue.written, queue.executed = [], []
+
+    def write_verified(receipt_id, invoice):
+        if write_error:
+            raise write_error
+        queue.written.append(receipt_id)
+
+    def execute(sql, params):
+        if execute_error:
+            raise execute_error
+        queue.executed.append(params)
+
+    queue._write_verified = write_verified
+    queue._execute = execute
+    return queue
+
+
+def verify(queue, *attempts, url='https://itax.kra.go.ke/x?invoiceNo=1'):
+    """Verify r1 once per attempt number (1 when none are given)."""
+    async def run():
+        for attempt in attempts or (1,):
+            await queue._verify('r1', url, attempt)
+
+    try:
+        asyncio.run(run())
+    finally:
+        queue.close()
+
+
+def test_retry_delay():
+    assert [retry_delay(attempts) for attempts in (0, 1, 2, 3)] == [
+        RETRY_BASE_S, RETRY_BASE_S, 2 * RETRY_BASE_S, 4 * RETRY_BASE_S,
+    ]
+    assert retry_delay(50) == RETRY_MAX_S
+
+
+def test_verified():
+    queue = make_queue({'invoice_number': 'KRA-1'})
+    verify(queue)
+    assert (queue.written, queue.executed) == (['r1'], [])
+    assert (queue.verified, queue.failed, queue.retried) == (1, 0, 0)
+
+
+def test_failed_lookup_is_retried_until_max_attempts():
+    queue = make_queue(ProcessorError('kra_unavailable', 'KRA returned HTTP 503'))
+    verify(queue, 1, 3)
+    assert [params[0] for params in queue.executed] == ['pending', 'failed']
+    assert queue.executed[0][2] == 'kra_unavailable: KRA returned HTTP 503'
+    assert (queue.failed, queue.retried) == (1, 1)
+
+
+def test_missing_url_fails_at_once():
+    queue = make_queue({})
+    verify(queue, url=None)
+    assert queue.executed[0][0] == 'failed'
+    assert queue.failed == 1
+
+
+@pytest.mark.parametrize('scraped, write_error', [
+    (RuntimeError('parser bug'), None),
+    ({'invoice_number': 'KRA-1'}, OSError('connection reset')),
+])
+def test_unexpected_errors_are_logged_and_rescheduled(capsys, scraped, write_error):
+    queue = make_queue(scraped, write_error=write_error)
+    error = write_error or scraped
+    verify(queue)
+    assert queue.executed == [('pending', retry_delay(1), f'{error.__class__.__name__}: {error}', 'r1')]
+    assert (queue.verified, queue.failed, queue.retried) == (0, 0, 1)
+    assert 'verifying r1 failed' in capsys.readouterr().err
+
+
+def test_reschedule_failure_leaves_the_lease(capsys):
+    queue = make_queue(ProcessorError('kra_no_data', 'no data'), execute_error=OSError('database is down'))
+    verify(queue)
+    assert 'rescheduling r1 failed' in capsys.readouterr().err
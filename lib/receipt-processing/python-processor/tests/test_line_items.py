@@ -0,0 +1,79 @@
+import math
+
+import pytest
+
+from receipt_processor.line_items import LineItems, check_totals, extract_line_items
+
+RECEIPT = '''NAIVAS SUPERMARKET
+Till No: 5512  Tel 0722123456
+SUGAR 2KG              2 x 250.00     500.00 B
+BREAD WHITE 400G                       65.00 A
+MILK BROOKSIDE 500ML
+    3 @ 60.00                         180.00 b
+PMS               12.50 L @ 182.00  2,275.00
+SUB TOTAL                            3,020.00
+VAT 16%                                416.55
+TOTAL                                3,020.00
+RICE 1KG                               99.00
+'''
+
+
+def test_layouts_become_columns():
+    items = extract_line_items(RECEIPT)
+    assert items.description == ['SUGAR 2KG', 'BREAD WHITE 400G', 'MILK BROOKSIDE 500ML', 'PMS']
+    assert list(items.amount) == [500.0, 65.0, 180.0, 2275.0]
+    assert items.tax_code == ['B', 'A', 'B', None]
+    assert list(items.line_no) == [2, 3, 4, 6]
+    assert items.qty[0] == 2 and items.unit_price[0] == 250
+    assert math.isnan(items.qty[1]) and math.isnan(items.unit_price[1])
+    assert items.qty[2] == 3 and items.unit_price[2] == 60
+    assert items.qty[3] == 12.5 and items.unit_price[3] == 182
+
+
+@pytest.mark.parametrize('line', [
+    'Tel 0722123456',
+    'PIN P051234567X',
+    'CASH                                 5,000.00',
+    'CHANGE                                 20.00',
+    'M-PESA                               3,020.00',
+])
+def test_non_item_lines_are_skipped(line):
+    assert len(extract_line_items(f'{line}\nBREAD 65.00')) == 1
+
+
+def test_description_without_quantity_line_is_dropped():
+    items = extract_line_items('MILK BROOKSIDE 500ML\nTill No: 5512\n    3 @ 60.00    180.00\n')
+    assert len(items) == 0
+
+
+def test_total_header_merchant_does_not_end_items():
+    items = extract_line_items('TOTAL KENYA\nDIESEL 20.5 L @ 182.30 3,737.15\nTOTAL KES 3,737.15\n')
+    assert items.description == ['DIESEL']
+
+
+def test_json_round_trip():
+    items = extract_line_items(RECEIPT)
+    data = items.to_json()
+    assert data['qty'][1] is None
+    restored = LineItems.from_json(data)
+    assert restored.to_json() == data
+    assert list(restored.rows())[0] == (2, 'SUGAR 2KG', 2.0, 250.0, 500.0, 'B')
+
+
+def test_check_totals_within_tolerance():
+    check = check_totals(extract_line_items(RECEIPT), 3020.00)
+    assert check == {'count': 4, 'items_total': 3020.0, 'row_mismatches': [], 'difference': 0.0, 'within_tolerance': True}
+
+
+def test_check_totals_flags_short_total_and_bad_rows():
+    items = extract_line_items('SUGAR 2KG   2 x 250.00   450.00\nBREAD 65.00\nEGGS 3 @ 20.00 60.04\n')
+    check = check_totals(items, 600.00)
+    assert check['row_mismatches'] == [0]  # 60.04 is within the rounding allowance
+    assert check['difference'] == -24.96
+    assert check['within_tolerance'] is False
+
+
+def test_check_totals_without_total_or_items():
+    items = extract_line_items('BREAD 65.00\n')
+    assert 'within_tolerance' not in check_totals(items, None)
+    assert check_totals(LineItems(), 100.0) is None
@@ -0,0 +1,129 @@
+import random
+import re
+import string
+
+import pytest
+
+from receipt_processor.names import (
+    MAX_WINDOW_WORDS, ChainIndex, NameIndex, allowed_distance, bounded_distance, normalize,
+)
+
+STORES = [
+    'Carrefour Junction', 'Carrefour Sarit', 'Naivas Westlands', 'Naivas Moi Avenue', 'Quickmart Kilimani',
+    'Chandarana Yaya', 'Total Energies Langata', 'Shell Waiyaki Way', 'Java House', 'KFC', 'Artcaffe',
+    'Tuskys Beba Beba', 'Cleanshelf Ngong Road', 'Eastmatt', 'Kenol Kobil Thika Road',
+]
+
+
+def levenshtein(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def brute_force(names: dict[str, str], query: str) -> dict[str, tuple[int, bool]]:
+    """Full-matrix namesMatch over every name and every word window of the query."""
+    whole = normalize(query)
+    words = re.findall(r'[a-z0-9]+', query.lower())
+    max_words = min(MAX_WINDOW_WORDS, max(len(re.findall(r'[a-z0-9]+', name.lower())) for name in names.values()))
+    probes = [(whole, False)] + [
+        (''.join(words[start:start + size]), True)
+        for size in range(1, min(max_words, len(words)) + 1)
+        for start in range(len(words) - size + 1)
+        if ''.join(words[start:start + size]) != whole
+    ]
+    best = {}
+    for probe, partial in probes:
+        if not probe:
+            continue
+        for key, name in names.items():
+            distance = levenshtein(probe, normalize(name))
+            if distance <= allowed_distance(probe) and (key not in best or (distance, partial) < best[key]):
+                best[key] = (distance, partial)
+    return best
+
+
+def garble(name: str, rng: random.Random, edits: int) -> str:
+    chars = list(name.upper())
+    for _ in range(edits):
+        position = rng.randrange(len(chars))
+        operation = rng.choice('sid')
+        if operation == 's':
+            chars[position] = rng.choice(string.ascii_uppercase + '01')
+        elif operation == 'i':
+            chars.insert(position, rng.choice(string.ascii_uppercase))
+        elif len(chars) > 1:
+            del chars[position]
+    return ''.join(chars)
+
+
+@pytest.fixture(scope='module')
+def index():
+    index = NameIndex()
+    for number, name in enumerate(STORES):
+        index.add(f's{number}', name)
+    return index
+
+
+def test_search_matches_brute_force(index):
+    names = {f's{number}': name for number, name in enumerate(STORES)}
+    rng = random.Random(11)
+    queries = [garble(rng.choice(STORES), rng, rng.randint(0, 2)) for _ in range(300)]
+    queries += [f'{garble(name, rng, 1)} LTD P.O. BOX 1234' for name in STORES]
+    queries += ['', 'RECEIPT', 'TOTAL KES 2,000.00']
+
+    for query in queries:
+        found = {match.key: (match.distance, match.partial) for match in index.search(query, limit=len(STORES))}
+        assert found == brute_force(names, query), query
+
+
+def test_search_ranks_exact_before_fuzzy_before_partial(index):
+    matches = index.search('CARREF0UR JUNCTI0N')
+    assert matches[0].name == 'Carrefour Junction'
+    assert matches[0].distance == 2 and not matches[0].partial
+
+    [match] = index.search('NAIVAS WESTLANDS LTD', limit=1)
+    assert (match.name, match.partial) == ('Naivas Westlands', True)
+
+
+def test_short_names_get_fewer_edits(index):
+    assert [match.name for match in index.search('KFC')] == ['KFC']
+    assert index.search('KFG') == []
+
+
+def test_add_replaces_and_remove_forgets():
+    index = NameIndex()
+    index.add('a', 'Naivas Westlands')
+    index.add('a', 'Quickmart Kilimani')
+    assert len(index) == 1
+    assert index.search('Naivas Westlands') == []
+    assert index.search('Quickmart Kilimani')[0].key == 'a'
+
+    index.remove('a')
+    assert 'a' not in index
+    assert index.search('Quickmart Kilimani') == []
+    assert index._deletes == {}
+
+
+@pytest.mark.parametrize('a, b', [
+    ('carrefour', 'carrefour'), ('carrefour', 'carefour'), ('naivas', 'naviasx'), ('kfc', 'kfcx'),
+    ('quickmart', 'quikmrat'), ('', 'abc'), ('abc', ''), ('totalenergies', 'totalenergis'),
+])
+@pytest.mark.parametrize('bound', [0, 1, 2, 3])
+def test_bounded_distance(a, b, bound):
+    distance = levenshtein(a, b)
+    assert bounded_distance(a, b, bound) == (distance if distance <= bound else None)
+
+
+@pytest.mark.parametrize('merchant, chain', [
+    ('TOTAL KENYA LTD JUNCTION', 'Total'),
+    ('CARREF0UR SARIT', 'Carrefour'),
+    ('TotalEnergies Langata', 'Total'),
+    ('Java House', None),
+])
+def test_chain_extract(merchant, chain):
+    assert ChainIndex().extract(merchant) == chain
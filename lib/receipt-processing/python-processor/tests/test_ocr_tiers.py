@@ -0,0 +1,141 @@
+import pytest
+
+from receipt_processor.errors import ProcessorError
+from receipt_processor.ocr_tiers import OCREngine, RemoteEngine, TierStats, build_tiers, read_tiered
+
+
+class Engine:
+    """Template engine stand-in: one five-field template, accepted at 80, `a` required."""
+
+    templates = {'t': ['a', 'b', 'c', 'd', 'e']}
+    confidence_thresholds = {'t': 80}
+    required_fields = {'t': ['a']}
+
+
+class Tier(OCREngine):
+    def __init__(self, name: str, text: str | None, partial: bool = False):
+        self.name = name
+        self.text = text
+        self.partial = partial
+        self.calls = 0
+
+    def read(self, image, image_bytes: bytes) -> str | None:
+        self.calls += 1
+        if self.text == 'error':
+            raise ProcessorError('ocr_failed', f'{self.name} is down')
+        return self.text
+
+
+def parse(text: str) -> tuple[dict, dict]:
+    """`text` lists the template fields read; the score is their share (no generic fields)."""
+    names = [name for name in text.split(',') if name]
+    return {'raw_text': text, 'date_needs_review': True}, {'t': {name: 'x' for name in names}}
+
+
+def run(*tiers: Tier):
+    return read_tiered(None, b'', list(tiers), parse, Engine())
+
+
+def test_confident_partial_reading_with_required_fields_is_accepted():
+    roi, full = Tier('roi', 'a,b,c,d', partial=True), Tier('tesseract', 'a,b,c,d,e')
+
+    ocr_data, fields, attempts = run(roi, full)
+
+    assert ocr_data['raw_text'] == 'a,b,c,d'
+    assert ocr_data['partial'] is True
+    assert fields == {'t': dict.fromkeys('abcd', 'x')}
+    assert [(attempt['engine'], attempt['accepted']) for attempt in attempts] == [('roi', True)]
+    assert full.calls == 0
+
+
+def test_partial_reading_missing_a_required_field_escalates():
+    ocr_data, _, attempts = run(Tier('roi', 'b,c,d,e', partial=True), Tier('tesseract', 'a,b,c,d'))
+
+    assert attempts[0]['confidence'] == 80
+    assert attempts[0]['missing'] == ['a']
+    assert not attempts[0]['accepted']
+    assert attempts[1]['accepted']
+    assert ocr_data['raw_text'] == 'a,b,c,d'
+    assert 'partial' not in ocr_data
+
+
+def test_rejected_partial_reading_loses_to_an_equally_confident_full_page():
+    ocr_data, _, attempts = run(Tier('roi', 'b,c', partial=True), Tier('tesseract', 'd,e'))
+
+    assert [attempt['accepted'] for attempt in attempts] == [False, False]
+    assert attempts[0]['confidence'] == attempts[1]['confidence'] == 40
+    assert ocr_data['raw_text'] == 'd,e'
+    assert 'partial' not in ocr_data
+
+
+def test_rejected_full_page_beats_a_more_confident_rejected_partial_reading():
+    ocr_data, _, _ = run(Tier('roi', 'b,c,d,e', partial=True), Tier('tesseract', 'a'))
+    assert ocr_data['raw_text'] == 'a'
+
+
+def test_partial_reading_is_kept_when_no_full_page_tier_reads_anything():
+    ocr_data, _, attempts = run(Tier('roi', 'b,c', partial=True), Tier('tesseract', 'error'), Tier('vision', None))
+
+    assert ocr_data['raw_text'] == 'b,c'
+    assert ocr_data['partial'] is True
+    assert attempts[1]['error'] == 'tesseract is down'
+    assert attempts[2]['confidence'] == 0
+
+
+def test_most_confident_full_page_reading_wins_when_none_is_accepted():
+    ocr_data, _, _ = run(Tier('tesseract', 'a'), Tier('vision', 'a,b,c'), Tier('gemini', 'a,b'))
+    assert ocr_data['raw_text'] == 'a,b,c'
+
+
+def test_escalation_stops_at_the_first_accepted_tier():
+    gemini = Tier('gemini', 'a,b,c,d,e')
+
+    ocr_data, _, attempts = run(Tier('tesseract', 'a'), Tier('vision', 'a,b,c,d'), gemini)
+
+    assert ocr_data['raw_text'] == 'a,b,c,d'
+    assert [attempt['engine'] for attempt in attempts] == ['tesseract', 'vision']
+    assert gemini.calls == 0
+
+
+def test_nothing_read():
+    ocr_data, fields, attempts = run(Tier('roi', None, partial=True), Tier('tesseract', 'error'))
+
+    assert (ocr_data, fields) == (None, {})
+    assert [attempt['engine'] for attempt in attempts] == ['roi', 'tesseract']
+
+
+def test_tier_stats():
+    stats = TierStats()
+    stats.record([{'engine': 'roi', 'accepted': False, 'ms': 10}, {'engine': 'tesseract', 'accepted': True, 'ms': 30}])
+    stats.record([{'engine': 'roi', 'accepted': True, 'ms': 20}])
+    stats.record(None)  # cache hit: no tiers ran
+
+    summary = stats.stats()
+    assert summary['receipts'] == 2
+    assert summary['tiers']['roi'] == {
+        'attempts': 2, 'hits': 1, 'errors': 0, 'hit_rate': 0.5, 'reach_rate': 1.0, 'avg_ms': 15,
+    }
+    assert summary['tiers']['tesseract']['reach_rate'] == 0.5
+
+
+def test_build_tiers():
+    tiers = build_tiers('roi, tesseract,vision=http://127.0.0.1:8766')
+    assert [(tier.name, tier.partial) for tier in tiers] == [('roi', True), ('tesseract', False), ('vision', False)]
+    with pytest.raises(ProcessorError):
+        build_tiers('tesseract,paddle')
+    with pytest.raises(ProcessorError):
+        build_tiers('tesseract=http://127.0.0.1:1')
+
+
+def test_incomplete_engines_fail_at_construction():
+    class NoText(RemoteEngine):
+        name = 'notext'
+        default_url = 'http://127.0.0.1:1'
+
+        def request(self, image_base64: str) -> tuple[str, dict]:
+            return '/ocr', {'image': image_base64}
+
+    with pytest.raises(TypeError):
+        OCREngine()
+    with pytest.raises(TypeError):
+        NoText()
@@ -0,0 +1,115 @@
+import random
+
+import pytest
+
+from receipt_processor.phash import MAX_RADIUS, DuplicateIndex, format_hash, hamming, parse_hash
+
+
+def _flip(value: int, bits: int, rng: random.Random) -> int:
+    for position in rng.sample(range(64), bits):
+        value ^= 1 << position
+    return value
+
+
+def _brute_force(entries, value, radius, scope=None):
+    return sorted(
+        (key, hamming(hash_, value))
+        for key, hash_, entry_scope in entries
+        if hamming(hash_, value) <= radius and (scope is None or entry_scope == scope)
+    )
+
+
+@pytest.fixture
+def entries():
+    # Random hashes plus clusters of near copies, so every radius has hits
+    rng = random.Random(7)
+    entries = []
+    for cluster in range(40):
+        base = rng.getrandbits(64)
+        entries.append((f'c{cluster}', base, f'user{cluster % 3}'))
+        for copy in range(5):
+            entries.append((f'c{cluster}-{copy}', _flip(base, rng.randint(1, 12), rng), f'user{copy % 3}'))
+    entries += [(f'r{n}', rng.getrandbits(64), 'user0') for n in range(2000)]
+    return entries
+
+
+@pytest.mark.parametrize('radius', [0, 3, 6, 10, MAX_RADIUS])
+def test_query_matches_brute_force(entries, radius):
+    index = DuplicateIndex()
+    for key, value, scope in entries:
+        index.add(key, value, scope)
+    rng = random.Random(radius)
+
+    for _, value, _ in rng.sample(entries, 60):
+        probe = _flip(value, rng.randint(0, 4), rng)
+        assert sorted(index.query(probe, radius)) == _brute_force(entries, probe, radius)
+        assert sorted(index.query(probe, radius, scope='user1')) == _brute_force(entries, probe, radius, 'user1')
+
+
+def test_query_orders_closest_first_and_limits(entries):
+    index = DuplicateIndex()
+    for key, value, scope in entries:
+        index.add(key, value, scope)
+    _, value, _ = entries[0]
+
+    matches = index.query(value, MAX_RADIUS, limit=3)
+
+    assert [distance for _, distance in matches] == sorted(distance for _, distance in matches)
+    assert matches == sorted(index.query(value, MAX_RADIUS), key=lambda match: match[1])[:3]
+    assert matches[0] == (entries[0][0], 0)
+
+
+def test_radius_is_bounded():
+    with pytest.raises(ValueError):
+        DuplicateIndex().query(0, MAX_RADIUS + 1)
+
+
+def test_add_is_idempotent_per_scope():
+    index = DuplicateIndex()
+    assert index.add('a', 1, 'user0')
+    assert not index.add('a', 1, 'user0')
+    assert index.add('a', 1, 'user1')
+    assert len(index) == 2
+
+
+def test_log_reloads(tmp_path):
+    path = tmp_path / 'phash.jsonl'
+    index = DuplicateIndex(str(path))
+    for n in range(20):
+        index.add(f'k{n}', n * 0x0101010101010101, 'user0')
+    index.add('k0', 0, 'user0')
+    index.close()
+    assert len(path.read_text().splitlines()) == 20
+
+    reloaded = DuplicateIndex(str(path))
+    assert len(reloaded) == 20
+    assert reloaded.query(19 * 0x0101010101010101, 0) == [('k19', 0)]
+    assert reloaded.query(0, 0, scope='user1') == []
+    reloaded.close()
+
+
+def test_log_reloads_and_compacts(tmp_path):
+    path = tmp_path / 'phash.jsonl'
+    index = DuplicateIndex(str(path), max_entries=8)
+    for n in range(20):
+        index.add(f'k{n}', n * 0x0101010101010101, 'user0')
+    kept = len(index)
+    index.close()
+
+    # Past the cap the oldest quarter goes: memory and the log stay bounded
+    assert kept <= 8
+    assert len(path.read_text().splitlines()) == kept
+
+    reloaded = DuplicateIndex(str(path), max_entries=4)
+    assert len(reloaded) == 4
+    assert reloaded.query(19 * 0x0101010101010101, 0) == [('k19', 0)]
+    assert reloaded.query(0, 0) == []
+    reloaded.close()
+    assert len(path.read_text().splitlines()) == 4
+
+
+def test_hash_text_round_trip():
+    assert parse_hash(format_hash(0xDEADBEEF)) == 0xDEADBEEF
+    assert format_hash(1) == '0000000000000001'
+    with pytest.raises(ValueError):
+        parse_hash('1' + '0' * 16)
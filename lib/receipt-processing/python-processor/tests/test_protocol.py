@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from receipt_processor.protocol import HEADER, MAX_FRAME_BYTES, encode_json, read_frame, read_request, write_frame
+
+
+class _Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, chunk: bytes) -> None:
+        self.data += chunk
+
+    async def drain(self) -> None:
+        pass
+
+
+def _frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+
+def _read_all(read, data: bytes, count: int = 1) -> list:
+    """Run `read(reader)` `count` times over a stream holding `data`."""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return [await read(reader) for _ in range(count)]
+
+    return asyncio.run(run())
+
+
+def test_write_frame_round_trips_through_read_frame():
+    writer = _Writer()
+    asyncio.run(write_frame(writer, b'\x00\xffimage bytes'))
+    asyncio.run(write_frame(writer, b''))
+
+    assert _read_all(read_frame, bytes(writer.data), 3) == [b'\x00\xffimage bytes', b'', None]
+
+
+def test_request_with_binary_body():
+    header = encode_json({'op': 'process', 'body': True, 'mobile_qr_url': None})
+    body = bytes(range(256)) * 4
+
+    [(request, received)] = _read_all(read_request, _frame(header) + _frame(body))
+
+    assert request == {'op': 'process', 'body': True, 'mobile_qr_url': None}
+    assert received == body
+
+
+def test_request_without_body_leaves_the_next_frame_unread():
+    ping = _frame(encode_json({'op': 'ping'}))
+
+    assert _read_all(read_request, ping + ping, 3) == [({'op': 'ping'}, None), ({'op': 'ping'}, None), None]
+
+
+def test_missing_body_frame_is_a_connection_error():
+    with pytest.raises(ConnectionError):
+        _read_all(read_request, _frame(encode_json({'op': 'process', 'body': True})))
+
+
+def test_truncated_header_is_a_connection_error():
+    with pytest.raises(ConnectionError):
+        _read_all(read_frame, b'\x00\x00')
+
+
+def test_truncated_payload_raises():
+    with pytest.raises(asyncio.IncompleteReadError):
+        _read_all(read_frame, HEADER.pack(10) + b'short')
+
+
+def test_oversized_frame_is_rejected_before_reading_it():
+    with pytest.raises(ValueError):
+        _read_all(read_frame, HEADER.pack(MAX_FRAME_BYTES + 1))
+
+
+def test_header_must_be_a_json_object():
+    with pytest.raises(ValueError):
+        _read_all(read_request, _frame(b'[1, 2]'))
@@ -0,0 +1,81 @@
+import pytest
+
+from receipt_processor.extraction import TemplateEngine
+from receipt_processor.reextract import plan, receipt_reasons
+from receipt_processor.templates import DEFAULT_TEMPLATES
+from receipt_processor.version import STAGE_VERSIONS
+
+FUEL_TEXT = 'TOTAL KENYA\nPump: 4\nProduct: DIESEL 20.5 Litres\nPrice: 182.30\nTOTAL KES 3,737.15\n'
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return TemplateEngine()
+
+
+def stamp(engine, stages=STAGE_VERSIONS, text=FUEL_TEXT):
+    """The stamp a receipt processed now would carry: every template that extracted fields."""
+    extracted = engine.extract_all(ocr_text=text)
+    versions = engine.template_versions()
+    return {
+        'stages': dict(stages),
+        'templates': {template_id: versions[template_id] for template_id, fields in extracted.items() if fields},
+    }
+
+
+def test_current_stamp_needs_nothing(engine):
+    assert receipt_reasons(stamp(engine), FUEL_TEXT, engine) == []
+
+
+def test_unstamped(engine):
+    assert receipt_reasons(None, FUEL_TEXT, engine) == ['unstamped']
+    assert receipt_reasons({}, None, engine) == ['unstamped']
+
+
+def test_stale_stage(engine):
+    versions = stamp(engine)
+    versions['stages']['parse'] = '0'
+    assert receipt_reasons(versions, FUEL_TEXT, engine) == ['stage:parse']
+
+
+def test_skipped_stage_is_left_alone(engine):
+    stages = {stage: version for stage, version in STAGE_VERSIONS.items() if stage != 'ocr'}
+    assert receipt_reasons(stamp(engine, stages), FUEL_TEXT, engine) == []
+
+
+def test_edited_and_removed_templates(engine):
+    versions = stamp(engine)
+    versions['templates']['total-kenya-fuel-v1'] = 'old'
+    versions['templates']['retired-v1'] = 'abc'
+    assert receipt_reasons(versions, FUEL_TEXT, engine) == ['template:retired-v1', 'template:total-kenya-fuel-v1']
+
+
+def test_new_template_match(engine):
+    versions = stamp(engine)
+    del versions['templates']['total-kenya-fuel-v1']
+    assert receipt_reasons(versions, FUEL_TEXT, engine) == ['new_match:total-kenya-fuel-v1']
+
+
+def test_new_match_needs_an_ocr_stage(engine):
+    versions = stamp(engine, {'qr': STAGE_VERSIONS['qr']})
+    del versions['templates']['total-kenya-fuel-v1']
+    assert receipt_reasons(versions, FUEL_TEXT, engine) == []
+    assert receipt_reasons(versions, None, engine) == []
+
+
+def test_template_subset_engine(engine):
+    """A receipt stamped by a template that no longer exists is selected once, by name."""
+    fuel_only = TemplateEngine([t for t in DEFAULT_TEMPLATES if t.id == 'total-kenya-fuel-v1'])
+    assert receipt_reasons(stamp(engine), FUEL_TEXT, fuel_only) == [
+        f'template:{template_id}' for template_id in sorted(stamp(engine)['templates']) if template_id != 'total-kenya-fuel-v1'
+    ]
+
+
+def test_plan_yields_only_selected_rows(engine):
+    stale = stamp(engine)
+    stale['stages']['ocr'] = '0'
+    rows = [('r1', stamp(engine), FUEL_TEXT), ('r2', None, None), ('r3', stale, FUEL_TEXT)]
+    assert list(plan(rows, engine)) == [
+        {'id': 'r2', 'reasons': ['unstamped']},
+        {'id': 'r3', 'reasons': ['stage:ocr']},
+    ]
@@ -0,0 +1,56 @@
+import datetime
+from decimal import Decimal
+
+from receipt_processor.rollup import diff_rollups
+
+JAN, FEB = datetime.date(2026, 1, 1), datetime.date(2026, 2, 1)
+
+
+def row(user, workspace, month, items, amount, reports):
+    return (user, workspace, month), (items, Decimal(amount), reports)
+
+
+def diff(expected, stored):
+    return list(diff_rollups(iter(expected), iter(stored)))
+
+
+def test_identical_streams():
+    rows = [row('a', '', JAN, 2, '10.00', 1), row('a', 'w1', JAN, 1, '5.50', 0), row('b', '', FEB, 3, '7', 1)]
+    assert diff(rows, list(rows)) == []
+    assert diff([], []) == []
+
+
+def test_changed_counters():
+    [mismatch] = diff([row('a', 'w1', JAN, 2, '10.00', 1)], [row('a', 'w1', JAN, 2, '9.00', 1)])
+    assert mismatch == {
+        'user_id': 'a',
+        'workspace_id': 'w1',
+        'month': '2026-01-01',
+        'expected': {'item_count': 2, 'total_amount': Decimal('10.00'), 'report_count': 1},
+        'stored': {'item_count': 2, 'total_amount': Decimal('9.00'), 'report_count': 1},
+    }
+
+
+def test_missing_rows_count_as_zero():
+    expected = [row('a', '', JAN, 1, '1', 0), row('c', '', JAN, 1, '1', 0)]
+    stored = [row('b', '', FEB, 4, '8', 2), row('c', '', JAN, 1, '1', 0), row('d', '', JAN, 0, '0', 0)]
+    mismatches = diff(expected, stored)
+    assert [(m['user_id'], m['workspace_id']) for m in mismatches] == [('a', None), ('b', None)]
+    assert mismatches[0]['stored'] == {'item_count': 0, 'total_amount': Decimal(0), 'report_count': 0}
+    assert mismatches[1]['expected'] == {'item_count': 0, 'total_amount': Decimal(0), 'report_count': 0}
+
+
+def test_merge_matches_dict_diff():
+    expected = [row(user, workspace, month, i, str(i), i % 2)
+                for i, (user, workspace, month) in enumerate(
+                    (u, w, m) for u in 'abcd' for w in ('', 'w1') for m in (JAN, FEB))]
+    stored = [(key, counters) for i, (key, counters) in enumerate(expected) if i % 3]
+    stored[0] = (stored[0][0], (99, Decimal(0), 0))
+    stored = sorted(stored + [row('bb', '', JAN, 1, '1', 1)])
+
+    want, have = dict(expected), dict(stored)
+    zero = (0, Decimal(0), 0)
+    keys = sorted(key for key in want.keys() | have.keys() if want.get(key, zero) != have.get(key, zero))
+    assert [(m['user_id'], m['workspace_id'] or '', m['month']) for m in diff(expected, stored)] == [
+        (user, workspace, month.isoformat()) for user, workspace, month in keys
+    ]
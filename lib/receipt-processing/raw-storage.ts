@@ -18,6 +18,7 @@ export interface RawReceiptData {
   // Original receipt
   imageUrl: string;
   imageHash?: string;
+  perceptualHash?: string; // 64-bit pHash (hex) from the Python processor, for near-duplicate detection
   
   // Raw extracted data (stored as JSON)
   rawQrData?: any;
@@ -25,6 +26,7 @@ export interface RawReceiptData {
   etimsQRUrl?: string; // NEW: eTIMS QR code URL
   rawOcrText?: string;
   rawKraData?: any;
+  kraStatus?: 'pending' | 'verified' | 'failed'; // Background KRA verification (migration 034)
   rawGeminiData?: any;
   receiptFullText?: string; // NEW: Complete OCR text (bag of words)
   
@@ -76,6 +78,12 @@ export interface RawReceiptStorage {
   exportToText(id: string, supabase: SupabaseClient): Promise<string>;
 }
 
+// Columns added by migration 033 (near-duplicate detection)
+const PERCEPTUAL_HASH_COLUMNS = ['perceptual_hash'];
+
+// Columns added by migration 034 (background KRA verification)
+const KRA_QUEUE_COLUMNS = ['kra_status', 'kra_next_attempt_at', 'kra_verified_at'];
+
 /**
  * Supabase implementation of raw receipt storage
  */
@@ -113,6 +121,19 @@ export class SupabaseRawReceiptStorage implements RawReceiptStorage {
     if (data.etimsQRUrl) {
       insertData.etims_qr_url = data.etimsQRUrl;
     }
+    // Near-duplicate hash (dropped below if migration 033 is missing)
+    if (data.perceptualHash) {
+      insertData.perceptual_hash = data.perceptualHash;
+    }
+    // Queue for background KRA verification (dropped below if migration 034 is missing)
+    if (data.kraStatus) {
+      insertData.kra_status = data.kraStatus;
+      if (data.kraStatus === 'pending') {
+        insertData.kra_next_attempt_at = new Date().toISOString();
+      } else if (data.kraStatus === 'verified') {
+        insertData.kra_verified_at = new Date().toISOString();
+      }
+    }
     if (data.rawGeminiData?.hasEtimsQR !== undefined) {
       insertData.ai_etims_detected = data.rawGeminiData.hasEtimsQR;
     }
@@ -134,12 +155,31 @@ export class SupabaseRawReceiptStorage implements RawReceiptStorage {
       insertData.receipt_full_text = data.receiptFullText;
     }
     
-    const { data: result, error } = await supabase
+    let { data: result, error } = await supabase
       .from('raw_receipts')
       .insert(insertData)
       .select('id')
       .single();
     
+    // Migration 033 or 034 not applied: save the receipt without the missing
+    // columns rather than losing it (PGRST204: unknown column in the schema
+    // cache). Each retry drops the columns of the migration the error names.
+    let optionalColumns = [PERCEPTUAL_HASH_COLUMNS, KRA_QUEUE_COLUMNS];
+    while (error && (error.code === 'PGRST204' || error.code === '42703')) {
+      const message = error.message;
+      const columns = optionalColumns.find((group) => group.some((column) => message.includes(column)));
+      if (!columns) break;
+      optionalColumns = optionalColumns.filter((group) => group !== columns);
+      for (const column of columns) {
+        delete insertData[column];
+      }
+      ({ data: result, error } = await supabase
+        .from('raw_receipts')
+        .insert(insertData)
+        .select('id')
+        .single());
+    }
+    
     if (error) throw error;
     return result.id;
   }
@@ -346,9 +386,11 @@ export class SupabaseRawReceiptStorage implements RawReceiptStorage {
       workspaceId: row.workspace_id,
       imageUrl: row.image_url,
       imageHash: row.image_hash,
+      perceptualHash: row.perceptual_hash,
       rawQrData: row.raw_qr_data,
       rawOcrText: row.raw_ocr_text,
       rawKraData: row.raw_kra_data,
+      kraStatus: row.kra_status ?? undefined,
       rawGeminiData: row.raw_gemini_data,
       fileSizeBytes: row.file_size_bytes,
       imageWidth: row.image_width,
@@ -7,6 +7,7 @@
 
 import type { SupabaseClient } from '@supabase/supabase-js';
 import { templateRegistry, type ReceiptTemplate } from './template-registry';
+import { findNearbyStoresWithPython, matchMerchantWithPython } from './python-client';
 
 export interface Store {
   id: string;
@@ -195,6 +196,16 @@ export class StoreRecognizer {
     radiusMeters: number,
     supabase: SupabaseClient
   ): Promise<Store[]> {
+    // In-memory spatial index in the Python pool, when it is running.
+    // Seed-only entries (id "seed:<name>") have no stores row yet, so skip them.
+    // Nothing left means the pool could not load the stores table (no
+    // DATABASE_URL, failed refresh) or there is no store nearby: ask the RPC.
+    const indexed = (await findNearbyStoresWithPython(latitude, longitude, radiusMeters))
+      ?.filter((row: any) => !String(row.id).startsWith('seed:'));
+    if (indexed?.length) {
+      return indexed.map(this.mapStore);
+    }
+
     // Using PostGIS or basic distance calculation
     const { data } = await supabase.rpc('find_stores_nearby', {
       lat: latitude,
@@ -240,8 +251,13 @@ export class StoreRecognizer {
     
     if (exactMatch) return this.mapStore(exactMatch);
     
+    // Fuzzy match against every known store name (Python pool index), skipping seed-only entries
+    const matched = await matchMerchantWithPython(name);
+    const fuzzyMatch = matched?.stores.find((row: any) => !String(row.id).startsWith('seed:'));
+    if (fuzzyMatch) return this.mapStore(fuzzyMatch);
+    
     // Try fuzzy match on chain name
-    const chainName = this.extractChainName(name);
+    const chainName = matched ? matched.chainName ?? undefined : this.extractChainName(name);
     if (chainName) {
       const { data: chainMatch } = await supabase
         .from('stores')
@@ -0,0 +1,15 @@
+-- MIGRATION 033: Add perceptual_hash column to raw_receipts
+-- 64-bit DCT perceptual hash (16 hex chars) computed by the Python receipt processor.
+-- image_hash (SHA-256) only matches byte-identical uploads; perceptual_hash lets the
+-- dedupe job (receipt_processor.dedupe) find re-photographed or recompressed copies.
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'raw_receipts' AND column_name = 'perceptual_hash'
+  ) THEN
+    ALTER TABLE raw_receipts ADD COLUMN perceptual_hash TEXT;
+    COMMENT ON COLUMN raw_receipts.perceptual_hash IS 'Perceptual image hash (hex) for near-duplicate detection';
+  END IF;
+END $$;
@@ -0,0 +1,52 @@
+-- MIGRATION 034: KRA verification queue on raw_receipts
+-- Uploads no longer wait for the KRA portal. Receipts with an eTIMS QR that could
+-- not be verified inline are marked kra_status = 'pending' and verified in the
+-- background by receipt_processor.kra_queue, which claims rows with a lease
+-- (kra_claimed_until) and writes raw_kra_data back. kra_verification_backlog
+-- reports depth and age so a degraded KRA portal is visible.
+
+BEGIN;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'raw_receipts' AND column_name = 'kra_status'
+  ) THEN
+    ALTER TABLE raw_receipts ADD COLUMN kra_status TEXT;
+    ALTER TABLE raw_receipts ADD COLUMN kra_attempts INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE raw_receipts ADD COLUMN kra_next_attempt_at TIMESTAMP WITH TIME ZONE;
+    ALTER TABLE raw_receipts ADD COLUMN kra_claimed_until TIMESTAMP WITH TIME ZONE;
+    ALTER TABLE raw_receipts ADD COLUMN kra_verified_at TIMESTAMP WITH TIME ZONE;
+    ALTER TABLE raw_receipts ADD COLUMN kra_last_error TEXT;
+    COMMENT ON COLUMN raw_receipts.kra_status IS 'KRA verification: pending, verified, failed (NULL: no eTIMS QR)';
+    COMMENT ON COLUMN raw_receipts.kra_claimed_until IS 'Lease held by a verification worker; expired leases are reclaimed';
+  END IF;
+END $$;
+
+-- Workers claim due rows in next-attempt order
+CREATE INDEX IF NOT EXISTS idx_raw_receipts_kra_pending
+  ON raw_receipts (kra_next_attempt_at)
+  WHERE kra_status = 'pending';
+
+-- Queue eTIMS receipts saved without any KRA data
+UPDATE raw_receipts
+SET kra_status = 'pending', kra_next_attempt_at = NOW()
+WHERE kra_status IS NULL
+  AND etims_qr_url IS NOT NULL
+  AND raw_kra_data IS NULL;
+
+CREATE OR REPLACE VIEW kra_verification_backlog
+WITH (security_invoker = true) AS
+SELECT
+  COUNT(*) FILTER (WHERE kra_status = 'pending') AS pending,
+  COUNT(*) FILTER (WHERE kra_status = 'pending' AND kra_next_attempt_at <= NOW()) AS due,
+  COUNT(*) FILTER (WHERE kra_status = 'pending' AND kra_claimed_until > NOW()) AS in_flight,
+  COUNT(*) FILTER (WHERE kra_status = 'pending' AND kra_attempts > 0) AS retrying,
+  COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at) FILTER (WHERE kra_status = 'pending')), 0) AS oldest_pending_age_s
+FROM raw_receipts
+WHERE kra_status = 'pending';
+
+COMMIT;
+
+SELECT 'KRA verification queue added' AS status;
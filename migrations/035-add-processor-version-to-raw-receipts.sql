@@ -0,0 +1,19 @@
+-- MIGRATION 035: Add processor_version column to raw_receipts
+-- Version of the Python receipt processor that last processed the row (version.py).
+-- receipt_processor.backfill selects rows that are still 'raw' or were processed by
+-- an older version, walking them in (created_at, id) order.
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'raw_receipts' AND column_name = 'processor_version'
+  ) THEN
+    ALTER TABLE raw_receipts ADD COLUMN processor_version TEXT;
+    COMMENT ON COLUMN raw_receipts.processor_version IS 'Python processor version that last processed this receipt (NULL: never)';
+  END IF;
+END $$;
+
+-- Keyset pagination for the backfill
+CREATE INDEX IF NOT EXISTS idx_raw_receipts_created_at_id
+  ON raw_receipts (created_at, id);
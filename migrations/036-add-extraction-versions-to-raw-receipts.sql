@@ -0,0 +1,33 @@
+-- MIGRATION 036: Add extraction_versions column to raw_receipts
+-- What produced a receipt's extraction: {"processor": "1.4.0", "stages": {"ocr": "1", ...},
+-- "templates": {"total-kenya-fuel-v1": "<fingerprint>", ...}}, written by receipt_processor.backfill.
+-- expense_items rows reach it through raw_receipt_id. receipt_processor.reextract compares
+-- it with the current stage and template versions to re-queue only affected receipts.
+-- reextract_requested_at marks the rows it re-queued (reextract --apply); backfill --planned
+-- selects them and clears the mark once a row is reprocessed.
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'raw_receipts' AND column_name = 'extraction_versions'
+  ) THEN
+    ALTER TABLE raw_receipts ADD COLUMN extraction_versions JSONB;
+    COMMENT ON COLUMN raw_receipts.extraction_versions IS 'Processor, stage and template versions that produced the extraction';
+  END IF;
+END $$;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'raw_receipts' AND column_name = 'reextract_requested_at'
+  ) THEN
+    ALTER TABLE raw_receipts ADD COLUMN reextract_requested_at TIMESTAMP WITH TIME ZONE;
+    COMMENT ON COLUMN raw_receipts.reextract_requested_at IS 'Set by the re-extraction planner; cleared when backfill reprocesses the row';
+  END IF;
+END $$;
+
+-- backfill --planned walks only the marked rows
+CREATE INDEX IF NOT EXISTS idx_raw_receipts_reextract_requested
+  ON raw_receipts (created_at, id) WHERE reextract_requested_at IS NOT NULL;
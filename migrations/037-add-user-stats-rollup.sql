@@ -0,0 +1,186 @@
+-- MIGRATION 037: Incrementally maintained per-user stats rollup
+-- user_stats_monthly holds one row per (user_id, workspace_id, month) with the item count,
+-- item amount total and report count, so /api/mobile/stats reads a handful of rows instead
+-- of re-aggregating expense_items on every dashboard load.
+-- Items are bucketed like the 024 RPCs: COALESCE(transaction_date, created_at), by UTC month.
+-- Reports are bucketed by their created_at month.
+-- Triggers on expense_items and expense_reports apply deltas in the same transaction as the
+-- change. receipt_processor.rollup recomputes from scratch and diffs (verify --repair).
+-- UNIQUE NULLS NOT DISTINCT needs Postgres 15+.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS user_stats_monthly (
+  user_id TEXT NOT NULL,
+  workspace_id UUID,
+  month DATE NOT NULL,
+  item_count BIGINT NOT NULL DEFAULT 0,
+  total_amount NUMERIC NOT NULL DEFAULT 0,
+  report_count BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+  CONSTRAINT user_stats_monthly_key UNIQUE NULLS NOT DISTINCT (user_id, workspace_id, month)
+);
+
+COMMENT ON TABLE user_stats_monthly IS 'Per user, workspace and month expense totals, kept up to date by triggers';
+
+ALTER TABLE user_stats_monthly ENABLE ROW LEVEL SECURITY;
+
+-- Read-only for users: only the triggers (SECURITY DEFINER) write
+DROP POLICY IF EXISTS "Users can read own stats" ON user_stats_monthly;
+CREATE POLICY "Users can read own stats"
+  ON user_stats_monthly
+  FOR SELECT
+  TO authenticated
+  USING (user_id = auth.jwt() ->> 'sub');
+
+-- Month an item or report counts towards (first day, UTC)
+CREATE OR REPLACE FUNCTION public.user_stats_month(p_transaction_date date, p_created_at timestamptz)
+RETURNS date
+LANGUAGE sql
+IMMUTABLE
+SET search_path = ''
+AS $$
+  SELECT date_trunc('month', COALESCE(p_transaction_date::timestamp, p_created_at AT TIME ZONE 'UTC'))::date;
+$$;
+
+-- Add deltas to one rollup row, creating it if needed
+CREATE OR REPLACE FUNCTION public.user_stats_apply(
+  p_user_id text, p_workspace_id uuid, p_month date,
+  p_items bigint, p_amount numeric, p_reports bigint
+)
+RETURNS void
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = ''
+AS $$
+  INSERT INTO public.user_stats_monthly AS s (user_id, workspace_id, month, item_count, total_amount, report_count)
+  VALUES (p_user_id, p_workspace_id, p_month, p_items, p_amount, p_reports)
+  ON CONFLICT ON CONSTRAINT user_stats_monthly_key DO UPDATE
+  SET item_count = s.item_count + EXCLUDED.item_count,
+      total_amount = s.total_amount + EXCLUDED.total_amount,
+      report_count = s.report_count + EXCLUDED.report_count,
+      updated_at = NOW();
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.user_stats_apply(text, uuid, date, bigint, numeric, bigint) FROM PUBLIC, anon, authenticated;
+
+-- expense_items: take the old row out, put the new row in
+CREATE OR REPLACE FUNCTION public.user_stats_item_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = ''
+AS $$
+DECLARE
+  report record;
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    SELECT user_id, workspace_id INTO report FROM public.expense_reports WHERE id = OLD.report_id;
+    -- Not found while the report itself is being deleted: its trigger already took the items out
+    IF FOUND THEN
+      PERFORM public.user_stats_apply(report.user_id, report.workspace_id,
+        public.user_stats_month(OLD.transaction_date, OLD.created_at), -1, -COALESCE(OLD.amount, 0), 0);
+    END IF;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    SELECT user_id, workspace_id INTO report FROM public.expense_reports WHERE id = NEW.report_id;
+    IF FOUND THEN
+      PERFORM public.user_stats_apply(report.user_id, report.workspace_id,
+        public.user_stats_month(NEW.transaction_date, NEW.created_at), 1, COALESCE(NEW.amount, 0), 0);
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+-- expense_reports: the report itself, and all of its items when it moves or is deleted
+CREATE OR REPLACE FUNCTION public.user_stats_report_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = ''
+AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM public.user_stats_apply(OLD.user_id, OLD.workspace_id, public.user_stats_month(NULL, OLD.created_at), 0, 0, -1);
+    PERFORM public.user_stats_apply(OLD.user_id, OLD.workspace_id, items.month, -items.item_count, -items.total_amount, 0)
+    FROM (
+      SELECT public.user_stats_month(transaction_date, created_at) AS month,
+             COUNT(*) AS item_count, COALESCE(SUM(amount), 0) AS total_amount
+      FROM public.expense_items WHERE report_id = OLD.id GROUP BY 1
+    ) items;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM public.user_stats_apply(NEW.user_id, NEW.workspace_id, public.user_stats_month(NULL, NEW.created_at), 0, 0, 1);
+    PERFORM public.user_stats_apply(NEW.user_id, NEW.workspace_id, items.month, items.item_count, items.total_amount, 0)
+    FROM (
+      SELECT public.user_stats_month(transaction_date, created_at) AS month,
+             COUNT(*) AS item_count, COALESCE(SUM(amount), 0) AS total_amount
+      FROM public.expense_items WHERE report_id = NEW.id GROUP BY 1
+    ) items;
+  END IF;
+  IF TG_OP = 'DELETE' THEN
+    RETURN OLD;
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS user_stats_items ON expense_items;
+CREATE TRIGGER user_stats_items
+  AFTER INSERT OR DELETE OR UPDATE OF report_id, amount, transaction_date, created_at ON expense_items
+  FOR EACH ROW
+  EXECUTE FUNCTION public.user_stats_item_changed();
+
+-- BEFORE DELETE so the items are still there to subtract; the cascade then finds no report
+DROP TRIGGER IF EXISTS user_stats_reports_delete ON expense_reports;
+CREATE TRIGGER user_stats_reports_delete
+  BEFORE DELETE ON expense_reports
+  FOR EACH ROW
+  EXECUTE FUNCTION public.user_stats_report_changed();
+
+DROP TRIGGER IF EXISTS user_stats_reports_insert ON expense_reports;
+CREATE TRIGGER user_stats_reports_insert
+  AFTER INSERT ON expense_reports
+  FOR EACH ROW
+  EXECUTE FUNCTION public.user_stats_report_changed();
+
+DROP TRIGGER IF EXISTS user_stats_reports_update ON expense_reports;
+CREATE TRIGGER user_stats_reports_update
+  AFTER UPDATE OF user_id, workspace_id, created_at ON expense_reports
+  FOR EACH ROW
+  WHEN (OLD.user_id IS DISTINCT FROM NEW.user_id
+        OR OLD.workspace_id IS DISTINCT FROM NEW.workspace_id
+        OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+  EXECUTE FUNCTION public.user_stats_report_changed();
+
+-- What the rollup should contain, recomputed from scratch (receipt_processor.rollup verify)
+CREATE OR REPLACE VIEW user_stats_monthly_expected
+WITH (security_invoker = true) AS
+SELECT user_id, workspace_id, month,
+       SUM(item_count)::bigint AS item_count,
+       SUM(total_amount) AS total_amount,
+       SUM(report_count)::bigint AS report_count
+FROM (
+  SELECT er.user_id, er.workspace_id, public.user_stats_month(ei.transaction_date, ei.created_at) AS month,
+         1 AS item_count, COALESCE(ei.amount, 0) AS total_amount, 0 AS report_count
+  FROM expense_items ei
+  JOIN expense_reports er ON er.id = ei.report_id
+  UNION ALL
+  SELECT user_id, workspace_id, public.user_stats_month(NULL, created_at), 0, 0, 1
+  FROM expense_reports
+) contributions
+GROUP BY user_id, workspace_id, month;
+
+REVOKE SELECT ON user_stats_monthly_expected FROM anon, authenticated;
+
+-- Initial fill. Writers wait for this transaction, so no change slips between the fill and the triggers.
+LOCK TABLE expense_reports, expense_items IN SHARE MODE;
+DELETE FROM user_stats_monthly;
+INSERT INTO user_stats_monthly (user_id, workspace_id, month, item_count, total_amount, report_count)
+SELECT user_id, workspace_id, month, item_count, total_amount, report_count
+FROM user_stats_monthly_expected;
+
+COMMIT;
+
+SELECT 'User stats rollup added' AS status;